@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the API endpoints on a synthetic poll.
+
+A test database is created, filled with generated questions, options, users and votes,
+and every endpoint is requested repeatedly through django's test client.
+Latency percentiles, throughput and the number of queries per request are reported
+and can be saved as JSON with --output. If VOTE_QUEUE is set, votes are queued in a temporary
+file (and answered with status 202), so the vote results measure queuing, not applying ballots. Passing the JSON of an earlier run to --compare
+reports the endpoints which have become slower and exits with status 1 if there are any.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+FILE_PATH = os.path.abspath(__file__)
+BASE_DIR = os.path.dirname(os.path.dirname(FILE_PATH))
+import sys
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+import argparse
+import json
+import platform
+import random
+import shutil
+import tempfile
+from collections import OrderedDict
+from timeit import default_timer
+
+from typing import Any, Callable, Dict, List, Sequence
+
+ENDPOINTS = ["index", "questions", "options", "my_choices", "vote", "login", "register"]
+
+parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+parser.add_argument('--questions', type=int, default=20, help="Number of questions")
+parser.add_argument('--options', type=int, default=10, help="Number of options per question")
+parser.add_argument('--users', type=int, default=100, help="Number of users")
+parser.add_argument('--votes', type=int, default=10, help="Number of questions each user has voted on")
+parser.add_argument('--requests', type=int, default=200, help="Number of requests to each endpoint")
+parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS,
+                    help="Endpoints to benchmark (default: all)")
+parser.add_argument('--no-cache', action='store_true', default=False, help="Disable the API cache")
+parser.add_argument('--seed', type=int, default=0, help="Seed for generating data and requests")
+parser.add_argument('--output', help="Save the results as JSON to this file")
+parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+parser.add_argument('--threshold', type=float, default=0.2,
+                    help="Fraction by which the median latency can grow before it is reported as a regression")
+args = parser.parse_args()
+
+def percentile(sorted_values, fraction):
+    # type: (Sequence[float], float) -> float
+    # nearest-rank percentile of a sorted non-empty sequence
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def get_stats(latencies, query_counts, total_time):
+    # type: (List[float], List[int], float) -> Dict[str, Any]
+    latencies = sorted(latencies)
+    stats = OrderedDict() # type: Dict[str, Any]
+    stats["requests"] = len(latencies)
+    stats["mean_ms"] = 1000 * sum(latencies) / len(latencies)
+    for name, fraction in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+        stats[name] = 1000 * percentile(latencies, fraction)
+    stats["max_ms"] = 1000 * latencies[-1]
+    stats["throughput"] = len(latencies) / total_time
+    stats["queries_mean"] = sum(query_counts) / len(query_counts)
+    stats["queries_max"] = max(query_counts)
+    return stats
+
+def compare(results, old_results, threshold):
+    # type: (Dict[str, Any], Dict[str, Any], float) -> List[str]
+    # Returns descriptions of the regressions in results relative to old_results
+    regressions = []
+    for endpoint, stats in results.items():
+        old_stats = old_results.get(endpoint)
+        if old_stats is None:
+            continue
+        if stats["p50_ms"] > old_stats["p50_ms"] * (1 + threshold):
+            regressions.append("{}: median latency {:.2f} ms -> {:.2f} ms".format(
+                endpoint, old_stats["p50_ms"], stats["p50_ms"]))
+        if stats["queries_max"] > old_stats["queries_max"]:
+            regressions.append("{}: queries per request {} -> {}".format(
+                endpoint, old_stats["queries_max"], stats["queries_max"]))
+    return regressions
+
+def print_table(results, old_results):
+    # type: (Dict[str, Any], Dict[str, Any]) -> None
+    columns = ["mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms", "throughput", "queries_max"]
+    print("{:<12}".format("endpoint") + "".join("{:>13}".format(column) for column in columns))
+    for endpoint, stats in results.items():
+        print("{:<12}".format(endpoint) + "".join("{:>13.2f}".format(stats[column]) for column in columns))
+        if endpoint in old_results:
+            old_stats = old_results[endpoint]
+            print("{:<12}".format("  (before)") + "".join("{:>13.2f}".format(old_stats[column]) for column in columns))
+
+# set up django
+print("Setting up Django", file=sys.stderr)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project_conf.settings")
+import django
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.http import HttpResponse
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment, CaptureQueriesContext
+
+from main.models import Question, Option, Choice
+from lib.models import rebuild_vote_counts
+from lib.populate import import_questions
+
+PASSWORD = "benchmark_password"
+
+def generate_data(rand):
+    # type: (random.Random) -> None
+    qdicts = []
+    for i in range(args.questions):
+        qdicts.append({
+            "title": "Question {}".format(i),
+            "text": "Which of these options do you like? ({})".format(i),
+            "multivote": i % 2 == 0,
+            "locked": False,
+            "show_count": i % 3 != 0,
+            "options": ["Option {}.{}".format(i, j) for j in range(args.options)],
+        })
+    import_questions(qdicts)
+
+    password_hash = make_password(PASSWORD)
+    User.objects.bulk_create([User(username="user{}".format(i), password=password_hash) for i in range(args.users)])
+
+    oids_by_question = {} # type: Dict[int, List[int]]
+    for oid, qid in Option.objects.values_list('id', 'question_id'):
+        oids_by_question.setdefault(qid, []).append(oid)
+    multivote_qids = set(Question.objects.filter(multivote=True).values_list('id', flat=True))
+    choices = []
+    for user_id in User.objects.values_list('id', flat=True):
+        for qid in rand.sample(sorted(oids_by_question), min(args.votes, len(oids_by_question))):
+            num_chosen = rand.randint(1, len(oids_by_question[qid])) if qid in multivote_qids else 1
+            for oid in rand.sample(oids_by_question[qid], num_chosen):
+                choices.append(Choice(user_id=user_id, option_id=oid, question_id=qid))
+    Choice.objects.bulk_create(choices)
+    rebuild_vote_counts()
+
+def make_request_funcs(rand):
+    # type: (random.Random) -> Dict[str, Callable[[], HttpResponse]]
+    anon_client = Client()
+    user_client = Client()
+    user_client.force_login(User.objects.get(username="user0"))
+    oids_by_question = {} # type: Dict[int, List[int]]
+    for oid, qid in Option.objects.values_list('id', 'question_id'):
+        oids_by_question.setdefault(qid, []).append(oid)
+    qids = sorted(oids_by_question)
+    counter = [0]
+
+    def vote():
+        # type: () -> HttpResponse
+        oids = oids_by_question[rand.choice(qids)]
+        choose_oids = rand.sample(oids, 1)
+        unchoose_oids = [oid for oid in oids if oid not in choose_oids and rand.random() < 0.5]
+        data = json.dumps({"choose": choose_oids, "unchoose": unchoose_oids})
+        return user_client.post(reverse('api:vote'), data, content_type="application/json")
+
+    def login():
+        # type: () -> HttpResponse
+        username = "user{}".format(rand.randrange(args.users))
+        return Client().post(reverse('api:login'), {"username": username, "password": PASSWORD})
+
+    def register():
+        # type: () -> HttpResponse
+        counter[0] += 1
+        username = "newuser{}".format(counter[0])
+        return anon_client.post(reverse('api:register'), {"username": username, "password": PASSWORD})
+
+    return {
+        "index": lambda: anon_client.get(reverse('api:index')),
+        "questions": lambda: anon_client.get(reverse('api:questions')),
+        "options": lambda: anon_client.get(reverse('api:options')),
+        "my_choices": lambda: user_client.get(reverse('api:my_choices')),
+        "vote": vote,
+        "login": login,
+        "register": register,
+    }
+
+def run_endpoint(request_func, expected_status=200):
+    # type: (Callable[[], HttpResponse], int) -> Dict[str, Any]
+    latencies = [] # type: List[float]
+    query_counts = [] # type: List[int]
+    start_time = default_timer()
+    for i in range(args.requests):
+        with CaptureQueriesContext(connection) as queries:
+            request_start = default_timer()
+            response = request_func()
+            if response.streaming:
+                b"".join(response.streaming_content)
+            latencies.append(default_timer() - request_start)
+        if response.status_code != expected_status:
+            raise Exception("{} returned status {}".format(request_func, response.status_code))
+        query_counts.append(len(queries))
+    return get_stats(latencies, query_counts, default_timer() - start_time)
+
+def main():
+    # type: () -> int
+    rand = random.Random(args.seed)
+    if args.no_cache:
+        settings.API_CACHE = None
+    vote_queue = settings.VOTE_QUEUE is not None
+    queue_dir = None
+    if vote_queue:
+        # ballots for the test database mustn't end up in the real queue
+        queue_dir = tempfile.mkdtemp()
+        settings.VOTE_QUEUE = os.path.join(queue_dir, 'queue.sqlite3')
+    setup_test_environment()
+    old_db_name = connection.creation.create_test_db(verbosity=0, serialize=False)
+    try:
+        print("Generating data", file=sys.stderr)
+        generate_data(rand)
+        if settings.API_CACHE is not None:
+            caches[settings.API_CACHE].clear()
+        request_funcs = make_request_funcs(rand)
+        results = OrderedDict() # type: Dict[str, Any]
+        for endpoint in args.endpoints:
+            print("Benchmarking " + endpoint, file=sys.stderr)
+            expected_status = 202 if endpoint == "vote" and vote_queue else 200
+            results[endpoint] = run_endpoint(request_funcs[endpoint], expected_status)
+    finally:
+        connection.creation.destroy_test_db(old_db_name, verbosity=0)
+        teardown_test_environment()
+        if queue_dir is not None:
+            shutil.rmtree(queue_dir)
+
+    config = OrderedDict((key, getattr(args, key)) for key in
+        ("questions", "options", "users", "votes", "requests", "no_cache", "seed"))
+    config["vote_queue"] = vote_queue
+    environment = OrderedDict([
+        ("python", platform.python_version()),
+        ("django", django.get_version()),
+        ("database", connection.vendor),
+    ])
+    report = OrderedDict([("config", config), ("environment", environment), ("results", results)])
+    if args.output:
+        with open(args.output, 'w') as fobj:
+            json.dump(report, fobj, indent=2)
+
+    old_results = {} # type: Dict[str, Any]
+    if args.compare:
+        with open(args.compare) as fobj:
+            old_report = json.load(fobj)
+        old_results = old_report["results"]
+        if old_report["config"] != config:
+            print("Warning: the compared run used a different configuration", file=sys.stderr)
+    print_table(results, old_results)
+
+    regressions = compare(results, old_results, args.threshold)
+    for regression in regressions:
+        print("Regression in " + regression)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
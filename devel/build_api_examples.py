@@ -30,11 +30,12 @@ from lib.response import get_response_str
 
 TEST_DATA_FILE = os.path.join(BASE_DIR, "lib", "test_data.json")
 
-endpoint_list = ["register", "login", "index", "questions", "options", "vote", "my_choices"]
+endpoint_list = ["register", "login", "index", "questions", "options", "vote", "my_choices", "tokens", "revoke_tokens"]
 
 context_dict = OrderedDict() # type: Dict[str, text_type]
 for x in endpoint_list:
     context_dict["url_" + x] = reverse('api:' + x)
+context_dict["url_question_results"] = reverse('api:question_results', args=[Option.objects.get(text=u"Linux").question_id])
 
 SITE_URL = u'http://localhost:8000'
 
@@ -63,6 +64,8 @@ choose(user, linux)
 
 context_dict["option_ids"] = text_type([vim.id, atom.id, linux.id])
 
+context_dict['output_question_results'] = get_response_str(client.get(context_dict["url_question_results"]))
+
 response = client.get('/api/my-choices/')
 assert(response.status_code == 200)
 context_dict['output_my_choices'] = get_response_str(response)
@@ -14,6 +14,8 @@ import argparse
 
 parser = argparse.ArgumentParser()
 parser.add_argument('source', help="JSON file to load data from")
+parser.add_argument('--upsert', action='store_true', default=False,
+    help="Update questions which already exist (matched by title, or by text if they have no title) instead of deleting all questions first")
 args = parser.parse_args()
 
 if __name__=="__main__":
@@ -26,6 +28,8 @@ if __name__=="__main__":
 from main.models import Question, Option
 from lib.populate import add_qfile
 
-Question.objects.all().delete()
-Option.objects.all().delete()
-add_qfile(args.source)
+if not args.upsert:
+    Question.objects.all().delete()
+    Option.objects.all().delete()
+num_questions, num_options = add_qfile(args.source, upsert=args.upsert)
+print("Added {} questions and {} options".format(num_questions, num_options))
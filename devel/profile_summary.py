@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Summarizes the profiles written by lib.profiling.ProfilingMiddleware.
+
+The .prof files in a directory are grouped by the view in their metadata. For every view,
+the number of profiled requests, their duration and the functions which took the most
+time in all of them together are printed.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import os
+import pstats
+import sys
+from collections import OrderedDict
+
+from typing import Any, Dict, List
+
+PROFILE_EXT = '.prof'
+META_EXT = '.json'
+
+parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+parser.add_argument('directory', help="Directory of the profiles (settings.PROFILE_DIR)")
+parser.add_argument('--view', action='append', dest='views',
+                    help="Only summarize the profiles of this view (like api:vote). Can be given more than once.")
+parser.add_argument('--sort', default='cumulative', choices=['cumulative', 'tottime', 'calls'],
+                    help="Order of the functions (default: cumulative)")
+parser.add_argument('--limit', type=int, default=20, help="Number of functions shown per view")
+
+def load_profiles(directory):
+    # type: (str) -> Dict[str, List[Dict[str, Any]]]
+    # Returns the metadata of the profiles in directory by view name, with the path of the profile under 'path'
+    profiles = {} # type: Dict[str, List[Dict[str, Any]]]
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(PROFILE_EXT):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path[:-len(PROFILE_EXT)] + META_EXT) as fobj:
+                metadata = json.load(fobj)
+        except (IOError, ValueError):
+            metadata = {'view_name': '(unknown)'}
+        metadata['path'] = path
+        profiles.setdefault(metadata['view_name'], []).append(metadata)
+    return OrderedDict((view_name, profiles[view_name]) for view_name in sorted(profiles))
+
+def main():
+    # type: () -> int
+    args = parser.parse_args()
+    profiles = load_profiles(args.directory)
+    if args.views:
+        profiles = OrderedDict((view_name, profiles[view_name]) for view_name in args.views if view_name in profiles)
+    if not profiles:
+        print("No profiles found", file=sys.stderr)
+        return 1
+    for view_name, metadata_list in profiles.items():
+        durations = sorted(metadata['duration'] for metadata in metadata_list if 'duration' in metadata)
+        print("=" * 72)
+        print("{}: {} requests".format(view_name, len(metadata_list)))
+        if durations:
+            print("duration: mean {:.2f} ms, median {:.2f} ms, max {:.2f} ms".format(
+                1000 * sum(durations) / len(durations), 1000 * durations[len(durations) // 2], 1000 * durations[-1]))
+        stats = pstats.Stats(*[metadata['path'] for metadata in metadata_list], stream=sys.stdout)
+        stats.strip_dirs().sort_stats(args.sort).print_stats(args.limit)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,199 @@
 from __future__ import unicode_literals
 
-from main.models import Option, Choice
+from collections import Counter
+from django.db import transaction, IntegrityError
+from django.db.models import Count, F
+from django.db.models.signals import pre_delete, post_delete
+from django.dispatch import receiver
+
+from main.models import Question, Option, Choice
 from django.contrib.auth.models import User
-from typing import Optional
+from lib.option_meta import OptionMeta, get_options_meta
+from lib.signals import votes_changed, questions_updated
+from lib.sqlite import retry_on_locked
+from lib.tally import get_tally, reserve_fence
+
+import six
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Set
+from lib.id_types import QuestionId, OptionId
+
+def apply_vote_deltas(user, deltas):
+    # type: (User, Mapping[OptionId, int]) -> None
+    # Adds deltas to the stored vote counts of options and notifies listeners of votes_changed
+    oids_by_delta = {} # type: Dict[int, List[OptionId]]
+    for oid, delta in six.iteritems(deltas):
+        if delta:
+            oids_by_delta.setdefault(delta, []).append(oid)
+    if not oids_by_delta:
+        return
+    for delta, oids in six.iteritems(oids_by_delta):
+        Option.objects.filter(id__in=oids).update(num_votes=F('num_votes') + delta)
+    tally = get_tally()
+    if tally is not None:
+        # the fence is reserved in this transaction, so it is above the fence of any rebuild which
+        # doesn't include these votes (see lib.tally)
+        fence = reserve_fence(tally)
+        # registered before votes_changed is sent, so the tally is updated before the data versions are bumped on commit
+        tally_deltas = {oid: delta for oid, delta in six.iteritems(deltas) if delta}
+        transaction.on_commit(lambda: tally.add(tally_deltas, fence))
+    votes_changed.send(sender=Choice, user=user, deltas=deltas)
+
+@receiver(pre_delete, sender=User, dispatch_uid='actions_user_deleting')
+def user_deleting(sender, instance, **kwargs):
+    # type: (Any, User, **Any) -> None
+    # The user's choices are deleted by a cascade, which doesn't update vote counts,
+    # so remember them until the user has been deleted
+    rows = Choice.objects.filter(user=instance).values_list('option_id').annotate(count=Count('id')).order_by()
+    instance._vote_deltas = {oid: -count for oid, count in rows}
+
+@receiver(post_delete, sender=User, dispatch_uid='actions_user_deleted')
+def user_deleted(sender, instance, **kwargs):
+    # type: (Any, User, **Any) -> None
+    deltas = getattr(instance, '_vote_deltas', None)
+    if deltas:
+        apply_vote_deltas(instance, deltas)
+
+# Maximum number of ids in a query, which stays below SQLite's limit on the number of parameters
+UPDATE_CHUNK_SIZE = 500
+
+@retry_on_locked
+def update_questions(qids, **values):
+    # type: (Sequence[QuestionId], **Any) -> None
+    # Sets fields of many questions without saving them one by one and notifies listeners of questions_updated
+    qids = list(qids)
+    if not qids:
+        return
+    with transaction.atomic():
+        for i in range(0, len(qids), UPDATE_CHUNK_SIZE):
+            Question.objects.filter(id__in=qids[i:i + UPDATE_CHUNK_SIZE]).update(**values)
+        questions_updated.send(sender=Question, question_ids=qids, values=values)
 
+def get_option_meta(option):
+    # type: (Option) -> OptionMeta
+    meta = get_options_meta([option.id]).get(option.id)
+    if meta is None:
+        raise Option.DoesNotExist("option {} does not exist".format(option.id))
+    return meta
+
+def lock_user(user):
+    # type: (User) -> None
+    # Makes concurrent votes of user wait until the current transaction ends, on databases with
+    # row locks. SQLite has a single writer, and retry_on_locked reruns transactions which lose.
+    list(User.objects.select_for_update().filter(id=user.id).values_list('id', flat=True))
+
+def delete_choices(choices):
+    # type: (Any) -> List[OptionId]
+    # Deletes the Choice rows in the queryset choices and returns the option ids of those which were deleted.
+    # The rows are locked when they are read, so a concurrent delete can't make them be counted twice.
+    rows = list(choices.select_for_update().values_list('id', 'option_id'))
+    if rows:
+        Choice.objects.filter(id__in=[choice_id for choice_id, oid in rows]).delete()
+    return [oid for choice_id, oid in rows]
+
+@retry_on_locked
 def choose(user, option):
     # type: (User, Option) -> Optional[bool]
-    # Returns None if polling is disabled, False if option is already chosen, and True otherwise
-    question = option.question
-    if question.locked:
+    # Returns None if polling is disabled, False if option is already chosen, and True otherwise.
+    # The cached metadata is only used for the flags, as its question id may be stale if the option was moved.
+    meta = get_option_meta(option)
+    if meta.locked:
         return None
 
-    option_choice, created = Choice.objects.get_or_create(user=user, option=option)
-    if created and not question.multivote:
-        # delete already chosen option
-        Choice.objects.filter(user=user, option__question=question).exclude(option=option).delete()
-    return created
+    with transaction.atomic():
+        lock_user(user)
+        try:
+            # the unique constraint on (user, option) rejects options which are already chosen
+            with transaction.atomic():
+                Choice.objects.create(user=user, option=option)
+        except IntegrityError:
+            return False
+        deltas = Counter({option.id: 1}) # type: Dict[OptionId, int]
+        if not meta.multivote:
+            # delete already chosen option
+            other_choices = Choice.objects.filter(user=user, question_id=option.question_id).exclude(option_id=option.id)
+            deltas.subtract(delete_choices(other_choices))
+        apply_vote_deltas(user, deltas)
+    return True
 
+@retry_on_locked
 def unchoose(user, option):
     # type: (User, Option) -> Optional[bool]
     # Returns None if polling is disabled, False if option is already not chosen, and True otherwise
-    question = option.question
-    if question.locked:
+    if get_option_meta(option).locked:
         return None
 
-    choice_qset = Choice.objects.filter(user=user, option=option)
-    exists = choice_qset.exists()
-    if exists:
-        choice_qset.delete()
-    return exists
+    with transaction.atomic():
+        num_deleted, _ = Choice.objects.filter(user=user, option=option).delete()
+        if num_deleted:
+            apply_vote_deltas(user, {option.id: -num_deleted})
+    return num_deleted > 0
+
+def get_ballot_result(chosen, options, qid_of, choose_oids, unchoose_oids):
+    # type: (Iterable[OptionId], Mapping[OptionId, OptionMeta], Mapping[OptionId, QuestionId], Iterable[OptionId], Iterable[OptionId]) -> Set[OptionId]
+    """
+    Returns the options which are chosen after applying a ballot to the chosen options,
+    with the same semantics as apply_ballot. options should be as in apply_ballot,
+    and qid_of should map every option id in chosen and in options to its question id.
+    """
+    result = set(chosen) # type: Set[OptionId]
+    choose_oids = [oid for oid in choose_oids if not options[oid].locked]
+    unchoose_oids = [oid for oid in unchoose_oids if not options[oid].locked]
+    for oid in choose_oids:
+        if oid not in result:
+            meta = options[oid]
+            if not meta.multivote:
+                # delete already chosen option
+                result = set(x for x in result if qid_of[x] != meta.question_id)
+            result.add(oid)
+    result.difference_update(unchoose_oids)
+    return result
+
+@retry_on_locked
+def apply_ballot(user, options, choose_oids, unchoose_oids):
+    # type: (User, Mapping[OptionId, OptionMeta], Iterable[OptionId], Iterable[OptionId]) -> None
+    """
+    Has the same effect as calling choose for every option in choose_oids and then
+    unchoose for every option in unchoose_oids, but uses a fixed number of queries.
+    options should map every option id in choose_oids and unchoose_oids to its
+    metadata (see lib.option_meta.get_options_meta).
+    """
+    choose_oids = list(choose_oids)
+    unchoose_oids = list(unchoose_oids)
+    qids = set(options[oid].question_id for oid in choose_oids + unchoose_oids if not options[oid].locked)
+    if not qids:
+        return
+
+    with transaction.atomic():
+        lock_user(user)
+        # the rows are locked, so those which are deleted below are exactly the ones read here
+        old_choices = Choice.objects.filter(user=user, question_id__in=qids).select_for_update()
+        old_rows = list(old_choices.values_list('option_id', 'question_id'))
+        old_oids = [oid for oid, qid in old_rows]
+        qid_of = dict(old_rows) # type: Dict[OptionId, QuestionId]
+        for oid, meta in six.iteritems(options):
+            qid_of[oid] = meta.question_id
+
+        chosen = get_ballot_result(old_oids, options, qid_of, choose_oids, unchoose_oids)
+        added_oids = chosen.difference(old_oids)
+        removed_oids = set(old_oids).difference(chosen)
 
+        deltas = Counter() # type: Dict[OptionId, int]
+        if removed_oids:
+            Choice.objects.filter(user=user, option_id__in=removed_oids).delete()
+            deltas.subtract(oid for oid in old_oids if oid in removed_oids)
+        if added_oids:
+            new_choices = [Choice(user=user, option_id=oid, question_id=qid_of[oid]) for oid in added_oids]
+            try:
+                with transaction.atomic():
+                    Choice.objects.bulk_create(new_choices)
+                deltas.update(added_oids)
+            except IntegrityError:
+                # some options were chosen by a writer which doesn't lock the user, so add the others one by one
+                for choice in new_choices:
+                    try:
+                        with transaction.atomic():
+                            choice.save()
+                        deltas.update([choice.option_id])
+                    except IntegrityError:
+                        pass
+        apply_vote_deltas(user, deltas)
@@ -0,0 +1,59 @@
+"""
+Authentication backend which caches users looked up from sessions.
+
+With django's ModelBackend, every request authenticated by a session fetches the
+user from the database. CachedModelBackend keeps users in the cache named by
+settings.USER_CACHE instead. Cached users are removed when they are saved or deleted,
+so changes made with QuerySet.update() or raw SQL only take effect after
+settings.USER_CACHE_TIMEOUT seconds, unless the cached user is removed with
+forget_cached_user.
+"""
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from six import text_type
+from typing import Any, Optional
+
+def get_user_cache():
+    # type: () -> Optional[BaseCache]
+    if settings.USER_CACHE is None:
+        return None
+    return caches[settings.USER_CACHE]
+
+def user_cache_key(user_id):
+    # type: (Any) -> text_type
+    return 'user:{}'.format(user_id)
+
+def forget_cached_user(user_id):
+    # type: (Any) -> None
+    cache = get_user_cache()
+    if cache is not None:
+        cache.delete(user_cache_key(user_id))
+
+class CachedModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        # type: (Any) -> Optional[User]
+        cache = get_user_cache()
+        if cache is None:
+            return super(CachedModelBackend, self).get_user(user_id)
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super(CachedModelBackend, self).get_user(user_id)
+            if user is not None:
+                cache.set(key, user, timeout=settings.USER_CACHE_TIMEOUT)
+        return user
+
+@receiver(post_save, sender=User, dispatch_uid='auth_user_saved')
+@receiver(post_delete, sender=User, dispatch_uid='auth_user_deleted')
+def user_changed(sender, instance, **kwargs):
+    # type: (Any, User, **Any) -> None
+    forget_cached_user(instance.id)
@@ -0,0 +1,188 @@
+"""
+Caching of the JSON sent by the read-only API endpoints.
+
+Every kind of data (questions, options, votes and the choices of each user) has a
+version number which is stored in the cache and is incremented whenever that data changes.
+A payload is cached under a key made of the versions of all the data it depends on,
+so a change only invalidates the payloads which depend on the changed data.
+The same versions are used as ETags, so conditional requests can be answered
+without building the payload.
+
+Versions are only seen by all processes if API_CACHE is shared by them (like memcached).
+A local-memory cache is private to each process, which would keep serving its own payloads
+and 304s after another process changed the data. So in a local-memory cache, versions
+expire after settings.API_LOCAL_VERSION_TIMEOUT seconds and start again from the current
+time, which bounds how long such a change goes unnoticed.
+"""
+
+from __future__ import unicode_literals
+
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import HttpRequest, HttpResponse
+
+from django.contrib.auth.models import User
+from main.models import Question, Option
+from lib.replicas import read_from_primary
+from lib.response import json_response, streaming_json_response
+from lib.signals import votes_changed, questions_updated
+
+import six
+from six import text_type
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+QUESTIONS = 'questions'
+OPTIONS = 'options'
+VOTES = 'votes'
+
+PAYLOAD_DEPENDENCIES = {
+    'index': (QUESTIONS, OPTIONS),
+    'questions': (QUESTIONS,),
+    'options': (QUESTIONS, OPTIONS, VOTES),
+    'results': (QUESTIONS, OPTIONS, VOTES),
+} # type: Dict[text_type, Tuple[text_type, ...]]
+
+def get_api_cache():
+    # type: () -> Optional[BaseCache]
+    if settings.API_CACHE is None:
+        return None
+    return caches[settings.API_CACHE]
+
+def version_key(name):
+    # type: (text_type) -> text_type
+    return 'data_version:' + name
+
+def user_choices_name(user_id):
+    # type: (int) -> text_type
+    return 'user_choices:{}'.format(user_id)
+
+def version_timeout(cache):
+    # type: (BaseCache) -> Optional[int]
+    if isinstance(cache, LocMemCache):
+        return settings.API_LOCAL_VERSION_TIMEOUT
+    return None
+
+def initial_version():
+    # type: () -> int
+    # Versions start from the current time so that a version which has been evicted
+    # from the cache does not start over from a number which has already been used.
+    return int(time.time() * 1000)
+
+def get_data_versions(names):
+    # type: (Iterable[text_type]) -> Dict[text_type, int]
+    cache = get_api_cache()
+    if cache is None:
+        return {}
+    keys = {version_key(name): name for name in names}
+    found = cache.get_many(list(keys))
+    versions = {} # type: Dict[text_type, int]
+    for key, name in six.iteritems(keys):
+        if key not in found:
+            cache.add(key, initial_version(), timeout=version_timeout(cache))
+            found[key] = cache.get(key)
+        versions[name] = found[key]
+    return versions
+
+def _incr_data_versions(names):
+    # type: (Iterable[text_type]) -> None
+    cache = get_api_cache()
+    if cache is None:
+        return
+    for name in names:
+        key = version_key(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, initial_version(), timeout=version_timeout(cache))
+
+def bump_data_versions(*names):
+    # type: (*text_type) -> None
+    _incr_data_versions(names)
+    # A request running concurrently with the current transaction could cache data
+    # read before the transaction committed under the new version, so bump again on commit.
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _incr_data_versions(names))
+
+def get_versions_str(names):
+    # type: (Sequence[text_type]) -> Optional[text_type]
+    versions = get_data_versions(names)
+    if not versions:
+        return None
+    return '-'.join(text_type(versions[name]) for name in names)
+
+def get_payload_version(payload_name):
+    # type: (text_type) -> Optional[text_type]
+    return get_versions_str(PAYLOAD_DEPENDENCIES[payload_name])
+
+def payload_etag_func(payload_name):
+    # type: (text_type) -> Callable[..., Optional[text_type]]
+    # Returns a function which can be passed as etag_func to django's condition decorator
+    def etag_func(request, *args, **kwargs):
+        # type: (HttpRequest, *Any, **Any) -> Optional[text_type]
+        version = get_payload_version(payload_name)
+        if version is None:
+            return None
+        return '{}-{}'.format(payload_name, version)
+    return etag_func
+
+def user_choices_dependencies(request):
+    # type: (HttpRequest) -> Tuple[text_type, ...]
+    # choices of a user also change when options are deleted, and with a vote queue,
+    # when questions are locked, since queued ballots for them are then dropped
+    if settings.VOTE_QUEUE is not None:
+        return (QUESTIONS, OPTIONS, user_choices_name(request.user.id))
+    return (OPTIONS, user_choices_name(request.user.id))
+
+def user_choices_etag(request, *args, **kwargs):
+    # type: (HttpRequest, *Any, **Any) -> Optional[text_type]
+    version = get_versions_str(user_choices_dependencies(request))
+    if version is None:
+        return None
+    return 'choices-{}-{}'.format(request.user.id, version)
+
+def cached_json_response(payload_name, data_func):
+    # type: (text_type, Callable[[], Any]) -> HttpResponse
+    """
+    Returns a JSON response of data_func(). The encoded JSON is cached
+    under the versions of the data payload_name depends on.
+    If settings.STREAM_JSON_RESPONSES is True, the response is streamed instead.
+    """
+    if settings.STREAM_JSON_RESPONSES:
+        # a streamed response is never held in memory in full, so it can't be cached
+        return streaming_json_response(data_func())
+    cache = get_api_cache()
+    if cache is None:
+        return json_response(data_func())
+    key = 'payload:{}:{}'.format(payload_name, get_payload_version(payload_name))
+    content = cache.get(key)
+    if content is None:
+        # the payload is kept until the data changes again, so it mustn't come from a lagging replica
+        with read_from_primary():
+            response = json_response(data_func())
+        cache.set(key, response.content, timeout=settings.API_CACHE_TIMEOUT)
+        return response
+    return HttpResponse(content, content_type="application/json")
+
+@receiver(post_save, sender=Question, dispatch_uid='cache_question_changed')
+@receiver(post_delete, sender=Question, dispatch_uid='cache_question_deleted')
+@receiver(questions_updated, dispatch_uid='cache_questions_updated')
+def question_changed(sender, **kwargs):
+    # type: (Any, **Any) -> None
+    bump_data_versions(QUESTIONS)
+
+@receiver(post_save, sender=Option, dispatch_uid='cache_option_changed')
+@receiver(post_delete, sender=Option, dispatch_uid='cache_option_deleted')
+def option_changed(sender, **kwargs):
+    # type: (Any, **Any) -> None
+    bump_data_versions(OPTIONS)
+
+@receiver(votes_changed, dispatch_uid='cache_votes_changed')
+def votes_changed_handler(sender, user, **kwargs):
+    # type: (Any, User, **Any) -> None
+    bump_data_versions(VOTES, user_choices_name(user.id))
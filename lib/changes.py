@@ -0,0 +1,158 @@
+"""
+Log of changes to questions, options and vote counts, from which /api/changes/ tells
+clients what has changed since the version they last saw.
+
+The log holds one main.models.Change row for each question and option: a change deletes
+the previous row of its object and inserts a new one, whose autoincremented id is the new
+version. The log therefore grows with the number of objects rather than with the number of
+votes, and logging a vote only touches the rows of its options, which are already locked by
+the update of their counts. Rows of deleted objects are removed by prune_changes after
+settings.CHANGE_LOG_RETENTION_DAYS, which happens automatically when objects are deleted.
+
+Ids are given out when rows are inserted, so a transaction can commit a change with a lower
+version after a client has seen a higher one. The version returned to clients is therefore
+that of the last change made more than settings.CHANGE_LOG_COMMIT_MARGIN seconds ago, and
+later changes are sent again in the next response. A change is only missed if its transaction
+commits more than that long after logging it.
+Changes made with QuerySet.update(), bulk_create() or raw SQL are not logged automatically,
+so call record_changes after making them.
+"""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from main.models import Question, Option, Change, PrunedVersion
+from lib.models import iter_questions_data, iter_options_data
+from lib.signals import votes_changed, questions_updated
+
+import six
+from six import text_type
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+from lib.id_types import OptionId
+
+# Maximum number of ids in a query, which stays below SQLite's limit on the number of parameters
+QUERY_CHUNK_SIZE = 500
+
+PRUNED_VERSION_ID = 1
+
+def record_changes(kind, object_ids, deleted=False):
+    # type: (text_type, Iterable[int], bool) -> None
+    # sorted, so that concurrent transactions lock the rows of the same objects in the same order
+    object_ids = sorted(set(object_ids))
+    if not object_ids:
+        return
+    with transaction.atomic(savepoint=False):
+        for i in range(0, len(object_ids), QUERY_CHUNK_SIZE):
+            Change.objects.filter(kind=kind, object_id__in=object_ids[i:i + QUERY_CHUNK_SIZE]).delete()
+        Change.objects.bulk_create([Change(kind=kind, object_id=object_id, deleted=deleted) for object_id in object_ids])
+        if deleted:
+            prune_changes(settings.CHANGE_LOG_RETENTION_DAYS)
+
+def record_question_changes(qids):
+    # type: (Iterable[int]) -> None
+    # Records changes to questions and all their options. Use this after changing
+    # questions with QuerySet.update(), since changes to show_count change the visible counts.
+    qids = list(qids)
+    record_changes(Change.QUESTION, qids)
+    for i in range(0, len(qids), QUERY_CHUNK_SIZE):
+        qid_chunk = qids[i:i + QUERY_CHUNK_SIZE]
+        record_changes(Change.OPTION, Option.objects.filter(question_id__in=qid_chunk).values_list('id', flat=True))
+
+def get_pruned_version():
+    # type: () -> int
+    return PrunedVersion.objects.filter(id=PRUNED_VERSION_ID).values_list('version', flat=True).first() or 0
+
+def get_version_range():
+    # type: () -> Tuple[int, int]
+    # Returns the version up to which changes have been pruned and the version of the last change
+    # which is old enough that all the changes before it have been committed
+    pruned_version = get_pruned_version()
+    settled = timezone.now() - timedelta(seconds=settings.CHANGE_LOG_COMMIT_MARGIN)
+    version = Change.objects.filter(created__lt=settled).aggregate(Max('id'))['id__max'] or 0
+    return (pruned_version, max(pruned_version, version))
+
+def prune_changes(days):
+    # type: (float) -> int
+    # Deletes the changes of deleted objects which are older than days and returns their number
+    changes = Change.objects.filter(deleted=True, created__lt=timezone.now() - timedelta(days=days))
+    # the last change is kept, since MySQL may reuse the ids of deleted rows at the end of a table
+    last_version = Change.objects.aggregate(Max('id'))['id__max']
+    pruned_version = changes.exclude(id=last_version).aggregate(Max('id'))['id__max']
+    if pruned_version is None:
+        return 0
+    with transaction.atomic(savepoint=False):
+        num_deleted = changes.filter(id__lte=pruned_version).delete()[0]
+        if not PrunedVersion.objects.filter(id=PRUNED_VERSION_ID, version__lt=pruned_version).update(version=pruned_version):
+            # the row is missing, for example because the table has been flushed, or the version is already higher
+            PrunedVersion.objects.get_or_create(id=PRUNED_VERSION_ID, defaults={'version': pruned_version})
+    return num_deleted
+
+def get_changes_since(since):
+    # type: (int) -> Optional[Dict[text_type, Any]]
+    """
+    Returns the current data of the questions and options which have changed after version since,
+    the ids of those which have been deleted and the version to pass as since next time.
+    Returns None if since is unknown, in which case the client has to fetch all the data again.
+    """
+    pruned_version, version = get_version_range()
+    last_version = Change.objects.aggregate(Max('id'))['id__max'] or 0
+    if since < pruned_version or since > max(pruned_version, last_version):
+        return None
+    changes = Change.objects.filter(id__gt=since)
+    changed_qids = changes.filter(kind=Change.QUESTION).values('object_id')
+    changed_oids = changes.filter(kind=Change.OPTION).values('object_id')
+    deleted = {Change.QUESTION: [], Change.OPTION: []} # type: Dict[text_type, List[int]]
+    for kind, object_id in changes.filter(deleted=True).order_by('id').values_list('kind', 'object_id'):
+        deleted[kind].append(object_id)
+    data = OrderedDict() # type: Dict[text_type, Any]
+    # the changes since the returned version are sent again, in case some before them weren't committed yet
+    data['version'] = max(since, version)
+    data['questions'] = OrderedDict(iter_questions_data(changed_qids))
+    data['options'] = OrderedDict(iter_options_data(changed_oids))
+    data['deleted'] = OrderedDict([('questions', deleted[Change.QUESTION]), ('options', deleted[Change.OPTION])])
+    return data
+
+@receiver(post_save, sender=Question, dispatch_uid='changes_question_saved')
+def question_saved(sender, instance, created, **kwargs):
+    # type: (Any, Question, bool, **Any) -> None
+    if created:
+        record_changes(Change.QUESTION, [instance.id])
+    else:
+        record_question_changes([instance.id])
+
+@receiver(post_delete, sender=Question, dispatch_uid='changes_question_deleted')
+def question_deleted(sender, instance, **kwargs):
+    # type: (Any, Question, **Any) -> None
+    record_changes(Change.QUESTION, [instance.id], deleted=True)
+
+@receiver(post_save, sender=Option, dispatch_uid='changes_option_saved')
+def option_saved(sender, instance, **kwargs):
+    # type: (Any, Option, **Any) -> None
+    record_changes(Change.OPTION, [instance.id])
+
+@receiver(post_delete, sender=Option, dispatch_uid='changes_option_deleted')
+def option_deleted(sender, instance, **kwargs):
+    # type: (Any, Option, **Any) -> None
+    record_changes(Change.OPTION, [instance.id], deleted=True)
+
+@receiver(votes_changed, dispatch_uid='changes_votes_changed')
+def votes_changed_handler(sender, deltas, **kwargs):
+    # type: (Any, Mapping[OptionId, int], **Any) -> None
+    record_changes(Change.OPTION, [oid for oid, delta in six.iteritems(deltas) if delta])
+
+@receiver(questions_updated, dispatch_uid='changes_questions_updated')
+def questions_updated_handler(sender, question_ids, values, **kwargs):
+    # type: (Any, Sequence[int], Mapping[text_type, Any], **Any) -> None
+    if 'show_count' in values:
+        # the counts of the options are shown or hidden
+        record_question_changes(question_ids)
+    else:
+        record_changes(Change.QUESTION, question_ids)
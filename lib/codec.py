@@ -0,0 +1,138 @@
+"""
+JSON codecs used to parse request bodies and encode API responses.
+
+A codec parses JSON from bytes and encodes objects to UTF-8 encoded JSON. Its make_encoder
+method returns a JSONEncoder which formats JSON the same way, for lib.response.iter_json.
+settings.JSON_CODEC is the dotted path of the codec class to use, and None means StdlibCodec.
+OrjsonCodec is only used if it is configured, so installing orjson doesn't change the bytes
+of responses (and so their ETags). Both codecs accept the same documents, raise the same
+errors and produce JSON which decodes to the same values, although the bytes may differ
+in whitespace and in the escaping of non-ASCII characters.
+"""
+
+from __future__ import unicode_literals
+
+import json
+from collections import OrderedDict
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+from lib.exceptions import BadDataError
+
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+try:
+    import orjson # type: ignore
+except ImportError:
+    orjson = None
+
+class JSONArray(object):
+    # Lazily encoded JSON array of the values in iterable
+    def __init__(self, iterable):
+        # type: (Iterable[Any]) -> None
+        self.iterable = iterable
+
+    def __iter__(self):
+        # type: () -> Iterator[Any]
+        return iter(self.iterable)
+
+class JSONObject(object):
+    # Lazily encoded JSON object of the (key, value) pairs in iterable
+    def __init__(self, iterable):
+        # type: (Iterable[Tuple[Any, Any]]) -> None
+        self.iterable = iterable
+
+    def __iter__(self):
+        # type: () -> Iterator[Tuple[Any, Any]]
+        return iter(self.iterable)
+
+class JSONEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # type: (Any) -> Any
+        if isinstance(o, JSONArray):
+            return list(o)
+        elif isinstance(o, JSONObject):
+            return OrderedDict(o)
+        return super(JSONEncoder, self).default(o)
+
+class StdlibCodec(object):
+    # Codec which uses python's json module
+
+    def loads(self, data):
+        # type: (bytes) -> Any
+        try:
+            data_str = data.decode('utf-8')
+        except UnicodeDecodeError:
+            raise BadDataError("Could not decode data to text")
+        try:
+            return json.loads(data_str)
+        except ValueError:
+            raise BadDataError("Invalid JSON")
+
+    def dumps(self, obj, indent=None):
+        # type: (Any, Optional[int]) -> bytes
+        return json.dumps(obj, indent=indent, cls=JSONEncoder).encode('utf-8')
+
+    def make_encoder(self, indent=None):
+        # type: (Optional[int]) -> JSONEncoder
+        return JSONEncoder(indent=indent)
+
+class OrjsonCodec(object):
+    """
+    Codec which uses orjson. orjson is stricter than the json module (for example, it
+    rejects NaN and integers which don't fit in 64 bits) and only supports an indent of 2,
+    so anything it can't handle is passed on to StdlibCodec.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        if orjson is None:
+            raise ImportError("OrjsonCodec requires the orjson package")
+        self.fallback = StdlibCodec()
+        self.encoder = JSONEncoder()
+        # django's encoder formats datetimes differently from orjson, so leave them to it
+        self.options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def loads(self, data):
+        # type: (bytes) -> Any
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return self.fallback.loads(data)
+
+    def dumps(self, obj, indent=None):
+        # type: (Any, Optional[int]) -> bytes
+        if indent is None:
+            options = self.options
+        elif indent == 2:
+            options = self.options | orjson.OPT_INDENT_2
+        else:
+            return self.fallback.dumps(obj, indent)
+        try:
+            return orjson.dumps(obj, default=self.encoder.default, option=options)
+        except orjson.JSONEncodeError:
+            return self.fallback.dumps(obj, indent)
+
+    def make_encoder(self, indent=None):
+        # type: (Optional[int]) -> JSONEncoder
+        # orjson leaves out optional whitespace and doesn't escape non-ASCII characters
+        if indent is None:
+            separators = (',', ':')
+        elif indent == 2:
+            separators = (',', ': ')
+        else:
+            return self.fallback.make_encoder(indent)
+        return JSONEncoder(indent=indent, separators=separators, ensure_ascii=False)
+
+_codecs = {} # type: Dict[Optional[str], Any]
+
+def get_codec():
+    # type: () -> Any
+    path = settings.JSON_CODEC
+    if path not in _codecs:
+        if path is not None:
+            _codecs[path] = import_string(path)()
+        else:
+            _codecs[path] = StdlibCodec()
+    return _codecs[path]
@@ -0,0 +1,201 @@
+"""
+Publishing of live poll events, which are streamed to clients by the /api/stream/ endpoint.
+
+Events are published to a broker, which is chosen by the EVENT_BROKER setting.
+LocalBroker fans events out to subscribers in the same process.
+A broker which works across processes should provide the same methods as LocalBroker.
+"""
+
+from __future__ import unicode_literals
+
+import json
+import time
+import threading
+from collections import deque
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from main.models import Question, Option
+from lib.signals import votes_changed, questions_updated
+
+import six
+from six import text_type
+from typing import Any, Callable, Iterator, List, Mapping, Optional, Sequence, Tuple
+from lib.id_types import OptionId
+
+Event = Tuple[int, text_type, Any]
+
+class LocalBroker(object):
+    """
+    Keeps the last buffer_size events in memory, numbered from 1.
+    Subscribers only need to remember the id of the last event they have seen,
+    so an idle subscriber costs nothing apart from the thread waiting in wait().
+    """
+
+    def __init__(self, buffer_size=1000):
+        # type: (int) -> None
+        self.events = deque(maxlen=buffer_size) # type: deque
+        self.last_id = 0
+        self.num_subscribers = 0
+        self.condition = threading.Condition()
+
+    def subscribe(self):
+        # type: () -> None
+        with self.condition:
+            self.num_subscribers += 1
+
+    def unsubscribe(self):
+        # type: () -> None
+        with self.condition:
+            self.num_subscribers -= 1
+
+    def has_subscribers(self):
+        # type: () -> bool
+        # Events need not be published when this returns False, in which case skip should be called.
+        # Brokers which work across processes should always return True.
+        return self.num_subscribers > 0
+
+    def skip(self):
+        # type: () -> None
+        # Uses up an event id without publishing an event, so that subscribers which
+        # reconnect with an earlier id know that they have missed something.
+        with self.condition:
+            self.last_id += 1
+
+    def publish(self, event_type, data):
+        # type: (text_type, Any) -> int
+        with self.condition:
+            self.last_id += 1
+            self.events.append((self.last_id, event_type, data))
+            self.condition.notify_all()
+            return self.last_id
+
+    def last_event_id(self):
+        # type: () -> int
+        return self.last_id
+
+    def wait(self, last_event_id, timeout):
+        # type: (int, float) -> Tuple[int, List[Event]]
+        """
+        Waits at most timeout seconds for events after last_event_id.
+        Returns the id of the last event and the events after last_event_id which are
+        still available. Some events are missing if the buffer has overflowed or if
+        events were skipped.
+        """
+        with self.condition:
+            if self.last_id <= last_event_id:
+                self.condition.wait(timeout)
+            if self.last_id <= last_event_id:
+                return (self.last_id, [])
+            return (self.last_id, [event for event in self.events if event[0] > last_event_id])
+
+_broker = None # type: Any
+
+def get_broker():
+    # type: () -> Any
+    global _broker
+    if _broker is None:
+        _broker = import_string(settings.EVENT_BROKER)()
+    return _broker
+
+def publish_on_commit(event_type, data):
+    # type: (text_type, Any) -> None
+    # events are only published if the transaction which caused them succeeds
+    transaction.on_commit(lambda: get_broker().publish(event_type, data))
+
+def format_event(event_id, event_type, data):
+    # type: (Optional[int], text_type, Any) -> text_type
+    lines = []
+    if event_id is not None:
+        lines.append("id: {}".format(event_id))
+    lines.append("event: " + event_type)
+    lines.append("data: " + json.dumps(data))
+    return "\n".join(lines) + "\n\n"
+
+class EventStream(object):
+    """
+    Iterator over server-sent events after last_event_id.
+    A comment is sent if no event has been published for heartbeat_interval seconds,
+    so that dead connections get noticed. The stream ends after max_duration seconds;
+    clients then reconnect with the Last-Event-ID header.
+    The stream is subscribed to the broker from its creation until close() is called.
+    """
+
+    def __init__(self, last_event_id, heartbeat_interval, max_duration=None, timer=time.time):
+        # type: (int, float, Optional[float], Callable[[], float]) -> None
+        self.broker = get_broker()
+        self.broker.subscribe()
+        self.closed = False
+        self.events = self.generate(last_event_id, heartbeat_interval, max_duration, timer)
+
+    def generate(self, last_event_id, heartbeat_interval, max_duration, timer):
+        # type: (int, float, Optional[float], Callable[[], float]) -> Iterator[text_type]
+        end_time = None if max_duration is None else timer() + max_duration
+        while end_time is None or timer() < end_time:
+            broker_last_event_id = self.broker.last_event_id()
+            if last_event_id > broker_last_event_id:
+                # the client has seen ids of another broker (like one in another process or before
+                # a restart), so it should refetch the full data and continue from this broker's ids
+                yield format_event(broker_last_event_id, "resync", None)
+                last_event_id = broker_last_event_id
+            new_last_event_id, events = self.broker.wait(last_event_id, heartbeat_interval)
+            if len(events) < new_last_event_id - last_event_id:
+                # some events were missed, so the client should refetch the full data
+                yield format_event(None, "resync", None)
+            if not events:
+                yield ": keepalive\n\n"
+            for event_id, event_type, data in events:
+                yield format_event(event_id, event_type, data)
+            last_event_id = max(last_event_id, new_last_event_id)
+
+    def __iter__(self):
+        # type: () -> EventStream
+        return self
+
+    def __next__(self):
+        # type: () -> text_type
+        return next(self.events)
+    next = __next__
+
+    def close(self):
+        # type: () -> None
+        if not self.closed:
+            self.closed = True
+            self.broker.unsubscribe()
+
+@receiver(votes_changed, dispatch_uid='events_votes_changed')
+def publish_vote_counts(sender, deltas, **kwargs):
+    # type: (Any, Mapping[OptionId, int], **Any) -> None
+    broker = get_broker()
+    if not broker.has_subscribers():
+        broker.skip()
+        return
+    oids = [oid for oid, delta in six.iteritems(deltas) if delta]
+    visible = Option.objects.filter(id__in=oids, question__show_count=True).values_list('id', 'question_id')
+    for oid, qid in visible:
+        publish_on_commit("count", {"option": oid, "question": qid, "delta": deltas[oid]})
+
+@receiver(post_init, sender=Question, dispatch_uid='events_question_post_init')
+def remember_locked(sender, instance, **kwargs):
+    # type: (Any, Question, **Any) -> None
+    # The value loaded from the database, which saves a query when the question is saved.
+    # It isn't known for new questions or if locked was deferred.
+    instance._old_locked = instance.__dict__.get('locked') if instance.pk is not None else None
+
+@receiver(post_save, sender=Question, dispatch_uid='events_question_post_save')
+def publish_locked(sender, instance, **kwargs):
+    # type: (Any, Question, **Any) -> None
+    old_locked = getattr(instance, '_old_locked', None)
+    if old_locked is not None and old_locked != instance.locked:
+        publish_on_commit("locked", {"question": instance.id, "locked": instance.locked})
+    instance._old_locked = instance.locked
+
+@receiver(questions_updated, dispatch_uid='events_questions_updated')
+def publish_locked_bulk(sender, question_ids, values, **kwargs):
+    # type: (Any, Sequence[int], Mapping[text_type, Any], **Any) -> None
+    if 'locked' in values:
+        for qid in question_ids:
+            publish_on_commit("locked", {"question": qid, "locked": values['locked']})
@@ -0,0 +1,63 @@
+"""
+Export of all choices for analysis, used by /api/export/votes/ and 'manage.py export_votes'.
+
+Choices are read in chunks ordered by id, each chunk starting after the last id of the
+previous one, so every query is short and memory use does not depend on the number of choices.
+Choices made while an export is running may or may not be included.
+"""
+
+from __future__ import unicode_literals
+
+import json
+from collections import OrderedDict
+
+from main.models import Choice
+
+from six import text_type
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+
+# Number of choices read by each query
+EXPORT_CHUNK_SIZE = 10000
+
+FIELDS = ('id', 'user_id', 'option_id', 'question_id')
+
+FORMATS = ('csv', 'ndjson')
+CONTENT_TYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# (choice id, user id, option id, question id)
+ChoiceRow = Tuple[int, int, int, int]
+
+def iter_choice_rows(question_ids=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # type: (Optional[Sequence[int]], int) -> Iterator[ChoiceRow]
+    choices = Choice.objects.all()
+    if question_ids is not None:
+        choices = choices.filter(question_id__in=question_ids)
+    last_id = 0
+    while True:
+        rows = list(choices.filter(id__gt=last_id).order_by('id').values_list(*FIELDS)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+def iter_csv(rows):
+    # type: (Iterable[ChoiceRow]) -> Iterator[text_type]
+    yield ",".join(FIELDS) + "\n"
+    for row in rows:
+        yield "{},{},{},{}\n".format(*row)
+
+def iter_ndjson(rows):
+    # type: (Iterable[ChoiceRow]) -> Iterator[text_type]
+    for row in rows:
+        yield text_type(json.dumps(OrderedDict(zip(FIELDS, row)))) + "\n"
+
+def iter_export(export_format, question_ids=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # type: (text_type, Optional[Sequence[int]], int) -> Iterator[text_type]
+    # Yields the lines of an export of choices in export_format, which is one of FORMATS
+    rows = iter_choice_rows(question_ids, chunk_size)
+    if export_format == 'csv':
+        return iter_csv(rows)
+    elif export_format == 'ndjson':
+        return iter_ndjson(rows)
+    raise ValueError("unknown export format: " + export_format)
@@ -0,0 +1,61 @@
+from __future__ import unicode_literals
+
+import time
+import threading
+from collections import OrderedDict
+
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+class LRUCache(object):
+    """
+    A thread-safe in-process cache which holds at most maxsize items.
+    The least recently used item is evicted when the cache is full,
+    and items are discarded ttl seconds after they were set.
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.time):
+        # type: (int, float, Callable[[], float]) -> None
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.data = OrderedDict() # type: Dict[Hashable, Tuple[float, Any]]
+
+    def get(self, key, default=None):
+        # type: (Hashable, Any) -> Any
+        with self.lock:
+            item = self.data.pop(key, None)
+            if item is None:
+                return default
+            expiry, value = item
+            if expiry <= self.timer():
+                return default
+            self.data[key] = item
+            return value
+
+    def set(self, key, value):
+        # type: (Hashable, Any) -> None
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data.pop(key, None)
+            while len(self.data) >= self.maxsize:
+                self.data.popitem(last=False)
+            self.data[key] = (self.timer() + self.ttl, value)
+
+    def pop(self, key, default=None):
+        # type: (Hashable, Any) -> Any
+        with self.lock:
+            item = self.data.pop(key, None)
+        if item is None:
+            return default
+        return item[1]
+
+    def clear(self):
+        # type: () -> None
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        # type: () -> int
+        return len(self.data)
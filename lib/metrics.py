@@ -0,0 +1,192 @@
+"""
+Per-endpoint request metrics.
+
+MetricsMiddleware records, for every request to a view in main.api_urls, its latency
+and the number and total duration of the SQL queries it made. Queries are timed by a
+cursor wrapper, so this works when DEBUG is False. Metrics are kept in memory in each
+process and are served by the /api/metrics/ endpoint as JSON or in Prometheus' text format.
+"""
+
+from __future__ import unicode_literals
+
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from timeit import default_timer
+
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.utils import CursorWrapper
+from django.http import HttpRequest, HttpResponse
+
+import six
+from six import text_type
+from typing import Any, Callable, Dict, List, Optional
+
+# Upper bounds (in seconds) of the buckets of the latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# URL namespace of the views whose requests are recorded
+NAMESPACE = 'api'
+
+_local = threading.local()
+
+class RequestStats(object):
+    def __init__(self):
+        # type: () -> None
+        self.num_queries = 0
+        self.sql_time = 0.0
+
+class EndpointStats(object):
+    def __init__(self):
+        # type: () -> None
+        self.num_requests = 0
+        self.num_errors = 0
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total_time = 0.0
+        self.num_queries = 0
+        self.sql_time = 0.0
+
+    def to_dict(self):
+        # type: () -> Dict[text_type, Any]
+        buckets = OrderedDict() # type: Dict[text_type, int]
+        cumulative_count = 0
+        for bound, count in zip(LATENCY_BUCKETS + (None,), self.bucket_counts):
+            cumulative_count += count
+            buckets['+Inf' if bound is None else text_type(bound)] = cumulative_count
+        stats = OrderedDict() # type: Dict[text_type, Any]
+        stats['requests'] = self.num_requests
+        stats['errors'] = self.num_errors
+        stats['latency_seconds'] = OrderedDict([('sum', self.total_time), ('buckets', buckets)])
+        stats['sql_queries'] = self.num_queries
+        stats['sql_seconds'] = self.sql_time
+        return stats
+
+class MetricsRegistry(object):
+    # Thread-safe aggregate of the requests made to each endpoint
+    def __init__(self):
+        # type: () -> None
+        self.lock = threading.Lock()
+        self.endpoints = {} # type: Dict[text_type, EndpointStats]
+
+    def record(self, name, duration, status_code, request_stats):
+        # type: (text_type, float, int, RequestStats) -> None
+        with self.lock:
+            stats = self.endpoints.get(name)
+            if stats is None:
+                stats = self.endpoints[name] = EndpointStats()
+            stats.num_requests += 1
+            if status_code >= 500:
+                stats.num_errors += 1
+            stats.bucket_counts[bisect_left(LATENCY_BUCKETS, duration)] += 1
+            stats.total_time += duration
+            stats.num_queries += request_stats.num_queries
+            stats.sql_time += request_stats.sql_time
+
+    def reset(self):
+        # type: () -> None
+        with self.lock:
+            self.endpoints = {}
+
+    def to_dict(self):
+        # type: () -> Dict[text_type, Any]
+        with self.lock:
+            return OrderedDict((name, self.endpoints[name].to_dict()) for name in sorted(self.endpoints))
+
+    def to_prometheus(self):
+        # type: () -> text_type
+        endpoints = self.to_dict()
+        lines = [] # type: List[text_type]
+
+        def add_metric(metric, metric_type, help_text, key):
+            # type: (text_type, text_type, text_type, text_type) -> None
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} {}".format(metric, metric_type))
+            for name, stats in six.iteritems(endpoints):
+                lines.append('{}{{view="{}"}} {}'.format(metric, name, stats[key]))
+
+        add_metric("poller_requests_total", "counter", "Number of requests.", 'requests')
+        add_metric("poller_request_errors_total", "counter", "Number of requests which failed with a 5xx status.", 'errors')
+        metric = "poller_request_duration_seconds"
+        lines.append("# HELP {} Time taken to return a response.".format(metric))
+        lines.append("# TYPE {} histogram".format(metric))
+        for name, stats in six.iteritems(endpoints):
+            latency = stats['latency_seconds']
+            for bound, count in six.iteritems(latency['buckets']):
+                lines.append('{}_bucket{{view="{}",le="{}"}} {}'.format(metric, name, bound, count))
+            lines.append('{}_sum{{view="{}"}} {}'.format(metric, name, latency['sum']))
+            lines.append('{}_count{{view="{}"}} {}'.format(metric, name, stats['requests']))
+        add_metric("poller_sql_queries_total", "counter", "Number of SQL queries.", 'sql_queries')
+        add_metric("poller_sql_duration_seconds_total", "counter", "Time spent executing SQL queries.", 'sql_seconds')
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+class TimedCursorWrapper(CursorWrapper):
+    # Adds the number and duration of queries to the RequestStats of the current thread, if any
+
+    def execute(self, sql, params=None):
+        # type: (text_type, Any) -> Any
+        start_time = default_timer()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            record_query(default_timer() - start_time)
+
+    def executemany(self, sql, param_list):
+        # type: (text_type, Any) -> Any
+        start_time = default_timer()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            record_query(default_timer() - start_time)
+
+def record_query(duration):
+    # type: (float) -> None
+    request_stats = getattr(_local, 'request_stats', None)
+    if request_stats is not None:
+        request_stats.num_queries += 1
+        request_stats.sql_time += duration
+
+def _timed(make_cursor):
+    # type: (Callable[..., CursorWrapper]) -> Callable[..., CursorWrapper]
+    def wrapped(self, cursor):
+        # type: (BaseDatabaseWrapper, Any) -> CursorWrapper
+        return TimedCursorWrapper(make_cursor(self, cursor), self)
+    wrapped.timed = True # type: ignore
+    return wrapped
+
+def install_cursor_wrapper():
+    # type: () -> None
+    # Wraps the cursors of all database connections in TimedCursorWrapper. Can be called more than once.
+    for attr in ('make_cursor', 'make_debug_cursor'):
+        make_cursor = getattr(BaseDatabaseWrapper, attr)
+        if not getattr(make_cursor, 'timed', False):
+            setattr(BaseDatabaseWrapper, attr, _timed(make_cursor))
+
+class MetricsMiddleware(object):
+    """
+    Records metrics of requests to views in main.api_urls in the registry.
+    It should be the first middleware, so that the time taken by other middleware is included.
+    The time taken by a streaming response only includes the time taken to start it.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        install_cursor_wrapper()
+
+    def process_request(self, request):
+        # type: (HttpRequest) -> None
+        request._metrics_start_time = default_timer()
+        _local.request_stats = RequestStats()
+
+    def process_response(self, request, response):
+        # type: (HttpRequest, HttpResponse) -> HttpResponse
+        request_stats = getattr(_local, 'request_stats', None)
+        _local.request_stats = None
+        start_time = getattr(request, '_metrics_start_time', None)
+        resolver_match = getattr(request, 'resolver_match', None)
+        if (request_stats is not None and start_time is not None and resolver_match is not None
+                and resolver_match.namespace == NAMESPACE):
+            duration = default_timer() - start_time
+            registry.record(resolver_match.url_name, duration, response.status_code, request_stats)
+        return response
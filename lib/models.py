@@ -1,35 +1,161 @@
 from __future__ import unicode_literals
 
 from collections import OrderedDict
+from django.db import transaction
+from django.db.models import Count
 from main.models import Question, Option, Choice
 
+import six
 from six import text_type
-from typing import Any, Dict, List, Set
-from lib.id_types import OptionId
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from lib.id_types import QuestionId, OptionId
 
-def question_to_dict(question):
+def question_fields_to_dict(question):
     # type: (Question) -> Dict[text_type, Any]
     qdict = OrderedDict() # type: Dict[text_type, Any]
-    # add simple fields
     for attr in Question.serialize_order:
         qdict[attr] = getattr(question, attr)
-    # add options
-    options = []
-    for option in question.option_set.order_by('id'):
-        options.append(option.text)
-    qdict["options"] = options
+    return qdict
+
+def question_to_dict(question, option_texts=None):
+    # type: (Question, Optional[List[text_type]]) -> Dict[text_type, Any]
+    # option_texts can be passed to avoid querying the question's options
+    qdict = question_fields_to_dict(question)
+    if option_texts is None:
+        option_texts = list(question.option_set.order_by('id').values_list('text', flat=True))
+    qdict["options"] = option_texts
     return qdict
 
 def vote_count(option):
     # type: (Option) -> int
     return Choice.objects.filter(option_id=option.id).count()
 
+def get_vote_count_mismatches():
+    # type: () -> Dict[OptionId, Tuple[int, int]]
+    # Returns a dict mapping option ids to (stored count, actual count) for every
+    # option whose Option.num_votes does not match the number of its Choice rows
+    actual_counts = dict(Choice.objects.values_list('option_id').annotate(Count('id'))) # type: Dict[OptionId, int]
+    mismatches = {} # type: Dict[OptionId, Tuple[int, int]]
+    for oid, stored_count in Option.objects.values_list('id', 'num_votes'):
+        actual_count = actual_counts.get(oid, 0)
+        if stored_count != actual_count:
+            mismatches[oid] = (stored_count, actual_count)
+    return mismatches
+
+def rebuild_vote_counts():
+    # type: () -> Dict[OptionId, Tuple[int, int]]
+    # Sets Option.num_votes from the Choice table and returns the mismatches that were fixed
+    with transaction.atomic():
+        mismatches = get_vote_count_mismatches()
+        for oid, (stored_count, actual_count) in six.iteritems(mismatches):
+            Option.objects.filter(id=oid).update(num_votes=actual_count)
+    return mismatches
+
+# The functions below build the data sent by the read-only API endpoints.
+# The iter_* functions yield the data one item at a time. They read rows in chunks of
+# ITER_CHUNK_SIZE, each starting after the last id of the previous one (like lib.export),
+# so memory use doesn't grow with the size of the poll. QuerySet.iterator() alone wouldn't
+# do that, since psycopg2 and MySQLdb fetch the whole result of a query at once.
+# They run a fixed number of queries per chunk, irrespective of the number of questions and options.
+
+# Number of rows read by each query of the iter_* functions
+ITER_CHUNK_SIZE = 2000
+
+def iter_chunks(queryset):
+    # type: (Any) -> Iterator[List[Any]]
+    # Yields the rows of queryset ordered by id in chunks. The rows are model instances
+    # or values_list() tuples starting with the id.
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by('id')[:ITER_CHUNK_SIZE])
+        if rows:
+            yield rows
+        if len(rows) < ITER_CHUNK_SIZE:
+            return
+        last_id = rows[-1][0] if isinstance(rows[-1], tuple) else rows[-1].id
+
+def iter_all_ques_data():
+    # type: () -> Iterator[Dict[text_type, Any]]
+    for questions in iter_chunks(Question.objects.all()):
+        options = Option.objects.filter(question_id__gte=questions[0].id, question_id__lte=questions[-1].id)
+        option_texts = {} # type: Dict[QuestionId, List[text_type]]
+        for qid, text in options.order_by('question_id', 'id').values_list('question_id', 'text'):
+            option_texts.setdefault(qid, []).append(text)
+        for ques_obj in questions:
+            yield question_to_dict(ques_obj, option_texts.get(ques_obj.id, []))
+
+def iter_questions_data(qids=None):
+    # type: (Optional[Iterable[QuestionId]]) -> Iterator[Tuple[QuestionId, Dict[text_type, Any]]]
+    # qids (a list or a queryset of ids) restricts the data to those questions
+    queryset = Question.objects.all()
+    if qids is not None:
+        queryset = queryset.filter(id__in=qids)
+    for questions in iter_chunks(queryset):
+        for ques_obj in questions:
+            yield (ques_obj.id, question_fields_to_dict(ques_obj))
+
+def iter_options_data(oids=None):
+    # type: (Optional[Iterable[OptionId]]) -> Iterator[Tuple[OptionId, Dict[text_type, Any]]]
+    # oids (a list or a queryset of ids) restricts the data to those options
+    fields = ('id', 'question_id', 'text', 'num_votes', 'question__show_count')
+    queryset = Option.objects.all()
+    if oids is not None:
+        queryset = queryset.filter(id__in=oids)
+    for rows in iter_chunks(queryset.values_list(*fields)):
+        for oid, qid, text, num_votes, show_count in rows:
+            odict = OrderedDict() # type: Dict[text_type, Any]
+            odict['question'] = qid
+            odict['text'] = text
+            if show_count:
+                odict['count'] = num_votes
+            else:
+                odict['count'] = None
+            yield (oid, odict)
+
 def all_ques_data():
     # type: () -> List[Dict[text_type, Any]]
-    qlist = []
-    for ques_obj in Question.objects.order_by('id'):
-        qlist.append(question_to_dict(ques_obj))
-    return qlist
+    return list(iter_all_ques_data())
+
+def questions_data():
+    # type: () -> Dict[QuestionId, Dict[text_type, Any]]
+    return OrderedDict(iter_questions_data())
+
+def options_data():
+    # type: () -> Dict[OptionId, Dict[text_type, Any]]
+    return OrderedDict(iter_options_data())
+
+def question_results_data(question):
+    # type: (Question) -> Dict[text_type, Any]
+    """
+    Returns the vote count and percentage of the total votes of each option of question,
+    the total number of votes and the number of users who have voted, using two queries.
+    These are None if the question's counts are not visible.
+    """
+    rows = list(Option.objects.filter(question_id=question.id).order_by('id').values_list('id', 'text', 'num_votes'))
+    visible = question.show_count
+    total = sum(num_votes for oid, text, num_votes in rows) if visible else None
+    voters = None # type: Optional[int]
+    if visible:
+        voters = Choice.objects.filter(question_id=question.id).aggregate(voters=Count('user_id', distinct=True))['voters']
+    olist = []
+    for oid, text, num_votes in rows:
+        odict = OrderedDict() # type: Dict[text_type, Any]
+        odict['id'] = oid
+        odict['text'] = text
+        odict['count'] = num_votes if visible else None
+        if not visible:
+            odict['percentage'] = None
+        elif total:
+            odict['percentage'] = round(100.0 * num_votes / total, 2)
+        else:
+            odict['percentage'] = 0.0
+        olist.append(odict)
+    results = OrderedDict() # type: Dict[text_type, Any]
+    results['question'] = question.id
+    results['total'] = total
+    results['voters'] = voters
+    results['options'] = olist
+    return results
 
 def get_all_oids_set():
     # type: () -> Set[OptionId]
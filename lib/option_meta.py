@@ -0,0 +1,111 @@
+"""
+Process-local cache of the question metadata of options.
+
+Voting needs the question, and whether it is locked and allows multiple votes, of every
+option voted for. These rarely change, so they are cached in each process instead of
+being read from the database on every vote. The cache is cleared when questions or
+options are changed in the same process. Other processes notice the change by comparing
+the shared data versions of lib.cache at most every settings.OPTION_META_CHECK_INTERVAL seconds.
+Since those versions are only shared if API_CACHE is shared by all processes, the cache is also
+cleared every settings.OPTION_META_MAX_AGE seconds, which bounds how long a change can go unnoticed.
+"""
+
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import namedtuple
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from main.models import Question, Option
+from lib.cache import get_data_versions, QUESTIONS, OPTIONS
+from lib.replicas import read_from_primary
+from lib.signals import questions_updated
+
+from typing import Any, Callable, Dict, Iterable, Optional
+from lib.id_types import OptionId
+
+OptionMeta = namedtuple('OptionMeta', ['question_id', 'locked', 'multivote', 'show_count'])
+
+def load_options_meta(oids):
+    # type: (Iterable[OptionId]) -> Dict[OptionId, OptionMeta]
+    # the metadata is kept until questions or options change, so it mustn't come from a lagging replica
+    with read_from_primary():
+        rows = list(Option.objects.filter(id__in=list(oids)).values_list(
+            'id', 'question_id', 'question__locked', 'question__multivote', 'question__show_count'))
+    return {row[0]: OptionMeta(*row[1:]) for row in rows}
+
+class OptionMetaCache(object):
+    def __init__(self, timer=time.time):
+        # type: (Callable[[], float]) -> None
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.data = {} # type: Dict[OptionId, OptionMeta]
+        # incremented whenever data is cleared, so that data loaded before that is discarded
+        self.generation = 0
+        self.versions = None # type: Optional[Dict[Any, int]]
+        self.cleared_at = self.checked_at = None # type: Optional[float]
+
+    def clear(self):
+        # type: () -> None
+        with self.lock:
+            self._clear(self.timer(), None)
+
+    def _clear(self, now, versions):
+        # type: (float, Optional[Dict[Any, int]]) -> None
+        self.data = {}
+        self.generation += 1
+        self.versions = versions
+        self.cleared_at = self.checked_at = now
+
+    def _check(self):
+        # type: () -> None
+        # clears data if it is too old or if questions or options have been changed in another process
+        now = self.timer()
+        if self.cleared_at is None or now - self.cleared_at >= settings.OPTION_META_MAX_AGE:
+            self._clear(now, get_data_versions([QUESTIONS, OPTIONS]))
+        elif self.checked_at is None or now - self.checked_at >= settings.OPTION_META_CHECK_INTERVAL:
+            versions = get_data_versions([QUESTIONS, OPTIONS])
+            if self.versions is None or versions != self.versions:
+                self._clear(now, versions)
+            self.checked_at = now
+
+    def get_many(self, oids):
+        # type: (Iterable[OptionId]) -> Dict[OptionId, OptionMeta]
+        # Returns a dict mapping those ids in oids which exist to their metadata
+        oids = list(oids)
+        if settings.OPTION_META_MAX_AGE <= 0:
+            return load_options_meta(oids)
+        with self.lock:
+            self._check()
+            generation = self.generation
+            result = {oid: self.data[oid] for oid in oids if oid in self.data}
+        missing = [oid for oid in oids if oid not in result]
+        if missing:
+            loaded = load_options_meta(missing)
+            result.update(loaded)
+            with self.lock:
+                if self.generation == generation:
+                    self.data.update(loaded)
+        return result
+
+option_meta_cache = OptionMetaCache()
+
+def get_options_meta(oids):
+    # type: (Iterable[OptionId]) -> Dict[OptionId, OptionMeta]
+    return option_meta_cache.get_many(oids)
+
+@receiver(post_save, sender=Question, dispatch_uid='option_meta_question_changed')
+@receiver(post_delete, sender=Question, dispatch_uid='option_meta_question_deleted')
+@receiver(post_save, sender=Option, dispatch_uid='option_meta_option_changed')
+@receiver(post_delete, sender=Option, dispatch_uid='option_meta_option_deleted')
+@receiver(questions_updated, dispatch_uid='option_meta_questions_updated')
+def clear_option_meta(sender, **kwargs):
+    # type: (Any, **Any) -> None
+    option_meta_cache.clear()
+    # other requests may load the old metadata until the current transaction commits
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(option_meta_cache.clear)
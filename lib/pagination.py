@@ -0,0 +1,48 @@
+"""
+Paginator for admin changelists of large tables.
+
+Django's Paginator counts the rows of a queryset with COUNT(*), which scans the whole
+table on most databases. For an unfiltered queryset, EstimatedCountPaginator uses an
+estimate of the number of rows instead, if it is at least ESTIMATE_THRESHOLD.
+The last pages may then be empty or missing.
+"""
+
+from __future__ import unicode_literals
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max, Min, Model, QuerySet
+
+from typing import Any, Type
+
+# Tables estimated to have fewer rows than this are counted exactly
+ESTIMATE_THRESHOLD = 100000
+
+def estimate_row_count(queryset):
+    # type: (QuerySet) -> int
+    model = queryset.model # type: Type[Model]
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        # statistics kept up to date by autovacuum and ANALYZE
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [model._meta.db_table])
+            row = cursor.fetchone()
+        if row is not None and row[0] >= 0:
+            return int(row[0])
+    # the range of primary keys is read from the index. It is an overestimate if rows have been deleted.
+    ids = model._default_manager.using(queryset.db).aggregate(first=Min('pk'), last=Max('pk'))
+    if ids['last'] is None:
+        return 0
+    return ids['last'] - ids['first'] + 1
+
+class EstimatedCountPaginator(Paginator):
+    def _get_count(self):
+        # type: () -> int
+        if self._count is None:
+            object_list = self.object_list # type: Any
+            if isinstance(object_list, QuerySet) and not object_list.query.where:
+                estimate = estimate_row_count(object_list)
+                if estimate >= ESTIMATE_THRESHOLD:
+                    self._count = estimate
+        return super(EstimatedCountPaginator, self)._get_count()
+    count = property(_get_count)
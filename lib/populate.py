@@ -1,26 +1,167 @@
 from __future__ import unicode_literals
 
+import io
 import json
-from main.models import Question, Option
+from django.db import transaction
+from main.models import Question, Option, Change
+
+from lib.cache import bump_data_versions, OPTIONS
+from lib.changes import record_changes
+from lib.exceptions import BadDataError
 
 from six import text_type
-from typing import Any, Mapping, Sequence
-
-def add_question(ques_dict):
-    # type: (Mapping[text_type, Any]) -> None
-    ques_obj = Question()
-    for attr in Question.serialize_order:
-        if attr in ques_dict:
-            setattr(ques_obj, attr, ques_dict[attr])
-    ques_obj.save()
-    for option_text in ques_dict["options"]:
-        Option.objects.create(text=option_text, question=ques_obj)
+from typing import Any, Dict, IO, Iterable, Iterator, List, Mapping, Sequence, Set, Tuple
+
+BATCH_SIZE = 1000
+
+def validate_question(ques_dict, index=0):
+    # type: (Any, int) -> None
+    # Raises BadDataError if ques_dict is not a valid question. index is used in error messages.
+    def error(message):
+        # type: (text_type) -> BadDataError
+        return BadDataError("question {}: {}".format(index, message))
+
+    if not isinstance(ques_dict, Mapping):
+        raise error("not an object")
+    text = ques_dict.get("text")
+    if not (isinstance(text, text_type) and text):
+        raise error("text missing")
+    title = ques_dict.get("title", "")
+    if not isinstance(title, text_type) or len(title) > Question._meta.get_field('title').max_length:
+        raise error("invalid title")
+    for attr in ('multivote', 'locked', 'show_count'):
+        if not isinstance(ques_dict.get(attr, False), bool):
+            raise error("invalid " + attr)
+    options = ques_dict.get("options")
+    if not isinstance(options, Sequence) or isinstance(options, text_type):
+        raise error("options missing")
+    max_length = Option._meta.get_field('text').max_length
+    for option_text in options:
+        if not (isinstance(option_text, text_type) and option_text) or len(option_text) > max_length:
+            raise error("invalid option {}".format(repr(option_text)))
+    if len(set(options)) != len(options):
+        raise error("duplicate options")
+
+def question_key(ques_dict):
+    # type: (Mapping[text_type, Any]) -> Tuple[text_type, text_type]
+    # Questions are matched by title, or by text if they don't have a title
+    title = ques_dict.get("title", "")
+    if title:
+        return ("title", title)
+    else:
+        return ("text", ques_dict["text"])
+
+def import_questions(qdicts, upsert=False, batch_size=BATCH_SIZE):
+    # type: (Iterable[Mapping[text_type, Any]], bool, int) -> Tuple[int, int]
+    """
+    Validates and saves questions in a single transaction and returns the number
+    of questions and options created. Options are inserted whenever batch_size of them
+    have been read (bulk_create splits them further if the database requires it).
+    If upsert is True, questions which match existing questions (see question_key)
+    update them and only their new options are added.
+    """
+    existing = {} # type: Dict[Tuple[text_type, text_type], Question]
+    existing_options = set() # type: Set[Tuple[int, text_type]]
+    num_questions = 0
+    num_options = 0
+    new_options = [] # type: List[Option]
+    changed_qids = [] # type: List[int]
+
+    with transaction.atomic():
+        if upsert:
+            for ques_obj in Question.objects.order_by('id'):
+                existing.setdefault(question_key({"title": ques_obj.title, "text": ques_obj.text}), ques_obj)
+            existing_options = set(Option.objects.values_list('question_id', 'text'))
+
+        for index, ques_dict in enumerate(qdicts):
+            validate_question(ques_dict, index)
+            ques_obj = existing.get(question_key(ques_dict)) if upsert else None
+            if ques_obj is None:
+                ques_obj = Question()
+                num_questions += 1
+            changed = ques_obj.pk is None
+            for attr in Question.serialize_order:
+                if attr in ques_dict and getattr(ques_obj, attr) != ques_dict[attr]:
+                    setattr(ques_obj, attr, ques_dict[attr])
+                    changed = True
+            if changed:
+                ques_obj.save()
+            if upsert:
+                existing[question_key(ques_dict)] = ques_obj
+
+            num_new_options = len(new_options)
+            # a new question can only repeat its own options, so only upserts remember all of them
+            seen_options = existing_options if upsert else set()
+            for option_text in ques_dict["options"]:
+                if (ques_obj.id, option_text) not in seen_options:
+                    seen_options.add((ques_obj.id, option_text))
+                    new_options.append(Option(text=option_text, question=ques_obj))
+            if len(new_options) > num_new_options:
+                changed_qids.append(ques_obj.id)
+            if len(new_options) >= batch_size:
+                Option.objects.bulk_create(new_options)
+                num_options += len(new_options)
+                new_options = []
+
+        Option.objects.bulk_create(new_options)
+        num_options += len(new_options)
+        # bulk_create does not send post_save signals
+        bump_data_versions(OPTIONS)
+        for i in range(0, len(changed_qids), batch_size):
+            qid_batch = changed_qids[i:i + batch_size]
+            record_changes(Change.OPTION, Option.objects.filter(question_id__in=qid_batch).values_list('id', flat=True))
+    return (num_questions, num_options)
 
 def add_qlist(qlist):
     # type: (Sequence[Mapping[text_type, Any]]) -> None
-    for qdict in qlist:
-        add_question(qdict)
+    import_questions(qlist)
+
+def iter_json_array(fp, chunk_size=65536):
+    # type: (IO[text_type], int) -> Iterator[Any]
+    # Yields the elements of the JSON array in fp without reading all of fp into memory
+    decoder = json.JSONDecoder()
+    buf = ""
+    eof = False
+    state = 'start' # one of 'start', 'first', 'value' and 'separator'
+    while True:
+        buf = buf.lstrip()
+        if not buf:
+            if eof:
+                raise BadDataError("Unexpected end of JSON")
+            buf = fp.read(chunk_size)
+            eof = not buf
+        elif state == 'start':
+            if buf[0] != '[':
+                raise BadDataError("Expected a JSON array")
+            buf = buf[1:]
+            state = 'first'
+        elif state == 'separator':
+            if buf[0] == ']':
+                return
+            elif buf[0] != ',':
+                raise BadDataError("Expected ',' or ']'")
+            buf = buf[1:]
+            state = 'value'
+        elif state == 'first' and buf[0] == ']':
+            return
+        else:
+            try:
+                value, end = decoder.raw_decode(buf)
+            except ValueError:
+                end = None
+            if end is None or (end == len(buf) and not eof):
+                # the value may continue in the next chunk
+                if eof:
+                    raise BadDataError("Invalid JSON")
+                chunk = fp.read(chunk_size)
+                eof = not chunk
+                buf += chunk
+            else:
+                yield value
+                buf = buf[end:]
+                state = 'separator'
 
-def add_qfile(fname):
-    # type: (text_type) -> None
-    add_qlist(json.load(open(fname)))
+def add_qfile(fname, upsert=False):
+    # type: (text_type, bool) -> Tuple[int, int]
+    with io.open(fname, encoding='utf-8') as fp:
+        return import_questions(iter_json_array(fp), upsert=upsert)
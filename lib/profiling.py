@@ -0,0 +1,147 @@
+"""
+Sampled profiling of views with cProfile.
+
+When settings.PROFILE_DIR is set, ProfilingMiddleware profiles the views of a random
+settings.PROFILE_SAMPLE_RATE fraction of requests, and of every request to the views named
+in settings.PROFILE_URL_NAMES (like 'api:vote'). The stats of each profiled request are
+written to a .prof file in PROFILE_DIR, with the request's metadata in a .json file of the
+same name. The oldest files are removed when there are more than settings.PROFILE_MAX_FILES
+of them or they take more than settings.PROFILE_MAX_BYTES bytes. Listing the directory is
+slow when it holds many files, so each process only does that every ROTATE_EVERY dumps, or
+sooner if the dumps it knows of exceed the limits. The limits can therefore be exceeded by
+the dumps which other processes have written since.
+devel/profile_summary.py merges the dumps of each endpoint and summarizes them.
+"""
+
+from __future__ import unicode_literals
+
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+from timeit import default_timer
+from collections import OrderedDict
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+
+from six import text_type
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+PROFILE_EXT = '.prof'
+META_EXT = '.json'
+
+# Maximum number of dumps written by a process between removals of old dumps
+ROTATE_EVERY = 50
+
+_counter_lock = threading.Lock()
+_counter = [0]
+
+_rotation_lock = threading.Lock()
+# Number and size of the dumps in each directory after the last removal, plus those written since,
+# and the number of dumps written since
+_rotation = {} # type: Dict[text_type, List[int]]
+
+def should_profile(request):
+    # type: (HttpRequest) -> bool
+    if settings.PROFILE_DIR is None:
+        return False
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is not None and resolver_match.view_name in settings.PROFILE_URL_NAMES:
+        return True
+    return random.random() < settings.PROFILE_SAMPLE_RATE
+
+def get_dump_name(view_name):
+    # type: (text_type) -> text_type
+    # Names start with the time, so that sorting them sorts them by age
+    with _counter_lock:
+        _counter[0] += 1
+        counter = _counter[0]
+    now = time.time()
+    return '{}.{:06d}-{}-{}-{}'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)), int(now % 1 * 1000000),
+                                       os.getpid(), counter, view_name.replace(':', '.'))
+
+def write_dump(profiler, metadata):
+    # type: (cProfile.Profile, Dict[text_type, Any]) -> text_type
+    # Returns the path of the .prof file
+    directory = settings.PROFILE_DIR
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    base_path = os.path.join(directory, get_dump_name(metadata['view_name']))
+    profiler.dump_stats(base_path + PROFILE_EXT)
+    with open(base_path + META_EXT, 'w') as fobj:
+        json.dump(metadata, fobj, indent=2)
+    size = os.path.getsize(base_path + PROFILE_EXT) + os.path.getsize(base_path + META_EXT)
+    with _rotation_lock:
+        state = _rotation.get(directory)
+        if state is not None:
+            state[0] += 1
+            state[1] += size
+            state[2] += 1
+            if (state[2] < ROTATE_EVERY and state[0] <= settings.PROFILE_MAX_FILES
+                    and state[1] <= settings.PROFILE_MAX_BYTES):
+                return base_path + PROFILE_EXT
+        num_files, total_size = rotate_dumps(directory)
+        _rotation[directory] = [num_files, total_size, 0]
+    return base_path + PROFILE_EXT
+
+def rotate_dumps(directory):
+    # type: (text_type) -> Tuple[int, int]
+    # Removes the oldest dumps in directory until there are at most PROFILE_MAX_FILES of them using at most PROFILE_MAX_BYTES.
+    # Returns the number and size of the remaining dumps.
+    names = sorted(name[:-len(PROFILE_EXT)] for name in os.listdir(directory) if name.endswith(PROFILE_EXT))
+    sizes = [] # type: List[int]
+    for name in names:
+        size = 0
+        for ext in (PROFILE_EXT, META_EXT):
+            try:
+                size += os.path.getsize(os.path.join(directory, name + ext))
+            except OSError:
+                # removed by another process
+                pass
+        sizes.append(size)
+    total_size = sum(sizes)
+    num_removed = 0
+    while num_removed < len(names) and (len(names) - num_removed > settings.PROFILE_MAX_FILES
+                                        or total_size > settings.PROFILE_MAX_BYTES):
+        for ext in (PROFILE_EXT, META_EXT):
+            try:
+                os.remove(os.path.join(directory, names[num_removed] + ext))
+            except OSError:
+                pass
+        total_size -= sizes[num_removed]
+        num_removed += 1
+    return (len(names) - num_removed, total_size)
+
+class ProfilingMiddleware(object):
+    """
+    Profiles views as described above. It should be the last middleware, so that only the
+    view is profiled and other middleware can still reject requests before the view runs.
+    Only the time taken to start a streaming response is profiled.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # type: (HttpRequest, Callable, Any, Any) -> None
+        if should_profile(request):
+            request._profiler = cProfile.Profile()
+            request._profile_start_time = default_timer()
+            request._profiler.enable()
+
+    def process_response(self, request, response):
+        # type: (HttpRequest, HttpResponse) -> HttpResponse
+        profiler = getattr(request, '_profiler', None) # type: Optional[cProfile.Profile]
+        if profiler is None:
+            return response
+        profiler.disable()
+        request._profiler = None
+        metadata = OrderedDict() # type: Dict[text_type, Any]
+        metadata['view_name'] = request.resolver_match.view_name
+        metadata['method'] = request.method
+        metadata['path'] = request.path
+        metadata['status'] = response.status_code
+        metadata['duration'] = default_timer() - request._profile_start_time
+        metadata['time'] = time.time()
+        metadata['pid'] = os.getpid()
+        write_dump(profiler, metadata)
+        return response
@@ -0,0 +1,202 @@
+"""
+Sending the reads of safe requests to read-only replicas of the database.
+
+settings.DATABASE_REPLICAS lists aliases in DATABASES which are replicas of 'default'.
+ReplicaMiddleware picks a replica for every GET, HEAD or OPTIONS request, and ReplicaRouter
+sends the reads made while handling it to that replica. All writes, and all reads of other
+requests, go to 'default'. Reads made while a streaming response is being sent go to 'default'.
+
+Replicas lag behind, so a client which has just voted could read its old choices from one.
+After an unsafe request (like a vote or a login), the middleware sets a cookie which keeps
+the reads of that client on 'default' for settings.REPLICA_PIN_SECONDS seconds. Clients which
+authenticate with an Authorization header may not keep cookies, so the user who made the
+request is also pinned in settings.API_CACHE, which must be shared by all processes for this
+to work. lib.request.api_login_required switches the reads to 'default' once it finds the user
+of a pinned request. Credentials in Authorization headers are always read from 'default', since
+a token which has just been created or revoked may not have reached the replica yet.
+Data which is kept after the request, like payloads cached under the current data versions
+(see lib.cache) and process-local caches, is read from 'default' with read_from_primary,
+since data read from a lagging replica would be kept until the next change.
+
+Replicas are picked round-robin (settings.REPLICA_SELECTION = 'round_robin') or by the
+latency of their last health check ('health'). A replica is checked with 'SELECT 1' at most
+every settings.REPLICA_CHECK_INTERVAL seconds; one which fails the check is skipped until
+it passes again. When no replica is healthy, reads go to 'default'. Checks run outside of the
+lock of the ReplicaSet, and other requests use the last results while a check is running.
+"""
+
+from __future__ import unicode_literals
+
+import threading
+import time
+from contextlib import contextmanager
+from timeit import default_timer
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, DEFAULT_DB_ALIAS, DatabaseError
+from django.http import HttpRequest, HttpResponse
+
+from six import text_type
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PIN_COOKIE = 'pin_primary'
+PIN_KEY = 'pin_primary:{}'
+
+_local = threading.local()
+
+def get_read_db():
+    # type: () -> Optional[text_type]
+    # Returns the alias which the current thread reads from, or None for the default
+    return getattr(_local, 'read_db', None)
+
+def set_read_db(alias):
+    # type: (Optional[text_type]) -> None
+    _local.read_db = alias
+
+@contextmanager
+def read_from_primary():
+    # type: () -> Iterator[None]
+    old_alias = get_read_db()
+    set_read_db(None)
+    try:
+        yield
+    finally:
+        set_read_db(old_alias)
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        # type: (Any, **Any) -> Optional[text_type]
+        return get_read_db()
+
+    def db_for_write(self, model, **hints):
+        # type: (Any, **Any) -> Optional[text_type]
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # type: (Any, Any, **Any) -> Optional[bool]
+        # replicas hold the same rows as 'default'
+        return True
+
+def check_alias(alias):
+    # type: (text_type) -> bool
+    try:
+        cursor = connections[alias].cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+        return True
+    except DatabaseError:
+        return False
+
+class ReplicaSet(object):
+    def __init__(self, aliases, check=check_alias, timer=default_timer):
+        # type: (Sequence[text_type], Callable[[text_type], bool], Callable[[], float]) -> None
+        self.aliases = list(aliases)
+        self.check = check
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.next_index = 0
+        # time of the last health check, whether it passed and how long it took, for every alias
+        self.checked_at = {} # type: Dict[text_type, float]
+        self.healthy = {} # type: Dict[text_type, bool]
+        self.latency = {} # type: Dict[text_type, float]
+
+    def claim_checks(self):
+        # type: () -> List[text_type]
+        # Returns the aliases whose health check is due. They are marked as checked, so that
+        # other threads keep using their last result until the check has finished.
+        now = self.timer()
+        due = [alias for alias in self.aliases
+               if alias not in self.checked_at or now - self.checked_at[alias] >= settings.REPLICA_CHECK_INTERVAL]
+        for alias in due:
+            self.checked_at[alias] = now
+        return due
+
+    def run_check(self, alias):
+        # type: (text_type) -> None
+        # Called without holding the lock, so that slow checks don't hold up other requests
+        start = self.timer()
+        healthy = self.check(alias)
+        end = self.timer()
+        with self.lock:
+            self.healthy[alias] = healthy
+            self.checked_at[alias] = end
+            self.latency[alias] = end - start
+
+    def choose(self):
+        # type: () -> text_type
+        # Returns the alias to read from, which is DEFAULT_DB_ALIAS if no replica is healthy
+        with self.lock:
+            due = self.claim_checks()
+        for alias in due:
+            self.run_check(alias)
+        with self.lock:
+            # replicas whose first check hasn't finished yet are skipped
+            healthy = [alias for alias in self.aliases if self.healthy.get(alias, False)]
+            if not healthy:
+                return DEFAULT_DB_ALIAS
+            if settings.REPLICA_SELECTION == 'health':
+                return min(healthy, key=lambda alias: self.latency[alias])
+            alias = healthy[self.next_index % len(healthy)]
+            self.next_index += 1
+            return alias
+
+_replica_sets = {} # type: Dict[Any, ReplicaSet]
+_replica_sets_lock = threading.Lock()
+
+def get_replica_set():
+    # type: () -> Optional[ReplicaSet]
+    aliases = tuple(settings.DATABASE_REPLICAS)
+    if not aliases:
+        return None
+    with _replica_sets_lock:
+        replica_set = _replica_sets.get(aliases)
+        if replica_set is None:
+            replica_set = _replica_sets[aliases] = ReplicaSet(aliases)
+    return replica_set
+
+def is_pinned(request):
+    # type: (HttpRequest) -> bool
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+def pin_user(user_id):
+    # type: (int) -> None
+    if settings.API_CACHE is not None:
+        caches[settings.API_CACHE].set(PIN_KEY.format(user_id), True, timeout=settings.REPLICA_PIN_SECONDS)
+
+def is_user_pinned(user_id):
+    # type: (int) -> bool
+    return settings.API_CACHE is not None and caches[settings.API_CACHE].get(PIN_KEY.format(user_id)) is not None
+
+def use_primary_if_pinned(user_id):
+    # type: (int) -> None
+    # Sends the rest of the current request's reads to 'default' if user_id has made an unsafe request recently
+    if get_read_db() is not None and is_user_pinned(user_id):
+        set_read_db(None)
+
+class ReplicaMiddleware(object):
+    """
+    Sends the reads of safe requests to a replica and pins clients which have made unsafe
+    requests to 'default'. It should come before the middleware which reads sessions and users.
+    """
+
+    def process_request(self, request):
+        # type: (HttpRequest) -> None
+        set_read_db(None)
+        replica_set = get_replica_set()
+        if replica_set is not None and request.method in SAFE_METHODS and not is_pinned(request):
+            set_read_db(replica_set.choose())
+
+    def process_response(self, request, response):
+        # type: (HttpRequest, HttpResponse) -> HttpResponse
+        set_read_db(None)
+        if settings.DATABASE_REPLICAS and request.method not in SAFE_METHODS:
+            response.set_cookie(PIN_COOKIE, text_type(time.time() + settings.REPLICA_PIN_SECONDS),
+                                max_age=settings.REPLICA_PIN_SECONDS, httponly=True)
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated():
+                pin_user(user.id)
+        return response
@@ -1,28 +1,80 @@
 from __future__ import unicode_literals
 
-import json
+import hmac
+import hashlib
 from base64 import b64decode
 from six import text_type
 
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
+from django.conf import settings
 from django.http import HttpRequest, HttpResponse
 
+from lib.codec import get_codec
 from lib.exceptions import BadDataError, ContentTypeError
+from lib.lru import LRUCache
+from lib.replicas import read_from_primary, use_primary_if_pinned
 from lib.response import text_response
+from lib.tokens import get_token_user
+from lib.textutil import force_bytes
 
 from typing import Any, Callable, Mapping, Optional, Tuple
 
 FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
 
+_auth_cache = None # type: Optional[LRUCache]
+
+def get_auth_cache():
+    # type: () -> LRUCache
+    """
+    Cache of Authorization headers which have been verified.
+    Keys are HMACs of the header, so passwords are never stored.
+    Values are (user id, password hash) pairs. The stored password hash is compared with the
+    user's current one on every lookup, so entries become invalid when the password changes.
+    """
+    global _auth_cache
+    if _auth_cache is None:
+        _auth_cache = LRUCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL)
+    return _auth_cache
+
+def get_auth_header_digest(header):
+    # type: (text_type) -> text_type
+    return hmac.new(force_bytes(settings.SECRET_KEY), force_bytes(header), hashlib.sha256).hexdigest()
+
+def authenticate_with_cache(header, username, password):
+    # type: (text_type, text_type, text_type) -> Optional[User]
+    # Same as django's authenticate, but skips password hashing if header has been verified recently
+    auth_cache = get_auth_cache()
+    digest = get_auth_header_digest(header)
+    cached = auth_cache.get(digest)
+    if cached is not None:
+        user_id, password_hash = cached
+        user = User.objects.filter(id=user_id).first()
+        if user is not None and user.password == password_hash and user.username == username:
+            return user
+        auth_cache.pop(digest)
+    user = authenticate(username=username, password=password)
+    if user:
+        auth_cache.set(digest, (user.id, user.password))
+    return user
+
+def get_bearer_token(request):
+    # type: (HttpRequest) -> Optional[text_type]
+    # Returns the token in the request's 'Authorization: Bearer <token>' header, if any
+    header_parts = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(header_parts) == 2 and header_parts[0].lower() == 'bearer':
+        return header_parts[1]
+    return None
+
 def get_user_from_auth_header(request):
     # type: (HttpRequest) -> Tuple[Optional[User], text_type]
     """
     Possible auth status codes and their meanings:
     auth_missing: Authorization header is not present
     invalid_auth: Authorization header is corrupt
-    unsupported_auth: Non-basic auth was used. Only basic auth is supported
+    unsupported_auth: Auth other than basic auth or a bearer token was used
     wrong_login: username or password is incorrect
+    invalid_token: Bearer token is unknown, expired or revoked
     success: Supplied credentials are correct and the user is active
     inactive: Supplied credentials are correct and the user is inactive
     """
@@ -33,6 +85,11 @@ def get_user_from_auth_header(request):
     if len(header_parts) != 2:
         return (None, "invalid_auth")
     auth_type, digest = header_parts
+    if auth_type.lower() == 'bearer':
+        user = get_token_user(digest)
+        if not user:
+            return (None, "invalid_token")
+        return (user, "success" if user.is_active else "inactive")
     if auth_type.lower() != 'basic':
         return (None, "unsupported_auth")
     try:
@@ -43,7 +100,7 @@ def get_user_from_auth_header(request):
     if len(credentials) != 2:
         return (None, "invalid_auth")
     username, password = credentials
-    user = authenticate(username=username, password=password)
+    user = authenticate_with_cache(header, username, password)
     if not user:
         return (None, "wrong_login")
     elif user.is_active:
@@ -58,14 +115,17 @@ def api_login_required(function):
         # type: (HttpRequest, *Any, **Any) -> HttpResponse
         if request.user.is_authenticated():
             if request.user.is_active:
+                use_primary_if_pinned(request.user.id)
                 return function(request, *args, **kwargs)
             else:
                 return text_response("inactive", status=403)
-        user, auth_status_code = get_user_from_auth_header(request)
+        with read_from_primary():
+            user, auth_status_code = get_user_from_auth_header(request)
         if not user:
             return text_response(auth_status_code, status=401)
         request.user = user
         if auth_status_code == "success":
+            use_primary_if_pinned(user.id)
             return function(request, *args, **kwargs)
         else:
             return text_response(auth_status_code, status=403)
@@ -81,14 +141,7 @@ def get_parsed_post_data(request):
     if is_form_content_type(content_type):
         return request.POST
     elif content_type.startswith("application/json"):
-        try:
-            request_str = request.body.decode('utf-8')
-            try:
-                return json.loads(request_str)
-            except ValueError:
-                raise BadDataError("Invalid JSON")
-        except UnicodeDecodeError:
-            raise BadDataError("Could not decode data to text")
+        return get_codec().loads(request.body)
     else:
         raise ContentTypeError(content_type)
 
@@ -1,14 +1,51 @@
 from __future__ import unicode_literals
 
-import json
+from itertools import chain
 from six import text_type
 
-from django.http import HttpResponse
-from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, StreamingHttpResponse
 from django.conf import settings
-from lib.textutil import force_text
+from lib.codec import JSONArray, JSONObject, get_codec
 
-from typing import Any, Optional
+from typing import Any, Iterable, Iterator, List, Optional
+
+# Number of characters of JSON sent in each chunk of a streaming response
+STREAM_CHUNK_SIZE = 65536
+
+def iter_json(object_to_send, indent=None):
+    # type: (Any, Optional[int]) -> Iterator[text_type]
+    """
+    Yields the JSON of object_to_send in parts, formatted like get_codec().dumps(object_to_send, indent).
+    If object_to_send is a JSONArray or JSONObject, there is a part for each of its items,
+    so it is never held in memory in full.
+    """
+    encoder = get_codec().make_encoder(indent)
+    if isinstance(object_to_send, JSONArray):
+        start, end = '[', ']'
+        items = (encoder.encode(value) for value in object_to_send) # type: Iterator[text_type]
+    elif isinstance(object_to_send, JSONObject):
+        start, end = '{', '}'
+        items = (encoder.encode(key if isinstance(key, text_type) else text_type(key))
+                 + encoder.key_separator + encoder.encode(value) for key, value in object_to_send)
+    else:
+        yield encoder.encode(object_to_send)
+        return
+
+    newline = None if indent is None else '\n' + ' ' * indent
+    separator = start
+    for item in items:
+        if newline is None:
+            yield separator + item
+        else:
+            # items are encoded at the top level, so they have to be indented one more level
+            yield separator + newline + item.replace('\n', newline)
+        separator = encoder.item_separator
+    if separator == start:
+        yield start + end
+    elif newline is None:
+        yield end
+    else:
+        yield '\n' + end
 
 def text_response(message, status=None):
     # type: (text_type, Optional[int]) -> HttpResponse
@@ -18,10 +55,31 @@ def text_response(message, status=None):
 
 def json_response(object_to_send, status=None):
     # type: (Any, Optional[int]) -> HttpResponse
-    json_str = force_text(json.dumps(object_to_send, indent=settings.JSON_INDENT, cls=DjangoJSONEncoder))
-    if not json_str.endswith("\n"):
-        json_str += "\n"
-    return HttpResponse(json_str, content_type="application/json", status=status)
+    content = get_codec().dumps(object_to_send, settings.JSON_INDENT)
+    if not content.endswith(b"\n"):
+        content += b"\n"
+    return HttpResponse(content, content_type="application/json", status=status)
+
+def iter_chunks(parts):
+    # type: (Iterable[text_type]) -> Iterator[bytes]
+    # Joins parts into UTF-8 encoded chunks of about STREAM_CHUNK_SIZE characters
+    chunk_parts = [] # type: List[text_type]
+    size = 0
+    for part in parts:
+        chunk_parts.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(chunk_parts).encode('utf-8')
+            chunk_parts = []
+            size = 0
+    if chunk_parts:
+        yield "".join(chunk_parts).encode('utf-8')
+
+def streaming_json_response(object_to_send, status=None):
+    # type: (Any, Optional[int]) -> HttpResponse
+    # Sends the same content as json_response, but encodes it while it is being sent
+    json_parts = chain(iter_json(object_to_send, settings.JSON_INDENT), ["\n"])
+    return StreamingHttpResponse(iter_chunks(json_parts), content_type="application/json", status=status)
 
 def get_response_str(response):
     # type: (HttpResponse) -> text_type
@@ -0,0 +1,12 @@
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+# Sent by lib.actions after votes have been added or removed.
+# user is the voter and deltas maps option ids to the change in their vote counts.
+votes_changed = Signal(providing_args=['user', 'deltas'])
+
+# Sent by lib.actions.update_questions, which changes questions with a single UPDATE
+# and so doesn't send post_save. question_ids are the updated questions and values maps
+# the names of the updated fields to their new values.
+questions_updated = Signal(providing_args=['question_ids', 'values'])
@@ -0,0 +1,65 @@
+"""
+Helpers for running the app on SQLite with concurrent writers.
+
+SQLite allows only one writer at a time. configure_connection applies settings.SQLITE_PRAGMAS
+to every new SQLite connection, which project_conf/settings/sqlite.py uses to switch to WAL
+journaling (readers then don't block the writer and vice versa) and to make writers wait for
+the lock instead of failing immediately.
+
+Even with a busy timeout, SQLite fails with 'database is locked' instead of waiting when a
+transaction which has read the database tries to write while another connection is writing,
+since waiting could deadlock. retry_on_locked runs such transactions again after a short delay.
+"""
+
+from __future__ import unicode_literals
+
+import functools
+import random
+import time
+from django.conf import settings
+from django.db import transaction, OperationalError
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+import six
+from typing import Any, Callable
+
+@receiver(connection_created, dispatch_uid='sqlite_configure_connection')
+def configure_connection(sender, connection, **kwargs):
+    # type: (Any, Any, **Any) -> None
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+    cursor = connection.cursor()
+    for name, value in sorted(six.iteritems(settings.SQLITE_PRAGMAS)):
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+def is_locked_error(e):
+    # type: (Exception) -> bool
+    # 'database is locked' with separate connections and 'database table is locked' with a shared cache
+    return isinstance(e, OperationalError) and 'locked' in str(e)
+
+def retry_on_locked(func):
+    # type: (Callable) -> Callable
+    """
+    Decorator which calls func again, up to settings.SQLITE_LOCKED_RETRIES times, when it fails
+    because the database is locked. The delay before each retry is doubled, starting from about
+    settings.SQLITE_LOCKED_RETRY_DELAY seconds. func should make all its changes in a single
+    transaction. Within an outer transaction, which a failed query has already broken,
+    the error is raised without retrying.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # type: (*Any, **Any) -> Any
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if (not is_locked_error(e) or attempt >= settings.SQLITE_LOCKED_RETRIES or
+                        transaction.get_connection().in_atomic_block):
+                    raise
+            # jitter keeps writers which failed together from retrying together
+            time.sleep(settings.SQLITE_LOCKED_RETRY_DELAY * (2 ** attempt) * random.uniform(0.5, 1))
+            attempt += 1
+    return wrapper
@@ -0,0 +1,291 @@
+"""
+Vote counts shared by all server processes through a memory-mapped file.
+
+When settings.TALLY_FILE is set, lib.actions.apply_vote_deltas adds every committed
+change in vote counts to the file, and /api/options/ reads counts from it instead of
+from the database. The file holds a header followed by an array of signed 64-bit
+counts indexed by option id. Writers take an exclusive lock (flock) on the file;
+readers read counts directly from the shared mapping.
+
+The header stores the sum of all counts, which is updated with every write, so that
+verify can detect partial writes (but not counts which are wrong as a whole). When a
+process opens a new or damaged file, the counts are rebuilt from the Choice table.
+'manage.py reconcile_tally' compares the counts with the Choice table and fixes them.
+
+Votes are added after their transaction commits, so one which has been committed may
+not have been added yet when the counts are rebuilt. To keep it from being counted twice,
+rebuilds and votes are fenced with a counter in the single row of main.models.TallyFence:
+a rebuild reserves a fence while the counts are read, which waits for transactions adding
+votes to commit, and stores it in the header. Every vote reserves a fence in its transaction,
+and it is only added if that fence is above the fence of the last rebuild. Since the row stays
+locked until the transaction ends, votes are committed one at a time while a tally is used,
+as they are written to the file one at a time anyway.
+The counts of deleted options are cleared, so that ids which are reused start from zero.
+A vote committed just before its option was deleted may still be added after that; it isn't
+shown, since the option doesn't exist, and the next reconcile_tally removes it.
+"""
+
+from __future__ import unicode_literals
+
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Count, F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from main.models import Option, Choice, TallyFence
+from lib.cache import get_api_cache, get_versions_str, QUESTIONS, OPTIONS
+from lib.replicas import read_from_primary
+
+import six
+from six import text_type
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+from lib.id_types import OptionId, QuestionId
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # type: ignore
+
+MAGIC = b'PTLY'
+FILE_VERSION = 2
+# magic, file version, number of counts, sum of counts, fence of the last rebuild
+HEADER = struct.Struct(str('<4sIQqq'))
+COUNT = struct.Struct(str('<q'))
+
+FENCE_ID = 1
+
+class Tally(object):
+    def __init__(self, path):
+        # type: (text_type) -> None
+        if fcntl is None:
+            raise ImportError("Tally requires fcntl, which is only available on Unix")
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        # flock doesn't exclude threads of the same process, which share the file descriptor
+        self.thread_lock = threading.RLock()
+        self.mm = None # type: Optional[mmap.mmap]
+        self.capacity = 0
+        with self.locked():
+            header = os.read(self.fd, HEADER.size) if os.fstat(self.fd).st_size >= HEADER.size else b''
+            # whether the counts have to be rebuilt, because the file is new or was written by something else
+            self.is_new = len(header) != HEADER.size or HEADER.unpack(header)[:2] != (MAGIC, FILE_VERSION)
+            if self.is_new:
+                os.ftruncate(self.fd, HEADER.size)
+                self._map()
+                HEADER.pack_into(self.mm, 0, MAGIC, FILE_VERSION, 0, 0, 0)
+            else:
+                self._map()
+
+    def _map(self):
+        # type: () -> None
+        # The old mapping isn't closed, since other threads may still be reading from it.
+        # It is unmapped when it is garbage collected.
+        self.mm = mmap.mmap(self.fd, os.fstat(self.fd).st_size)
+        self.capacity = HEADER.unpack_from(self.mm, 0)[2]
+
+    def _remap_if_grown(self):
+        # type: () -> None
+        # another process may have grown the file
+        if HEADER.unpack_from(self.mm, 0)[2] != self.capacity:
+            with self.thread_lock:
+                self._map()
+
+    @contextmanager
+    def locked(self):
+        # type: () -> Iterator[None]
+        with self.thread_lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _ensure_capacity(self, max_oid):
+        # type: (int) -> None
+        # must be called with the lock held
+        self._remap_if_grown()
+        if max_oid < self.capacity:
+            return
+        capacity = max(max_oid + 1, 2 * self.capacity, 1024)
+        os.ftruncate(self.fd, HEADER.size + capacity * COUNT.size)
+        self._map()
+        total, fence = HEADER.unpack_from(self.mm, 0)[3:]
+        HEADER.pack_into(self.mm, 0, MAGIC, FILE_VERSION, capacity, total, fence)
+        self.capacity = capacity
+
+    def get(self, oid):
+        # type: (OptionId) -> int
+        self._remap_if_grown()
+        mm = self.mm
+        offset = HEADER.size + oid * COUNT.size
+        if offset + COUNT.size > len(mm):
+            return 0
+        return COUNT.unpack_from(mm, offset)[0]
+
+    def get_fence(self):
+        # type: () -> int
+        return HEADER.unpack_from(self.mm, 0)[4]
+
+    def add(self, deltas, fence=None):
+        # type: (Mapping[OptionId, int], Optional[int]) -> None
+        # Adds deltas to the counts, unless fence is given and the counts were rebuilt at or after it
+        if not deltas:
+            return
+        with self.locked():
+            self._remap_if_grown()
+            if fence is not None and fence <= self.get_fence():
+                return
+            self._update(deltas)
+
+    def clear(self, oids):
+        # type: (Iterable[OptionId]) -> None
+        with self.locked():
+            self._remap_if_grown()
+            self._update({oid: -COUNT.unpack_from(self.mm, HEADER.size + oid * COUNT.size)[0]
+                          for oid in oids if oid < self.capacity})
+
+    def _update(self, deltas):
+        # type: (Mapping[OptionId, int]) -> None
+        # must be called with the lock held
+        if not deltas:
+            return
+        self._ensure_capacity(max(deltas))
+        total, fence = HEADER.unpack_from(self.mm, 0)[3:]
+        for oid, delta in six.iteritems(deltas):
+            offset = HEADER.size + oid * COUNT.size
+            COUNT.pack_into(self.mm, offset, COUNT.unpack_from(self.mm, offset)[0] + delta)
+            total += delta
+        HEADER.pack_into(self.mm, 0, MAGIC, FILE_VERSION, self.capacity, total, fence)
+
+    def reset(self, counts, fence=None):
+        # type: (Mapping[OptionId, int], Optional[int]) -> None
+        # Replaces all counts by counts, which include the votes fenced with versions up to fence
+        with self.locked():
+            self._ensure_capacity(max(counts) if counts else 0)
+            if fence is None:
+                fence = self.get_fence()
+            self.mm[HEADER.size:] = b'\0' * (self.capacity * COUNT.size)
+            for oid, count in six.iteritems(counts):
+                COUNT.pack_into(self.mm, HEADER.size + oid * COUNT.size, count)
+            HEADER.pack_into(self.mm, 0, MAGIC, FILE_VERSION, self.capacity, sum(six.itervalues(counts)), fence)
+
+    def counts(self):
+        # type: () -> Dict[OptionId, int]
+        # Returns all non-zero counts
+        self._remap_if_grown()
+        mm = self.mm
+        counts = {} # type: Dict[OptionId, int]
+        for oid in range((len(mm) - HEADER.size) // COUNT.size):
+            count = COUNT.unpack_from(mm, HEADER.size + oid * COUNT.size)[0]
+            if count:
+                counts[oid] = count
+        return counts
+
+    def verify(self):
+        # type: () -> bool
+        # Checks that the counts add up to the sum stored in the header
+        with self.locked():
+            return sum(six.itervalues(self.counts())) == HEADER.unpack_from(self.mm, 0)[3]
+
+    def close(self):
+        # type: () -> None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        os.close(self.fd)
+
+_tallies = {} # type: Dict[text_type, Tally]
+_tallies_lock = threading.Lock()
+
+def get_tally():
+    # type: () -> Optional[Tally]
+    # Returns the tally at settings.TALLY_FILE, or None if vote counts are only kept in the database
+    path = settings.TALLY_FILE
+    if path is None:
+        return None
+    with _tallies_lock:
+        tally = _tallies.get(path)
+        if tally is None:
+            tally = _tallies[path] = Tally(path)
+            if tally.is_new or not tally.verify():
+                # in a transaction, the counts would include its uncommitted choices
+                transaction.on_commit(lambda: reconcile_tally(tally))
+    return tally
+
+def reserve_fence(tally):
+    # type: (Tally) -> int
+    # Returns a new fence. The counter stays locked until the current transaction ends.
+    # The counter is read from the database it is written to, even if other reads go to a replica.
+    db = router.db_for_write(TallyFence)
+    counter = TallyFence.objects.using(db).filter(id=FENCE_ID)
+    if not counter.update(version=F('version') + 1):
+        # the row is missing, for example because the table has been flushed
+        TallyFence.objects.using(db).get_or_create(id=FENCE_ID, defaults={'version': tally.get_fence()})
+        counter.update(version=F('version') + 1)
+    return counter.values_list('version', flat=True)[0]
+
+def get_choice_counts():
+    # type: () -> Dict[OptionId, int]
+    rows = Choice.objects.values_list('option_id').annotate(count=Count('id')).order_by()
+    return {oid: count for oid, count in rows}
+
+def reconcile_tally(tally, fix=True):
+    # type: (Tally, bool) -> Dict[OptionId, Tuple[int, int]]
+    # Returns a dict mapping option ids to (tally count, actual count) for every wrong count, and fixes them if fix is True
+    with transaction.atomic(), read_from_primary():
+        # keeps votes from being committed until the counts have been replaced
+        fence = reserve_fence(tally)
+        actual_counts = get_choice_counts()
+        tally_counts = tally.counts()
+        mismatches = {} # type: Dict[OptionId, Tuple[int, int]]
+        for oid in set(actual_counts) | set(tally_counts):
+            if tally_counts.get(oid, 0) != actual_counts.get(oid, 0):
+                mismatches[oid] = (tally_counts.get(oid, 0), actual_counts.get(oid, 0))
+        if fix:
+            tally.reset(actual_counts, fence)
+    return mismatches
+
+@receiver(post_delete, sender=Option, dispatch_uid='tally_option_deleted')
+def option_deleted(sender, instance, **kwargs):
+    # type: (Any, Option, **Any) -> None
+    # The option's choices are deleted by a cascade, which doesn't update vote counts
+    tally = get_tally()
+    if tally is not None:
+        oid = instance.id
+        transaction.on_commit(lambda: tally.clear([oid]))
+
+def get_option_skeleton():
+    # type: () -> List[Tuple[OptionId, QuestionId, text_type, bool]]
+    # Returns the (id, question id, text, show_count) of every option. Unlike counts, these
+    # rarely change, so they are cached under the versions of questions and options.
+    cache = get_api_cache()
+    version = get_versions_str([QUESTIONS, OPTIONS])
+    key = 'option_skeleton:{}'.format(version)
+    rows = cache.get(key) if cache is not None and version is not None else None
+    if rows is None:
+        query = Option.objects.order_by('id').values_list('id', 'question_id', 'text', 'question__show_count')
+        if cache is not None and version is not None:
+            # cached rows are kept until options change again, so they mustn't come from a lagging replica
+            with read_from_primary():
+                rows = list(query)
+            cache.set(key, rows, timeout=settings.API_CACHE_TIMEOUT)
+        else:
+            rows = list(query)
+    return rows
+
+def iter_options_data_from_tally(tally):
+    # type: (Tally) -> Iterator[Tuple[OptionId, Dict[text_type, Any]]]
+    # Same as lib.models.iter_options_data, but with counts from tally
+    for oid, qid, text, show_count in get_option_skeleton():
+        odict = OrderedDict() # type: Dict[text_type, Any]
+        odict['question'] = qid
+        odict['text'] = text
+        odict['count'] = tally.get(oid) if show_count else None
+        yield (oid, odict)
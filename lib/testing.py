@@ -13,7 +13,7 @@ from six import text_type
 from base64 import b64encode
 
 from main.models import Option, Choice, Question
-from lib.actions import choose
+from lib.actions import choose, update_questions
 
 from lib.exceptions import BadDataError, ContentTypeError
 from lib.response import get_response_str
@@ -147,7 +147,8 @@ def do_test_vote(test, username, already_chosen_strs, choose_strs, unchoose_strs
         choose(user, option)
 
     # lock questions in locked_titles
-    Question.objects.filter(title__in=(locked_titles or [])).update(locked=True)
+    locked_qids = list(Question.objects.filter(title__in=(locked_titles or [])).values_list('id', flat=True))
+    update_questions(locked_qids, locked=True)
 
     # get oid lists
     choose_list = get_oids_from_strs(choose_strs)
@@ -166,7 +167,7 @@ def do_test_vote(test, username, already_chosen_strs, choose_strs, unchoose_strs
 
     test.assertEqual(response.status_code, status_code)
 
-    Question.objects.filter(title__in=(locked_titles or [])).update(locked=False)
+    update_questions(locked_qids, locked=False)
 
     if should_be_chosen is not None:
         chosen_by_view = set(Choice.objects.filter(user=user).values_list('option_id', flat=True))
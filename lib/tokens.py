@@ -0,0 +1,86 @@
+"""
+API tokens, an alternative to sending a username and password with every request.
+
+A token is a random string given to the client by /api/tokens/ and sent back in an
+'Authorization: Bearer <token>' header. Tokens are random enough that they don't need a
+slow password hash, so only their SHA-256 digest is stored and looked up.
+Recently used tokens are kept in an in-process LRU cache. Revoking a token removes it
+from the cache of the process which revoked it; other processes may accept it for up to
+settings.AUTH_CACHE_TTL seconds more.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from main.models import ApiToken
+from lib.lru import LRUCache
+from lib.textutil import force_bytes
+
+from six import text_type
+from typing import Optional, Tuple
+
+TOKEN_LENGTH = 40
+
+_token_cache = None # type: Optional[LRUCache]
+
+def get_token_cache():
+    # type: () -> LRUCache
+    # Cache of token digests which have been looked up, with their (user id, expiry time)
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = LRUCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL)
+    return _token_cache
+
+def get_token_digest(token):
+    # type: (text_type) -> text_type
+    return hashlib.sha256(force_bytes(token)).hexdigest()
+
+def create_token(user):
+    # type: (User) -> Tuple[text_type, ApiToken]
+    # Returns a new token for user and its database row
+    token = get_random_string(TOKEN_LENGTH)
+    expires = None
+    if settings.API_TOKEN_TTL is not None:
+        expires = timezone.now() + timedelta(seconds=settings.API_TOKEN_TTL)
+    token_obj = ApiToken.objects.create(user=user, digest=get_token_digest(token), expires=expires)
+    return (token, token_obj)
+
+def get_token_user(token):
+    # type: (text_type) -> Optional[User]
+    # Returns the user token belongs to, or None if token is unknown, expired or revoked
+    token_cache = get_token_cache()
+    digest = get_token_digest(token)
+    cached = token_cache.get(digest)
+    if cached is None:
+        token_obj = ApiToken.objects.filter(digest=digest, revoked=False).first()
+        if token_obj is None:
+            return None
+        cached = (token_obj.user_id, token_obj.expires)
+        token_cache.set(digest, cached)
+    user_id, expires = cached
+    if expires is not None and expires <= timezone.now():
+        token_cache.pop(digest)
+        return None
+    return User.objects.filter(id=user_id).first()
+
+def revoke_token(token):
+    # type: (text_type) -> bool
+    # Returns whether the token existed and was not already revoked
+    digest = get_token_digest(token)
+    get_token_cache().pop(digest)
+    return ApiToken.objects.filter(digest=digest, revoked=False).update(revoked=True) > 0
+
+def revoke_user_tokens(user):
+    # type: (User) -> int
+    # Revokes all tokens of user and returns their number
+    digests = list(ApiToken.objects.filter(user=user, revoked=False).values_list('digest', flat=True))
+    token_cache = get_token_cache()
+    for digest in digests:
+        token_cache.pop(digest)
+    return ApiToken.objects.filter(user=user, revoked=False).update(revoked=True)
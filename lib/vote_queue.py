@@ -0,0 +1,162 @@
+"""
+Write-behind queue of ballots.
+
+When settings.VOTE_QUEUE is set, /api/vote/ validates a ballot and appends it to a queue
+kept in a separate SQLite file instead of applying it, so that votes don't wait for
+the lock of the main database. The process_vote_queue management command applies
+queued ballots in batches, one transaction per batch, in the order they were queued.
+A ballot is removed from the queue only after its batch has been committed. If the worker
+dies in between, the batch is applied again, which has no further effect.
+Only one worker should process a queue at a time.
+
+Queuing a ballot doesn't guarantee that it will be applied: like a direct vote, it has no
+effect on questions which are locked when the worker applies it, even if they were unlocked
+when it was queued. Both the worker and get_choices_with_pending therefore read whether
+questions are locked from the database rather than from the cache of lib.option_meta,
+so that /api/my-choices/ stops showing such ballots as soon as their question is locked.
+"""
+
+from __future__ import unicode_literals
+
+import json
+import sqlite3
+import threading
+import time
+from django.conf import settings
+from django.db import transaction
+
+from django.contrib.auth.models import User
+from main.models import Choice
+from lib.actions import apply_ballot, get_ballot_result
+from lib.cache import bump_data_versions, user_choices_name
+from lib.option_meta import load_options_meta
+from lib.sqlite import retry_on_locked
+
+import six
+from six import text_type
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+from lib.id_types import OptionId, QuestionId
+
+# (id, user id, option ids to choose, option ids to unchoose)
+Ballot = Tuple[int, int, List[OptionId], List[OptionId]]
+
+class VoteQueue(object):
+    # A FIFO queue of ballots stored in the SQLite database at path
+
+    def __init__(self, path):
+        # type: (text_type) -> None
+        self.path = path
+        self.local = threading.local()
+        self.connect().execute("""CREATE TABLE IF NOT EXISTS ballot (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            choose TEXT NOT NULL,
+            unchoose TEXT NOT NULL,
+            created REAL NOT NULL)""")
+        self.connect().execute("CREATE INDEX IF NOT EXISTS ballot_user_id ON ballot (user_id)")
+
+    def connect(self):
+        # type: () -> sqlite3.Connection
+        # sqlite3 connections can't be shared between threads, so each thread has its own
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            # WAL lets the worker read while requests append
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def put(self, user_id, choose_oids, unchoose_oids):
+        # type: (int, Sequence[OptionId], Sequence[OptionId]) -> int
+        cursor = self.connect().execute("INSERT INTO ballot (user_id, choose, unchoose, created) VALUES (?, ?, ?, ?)",
+            (user_id, json.dumps(list(choose_oids)), json.dumps(list(unchoose_oids)), time.time()))
+        return cursor.lastrowid
+
+    def _read(self, query, params):
+        # type: (text_type, Tuple[Any, ...]) -> List[Ballot]
+        rows = self.connect().execute(query, params).fetchall()
+        return [(ballot_id, user_id, json.loads(choose), json.loads(unchoose))
+                for ballot_id, user_id, choose, unchoose in rows]
+
+    def get_batch(self, size):
+        # type: (int) -> List[Ballot]
+        return self._read("SELECT id, user_id, choose, unchoose FROM ballot ORDER BY id LIMIT ?", (size,))
+
+    def get_pending(self, user_id):
+        # type: (int) -> List[Ballot]
+        return self._read("SELECT id, user_id, choose, unchoose FROM ballot WHERE user_id = ? ORDER BY id", (user_id,))
+
+    def remove_through(self, ballot_id):
+        # type: (int) -> None
+        # removes the ballots up to and including ballot_id
+        self.connect().execute("DELETE FROM ballot WHERE id <= ?", (ballot_id,))
+
+    def __len__(self):
+        # type: () -> int
+        return self.connect().execute("SELECT COUNT(*) FROM ballot").fetchone()[0]
+
+_queues = {} # type: Dict[text_type, VoteQueue]
+
+def get_vote_queue():
+    # type: () -> Optional[VoteQueue]
+    # Returns the queue at settings.VOTE_QUEUE, or None if ballots should be applied immediately
+    path = settings.VOTE_QUEUE
+    if path is None:
+        return None
+    if path not in _queues:
+        _queues[path] = VoteQueue(path)
+    return _queues[path]
+
+def enqueue_ballot(queue, user, choose_oids, unchoose_oids):
+    # type: (VoteQueue, User, Sequence[OptionId], Sequence[OptionId]) -> None
+    queue.put(user.id, choose_oids, unchoose_oids)
+    # the user's choices, as seen by /api/my-choices/, have changed
+    bump_data_versions(user_choices_name(user.id))
+
+@retry_on_locked
+def process_batch(queue, size):
+    # type: (VoteQueue, int) -> int
+    # Applies the oldest size ballots in one transaction and returns the number of ballots applied.
+    # The ballots are only removed after the transaction, so a retried batch applies them again.
+    ballots = queue.get_batch(size)
+    if not ballots:
+        return 0
+    oids = set() # type: Set[OptionId]
+    for ballot_id, user_id, choose_oids, unchoose_oids in ballots:
+        oids.update(choose_oids)
+        oids.update(unchoose_oids)
+    with transaction.atomic():
+        options = load_options_meta(oids)
+        users = User.objects.in_bulk(list(set(ballot[1] for ballot in ballots)))
+        for ballot_id, user_id, choose_oids, unchoose_oids in ballots:
+            user = users.get(user_id)
+            if user is None:
+                continue
+            # options may have been deleted after the ballot was queued
+            apply_ballot(user, options, [oid for oid in choose_oids if oid in options],
+                         [oid for oid in unchoose_oids if oid in options])
+    queue.remove_through(ballots[-1][0])
+    return len(ballots)
+
+def get_choices_with_pending(queue, user):
+    # type: (VoteQueue, User) -> List[OptionId]
+    # Returns the options chosen by user, including the effect of ballots which are still queued
+    # Read the queue first: a ballot applied in between is then seen twice, which is harmless,
+    # whereas reading the choices first could miss it.
+    ballots = queue.get_pending(user.id)
+    rows = list(Choice.objects.filter(user=user).order_by('option_id').values_list('option_id', 'question_id'))
+    if not ballots:
+        return [oid for oid, qid in rows]
+    oids = set() # type: Set[OptionId]
+    for ballot_id, user_id, choose_oids, unchoose_oids in ballots:
+        oids.update(choose_oids)
+        oids.update(unchoose_oids)
+    options = load_options_meta(oids)
+    qid_of = dict(rows) # type: Dict[OptionId, QuestionId]
+    for oid, meta in six.iteritems(options):
+        qid_of[oid] = meta.question_id
+    chosen = set(oid for oid, qid in rows) # type: Set[OptionId]
+    for ballot_id, user_id, choose_oids, unchoose_oids in ballots:
+        chosen = get_ballot_result(chosen, options, qid_of, [oid for oid in choose_oids if oid in options],
+                                   [oid for oid in unchoose_oids if oid in options])
+    return sorted(chosen)
@@ -1,22 +1,149 @@
 from __future__ import unicode_literals
 
+from collections import Counter
 from django.contrib import admin
-from django.contrib.admin import ModelAdmin
+from django.contrib.admin import ModelAdmin, SimpleListFilter
+from django.contrib.admin.actions import delete_selected
+from django.contrib.auth.models import User
+from django.db.models import QuerySet, Sum
+from django.http import HttpRequest, HttpResponse
+from django.utils.html import format_html
 
-from main.models import Question, Option, Choice
+from main.models import Question, Option, Choice, ApiToken
+from lib.actions import apply_vote_deltas, update_questions
+from lib.pagination import EstimatedCountPaginator
 
+import six
 from six import text_type
-from typing import Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+def question_action(description, **values):
+    # type: (text_type, **Any) -> Callable[[ModelAdmin, HttpRequest, QuerySet[Question]], None]
+    # Returns an admin action which sets values on the selected questions with a single UPDATE
+    def action(modeladmin, request, queryset):
+        # type: (ModelAdmin, HttpRequest, QuerySet[Question]) -> None
+        qids = list(queryset.exclude(**values).values_list('id', flat=True))
+        update_questions(qids, **values)
+        modeladmin.message_user(request, "Updated {} questions.".format(len(qids)))
+    action.short_description = description # type: ignore
+    action.__name__ = str('set_' + '_'.join('{}_{}'.format(key, value).lower() for key, value in sorted(values.items())))
+    return action
 
 class QuestionAdmin(ModelAdmin):
-    list_display = ("id", "title", "text", "multivote", "locked") # type: Tuple[text_type, ...]
+    list_display = ("id", "title", "text", "multivote", "locked", "show_count", "total_votes") # type: Tuple[text_type, ...]
+    list_filter = ("locked", "show_count", "multivote") # type: Tuple[text_type, ...]
+    actions = [
+        question_action("Lock selected questions", locked=True),
+        question_action("Unlock selected questions", locked=False),
+        question_action("Show vote counts of selected questions", show_count=True),
+        question_action("Hide vote counts of selected questions", show_count=False),
+    ] # type: List[Any]
+
+    def get_queryset(self, request):
+        # type: (HttpRequest) -> QuerySet[Question]
+        return super(QuestionAdmin, self).get_queryset(request).annotate(vote_total=Sum('option__num_votes'))
+
+    def total_votes(self, obj):
+        # type: (Question) -> int
+        return obj.vote_total or 0 # type: ignore
+    total_votes.admin_order_field = 'vote_total' # type: ignore
 
 class OptionAdmin(ModelAdmin):
-    list_display = ("id", "text", "question") # type: Tuple[text_type, ...]
+    list_display = ("id", "text", "question", "num_votes") # type: Tuple[text_type, ...]
+    list_select_related = ("question",) # type: Tuple[text_type, ...]
+    list_filter = ("question",) # type: Tuple[text_type, ...]
+    # vote counts are maintained by lib.actions
+    readonly_fields = ("num_votes",) # type: Tuple[text_type, ...]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+class ChoiceUserFilter(SimpleListFilter):
+    """
+    Filters choices by user id (?user=<id>). Unlike a RelatedFieldListFilter,
+    it doesn't list every user; only the selected user is shown.
+    """
+    title = "user"
+    parameter_name = "user"
+
+    def lookups(self, request, model_admin):
+        # type: (HttpRequest, ModelAdmin) -> List[Tuple[text_type, text_type]]
+        value = self.value()
+        if not value or not value.isdigit():
+            return []
+        user = User.objects.filter(id=int(value)).first()
+        return [(value, user.username if user is not None else value)]
+
+    def queryset(self, request, queryset):
+        # type: (HttpRequest, QuerySet[Choice]) -> QuerySet[Choice]
+        value = self.value()
+        if value and value.isdigit():
+            return queryset.filter(user_id=int(value))
+        return queryset
+
+def delete_selected_choices(modeladmin, request, queryset):
+    # type: (ModelAdmin, HttpRequest, QuerySet[Choice]) -> Optional[HttpResponse]
+    # Same as django's delete_selected action, but also updates stored vote counts
+    if request.POST.get('post'):
+        deltas_by_user = {} # type: Dict[int, Counter]
+        for user_id, option_id in queryset.values_list('user_id', 'option_id'):
+            deltas_by_user.setdefault(user_id, Counter())[option_id] -= 1
+    response = delete_selected(modeladmin, request, queryset)
+    # delete_selected returns None once the objects have been deleted
+    if response is None and request.POST.get('post'):
+        users = User.objects.in_bulk(list(deltas_by_user))
+        for user_id, deltas in six.iteritems(deltas_by_user):
+            apply_vote_deltas(users[user_id], deltas)
+    return response
+delete_selected_choices.short_description = delete_selected.short_description
 
 class ChoiceAdmin(ModelAdmin):
-    list_display = ("id", "user", "option", "get_question") # type: Tuple[text_type, ...]
+    list_display = ("id", "user_link", "option", "question") # type: Tuple[text_type, ...]
+    list_select_related = ("user", "option", "question") # type: Tuple[text_type, ...]
+    # both filters use the (user, question) index
+    list_filter = (ChoiceUserFilter, "question") # type: Tuple[Any, ...]
+    search_fields = ("=user__username",) # type: Tuple[text_type, ...]
+    raw_id_fields = ("user", "option") # type: Tuple[text_type, ...]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = [delete_selected_choices] # type: List[Any]
+
+    def user_link(self, obj):
+        # type: (Choice) -> text_type
+        # links to the choices of the same user
+        return format_html('<a href="?user={}">{}</a>', obj.user_id, obj.user.username)
+    user_link.short_description = "user" # type: ignore
+    user_link.admin_order_field = "user" # type: ignore
+
+    def get_actions(self, request):
+        # type: (HttpRequest) -> Dict[text_type, Any]
+        actions = super(ChoiceAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def save_model(self, request, obj, form, change):
+        # type: (HttpRequest, Choice, Any, bool) -> None
+        old_obj = Choice.objects.get(id=obj.id) if change else None
+        super(ChoiceAdmin, self).save_model(request, obj, form, change)
+        if old_obj is not None:
+            apply_vote_deltas(old_obj.user, {old_obj.option_id: -1})
+        apply_vote_deltas(obj.user, {obj.option_id: 1})
+
+    def delete_model(self, request, obj):
+        # type: (HttpRequest, Choice) -> None
+        super(ChoiceAdmin, self).delete_model(request, obj)
+        apply_vote_deltas(obj.user, {obj.option_id: -1})
+
+class ApiTokenAdmin(ModelAdmin):
+    list_display = ("id", "user", "created", "expires", "revoked") # type: Tuple[text_type, ...]
+    list_filter = ("revoked",) # type: Tuple[text_type, ...]
+    # tokens are created through the API; only their digest is stored
+    readonly_fields = ("user", "digest", "created") # type: Tuple[text_type, ...]
+
+    def has_add_permission(self, request):
+        # type: (HttpRequest) -> bool
+        return False
 
 admin.site.register(Question, QuestionAdmin)
 admin.site.register(Option, OptionAdmin)
 admin.site.register(Choice, ChoiceAdmin)
+admin.site.register(ApiToken, ApiTokenAdmin)
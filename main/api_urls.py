@@ -8,9 +8,16 @@ urlpatterns = [
     url(r'^login/$', api_views.login_view, name='login'),
     url(r'^logout/$', api_views.logout_view, name='logout'),
     url(r'^register/$', api_views.register, name='register'),
+    url(r'^tokens/$', api_views.tokens, name='tokens'),
+    url(r'^tokens/revoke/$', api_views.revoke_tokens, name='revoke_tokens'),
     url(r'^$', api_views.all_ques, name='index'),
     url(r'^questions/$', api_views.questions, name='questions'),
     url(r'^options/$', api_views.options, name='options'),
+    url(r'^questions/(?P<question_id>\d+)/results/$', api_views.question_results, name='question_results'),
+    url(r'^changes/$', api_views.changes, name='changes'),
     url(r'^my-choices/$', api_views.my_choices, name='my_choices'),
     url(r'^vote/$', api_views.vote, name='vote'),
+    url(r'^stream/$', api_views.stream, name='stream'),
+    url(r'^metrics/$', api_views.metrics_view, name='metrics'),
+    url(r'^export/votes/$', api_views.export_votes, name='export_votes'),
 ]
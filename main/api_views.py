@@ -2,60 +2,96 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 from django.contrib.auth.models import User
-from django.views.decorators.http import require_safe, require_POST
+from django.views.decorators.http import require_safe, require_POST, condition
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth import authenticate, login, logout
 from django.conf import settings
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
 
-from collections import OrderedDict
 from six import text_type
 
 from main.models import Question, Option, Choice
-from lib.actions import choose, unchoose
-from lib.models import vote_count, all_ques_data, get_all_oids_set
+from lib.actions import apply_ballot
+from lib.models import (
+    iter_all_ques_data, iter_questions_data, iter_options_data, question_results_data
+)
 
+from lib.cache import (
+    cached_json_response, payload_etag_func, user_choices_etag
+)
+from lib.changes import get_changes_since, get_version_range
+from lib.events import get_broker, EventStream
 from lib.exceptions import BadDataError
-from lib.response import json_response, text_response
+from lib import export, metrics
+from lib.vote_queue import get_vote_queue, enqueue_ballot, get_choices_with_pending
+from lib.option_meta import get_options_meta
+from lib.sqlite import retry_on_locked
+from lib.tally import get_tally, iter_options_data_from_tally
+from lib.tokens import create_token, revoke_token, revoke_user_tokens
+from lib.response import json_response, text_response, iter_chunks, JSONArray, JSONObject
 from lib.request import (
     api_login_required, get_parsed_post_data, is_form_content_type,
-    get_username_and_password
+    get_username_and_password, get_bearer_token
 )
 
 from typing import Any, Dict, Mapping, Sequence
 from lib.id_types import QuestionId, OptionId
 
 @require_safe
+@condition(etag_func=payload_etag_func('index'))
 def all_ques(request):
     # type: (HttpRequest) -> HttpResponse
-    qlist = all_ques_data()
-    return json_response(qlist)
+    return cached_json_response('index', lambda: JSONArray(iter_all_ques_data()))
 
 @require_safe
+@condition(etag_func=payload_etag_func('questions'))
 def questions(request):
     # type: (HttpRequest) -> HttpResponse
-    qlist = OrderedDict() # type: Dict[QuestionId, Dict[text_type, Any]]
-    for q in Question.objects.order_by('id'):
-        qdict = OrderedDict() # type: Dict[text_type, Any]
-        for attr in Question.serialize_order:
-            qdict[attr] = getattr(q, attr)
-        qlist[q.id] = qdict
-    return json_response(qlist)
+    return cached_json_response('questions', lambda: JSONObject(iter_questions_data()))
 
 @require_safe
+@condition(etag_func=payload_etag_func('options'))
 def options(request):
     # type: (HttpRequest) -> HttpResponse
-    olist = OrderedDict() # type: Dict[OptionId, Dict[text_type, Any]]
-    for option in Option.objects.order_by('id'):
-        odict = OrderedDict() # type: Dict[text_type, Any]
-        odict['question'] = option.question_id
-        odict['text'] = option.text
-        if option.question.show_count:
-            odict['count'] = vote_count(option)
-        else:
-            odict['count'] = None
-        olist[option.id] = odict
-    return json_response(olist)
+    tally = get_tally()
+    if tally is not None:
+        return cached_json_response('options', lambda: JSONObject(iter_options_data_from_tally(tally)))
+    return cached_json_response('options', lambda: JSONObject(iter_options_data()))
+
+@require_safe
+@condition(etag_func=payload_etag_func('results'))
+def question_results(request, question_id):
+    # type: (HttpRequest, text_type) -> HttpResponse
+    question = Question.objects.filter(id=int(question_id)).first()
+    if question is None:
+        return text_response("question_not_found", 404)
+    return json_response(question_results_data(question))
+
+@require_safe
+def changes(request):
+    # type: (HttpRequest) -> HttpResponse
+    # Questions and options which have changed since the version passed as ?since=
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        return text_response("invalid_format", 400)
+    data = get_changes_since(since)
+    if data is None:
+        return json_response({"error": "resync_required", "version": get_version_range()[1]}, 410)
+    return json_response(data)
+
+@require_safe
+def stream(request):
+    # type: (HttpRequest) -> HttpResponse
+    # Streams vote count changes and question locks as server-sent events
+    try:
+        last_event_id = int(request.META.get('HTTP_LAST_EVENT_ID', ''))
+    except ValueError:
+        last_event_id = get_broker().last_event_id()
+    events = EventStream(last_event_id, settings.SSE_HEARTBEAT_INTERVAL, settings.SSE_MAX_DURATION)
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 @require_POST
 @csrf_exempt
@@ -93,7 +129,7 @@ def register(request):
     if exists:
         return text_response("username_taken")
     else:
-        User.objects.create_user(username=username, password=password)
+        retry_on_locked(User.objects.create_user)(username=username, password=password)
         return text_response("success")
 
 @require_POST
@@ -103,10 +139,44 @@ def logout_view(request):
     logout(request)
     return text_response("logged_out")
 
+@require_POST
+@csrf_exempt
+def tokens(request):
+    # type: (HttpRequest) -> HttpResponse
+    # Trades a username and password for an API token
+    try:
+        username, password = get_username_and_password(request)
+    except BadDataError as e:
+        return text_response(str(e), 400)
+    user = authenticate(username=username, password=password)
+    if not user:
+        return text_response("wrong_login", 401)
+    if not user.is_active:
+        return text_response("inactive", 403)
+    token, token_obj = create_token(user)
+    return json_response({"token": token, "expires": token_obj.expires}, 201)
+
+@require_POST
+@csrf_exempt
+@api_login_required
+def revoke_tokens(request):
+    # type: (HttpRequest) -> HttpResponse
+    # Revokes the token the request was authenticated with, or all of the user's tokens otherwise
+    token = get_bearer_token(request)
+    if token is not None:
+        revoke_token(token)
+    else:
+        revoke_user_tokens(request.user)
+    return text_response("revoked")
+
 @require_safe
 @api_login_required
+@condition(etag_func=user_choices_etag)
 def my_choices(request):
     # type: (HttpRequest) -> HttpResponse
+    queue = get_vote_queue()
+    if queue is not None:
+        return json_response(get_choices_with_pending(queue, request.user))
     choice_query = Choice.objects.filter(user=request.user).order_by('option_id')
     return json_response(list(choice_query.values_list('option_id', flat=True)))
 
@@ -168,13 +238,47 @@ def vote(request):
                 return text_response("has_negative_values", 400)
 
     # check if all oids are valid
-    oids_in_db = get_all_oids_set()
+    options = get_options_meta(choose_set | unchoose_set)
     for oset in osets:
-        if oset - oids_in_db:
+        if oset.difference(options):
             return text_response("has_invalid_values", 400)
 
-    for oid in choose_set:
-        choose(request.user, Option.objects.get(id=oid))
-    for oid in unchoose_set:
-        unchoose(request.user, Option.objects.get(id=oid))
+    queue = get_vote_queue()
+    if queue is not None:
+        enqueue_ballot(queue, request.user, list(choose_set), list(unchoose_set))
+        return text_response("queued", 202)
+    apply_ballot(request.user, options, choose_set, unchoose_set)
     return text_response("")
+
+@require_safe
+@api_login_required
+def metrics_view(request):
+    # type: (HttpRequest) -> HttpResponse
+    # Metrics of this process, as JSON or, with ?format=prometheus, in Prometheus' text format
+    if not request.user.is_staff:
+        return text_response("forbidden", 403)
+    if request.GET.get('format') == 'prometheus':
+        return HttpResponse(metrics.registry.to_prometheus(), content_type="text/plain; version=0.0.4")
+    return json_response(metrics.registry.to_dict())
+
+@require_safe
+@api_login_required
+def export_votes(request):
+    # type: (HttpRequest) -> HttpResponse
+    # Streams all choices as CSV or, with ?format=ndjson, as newline-delimited JSON.
+    # ?question= (which can be repeated) only exports choices for the given questions.
+    if not request.user.is_staff:
+        return text_response("forbidden", 403)
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in export.FORMATS:
+        return text_response("invalid_format", 400)
+    question_ids = None
+    if 'question' in request.GET:
+        try:
+            question_ids = [int(qid) for qid in request.GET.getlist('question')]
+        except ValueError:
+            return text_response("invalid_format", 400)
+    lines = export.iter_export(export_format, question_ids)
+    response = StreamingHttpResponse(iter_chunks(lines), content_type=export.CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = 'attachment; filename="votes.{}"'.format(export_format)
+    return response
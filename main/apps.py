@@ -0,0 +1,18 @@
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+
+class MainConfig(AppConfig):
+    name = 'main'
+
+    def ready(self):
+        # type: () -> None
+        # connect signal receivers
+        import lib.actions
+        import lib.auth_backends
+        import lib.cache
+        import lib.changes
+        import lib.events
+        import lib.option_meta
+        import lib.sqlite
+        import lib.tally
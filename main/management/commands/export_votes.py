@@ -0,0 +1,32 @@
+from __future__ import unicode_literals
+
+import io
+from django.core.management.base import BaseCommand
+
+from lib.export import iter_export, EXPORT_CHUNK_SIZE, FORMATS
+
+from argparse import ArgumentParser
+from typing import Any
+
+class Command(BaseCommand):
+    help = "Write all choices as CSV or newline-delimited JSON."
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--format', choices=FORMATS, default='csv', help="Output format")
+        parser.add_argument('--question', type=int, action='append', dest='question_ids',
+                            help="Only export choices for this question (can be repeated)")
+        parser.add_argument('--output', help="File to write to (default: standard output)")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help="Number of choices read by each query")
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        lines = iter_export(options['format'], options['question_ids'], options['chunk_size'])
+        if options['output'] is None:
+            for line in lines:
+                self.stdout.write(line, ending='')
+        else:
+            with io.open(options['output'], 'w', encoding='utf-8') as fobj:
+                for line in lines:
+                    fobj.write(line)
@@ -0,0 +1,37 @@
+from __future__ import unicode_literals
+
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from lib.vote_queue import get_vote_queue, process_batch
+
+from argparse import ArgumentParser
+from typing import Any
+
+class Command(BaseCommand):
+    help = "Apply the ballots queued by /api/vote/ when the VOTE_QUEUE setting is set."
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--batch-size', type=int, default=settings.VOTE_QUEUE_BATCH_SIZE,
+                            help="Maximum number of ballots applied in a transaction")
+        parser.add_argument('--interval', type=float, default=0.5,
+                            help="Number of seconds to wait when the queue is empty")
+        parser.add_argument('--once', action='store_true', default=False,
+                            help="Exit when the queue is empty instead of waiting for more ballots")
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        queue = get_vote_queue()
+        if queue is None:
+            raise CommandError("The VOTE_QUEUE setting is not set")
+        total = 0
+        while True:
+            num_applied = process_batch(queue, options['batch_size'])
+            total += num_applied
+            if num_applied == 0:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write("Applied {} ballots".format(total))
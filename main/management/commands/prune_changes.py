@@ -0,0 +1,22 @@
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from lib.changes import prune_changes
+
+from argparse import ArgumentParser
+from typing import Any
+
+class Command(BaseCommand):
+    help = "Delete the entries of deleted questions and options from the change log used by /api/changes/."
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--days', type=float, default=settings.CHANGE_LOG_RETENTION_DAYS,
+                            help="Number of days for which the entries are kept")
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        num_deleted = prune_changes(options['days'])
+        self.stdout.write("Deleted {} changes".format(num_deleted))
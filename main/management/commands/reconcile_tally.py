@@ -0,0 +1,35 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lib.tally import get_tally, reconcile_tally
+
+from argparse import ArgumentParser
+from typing import Any
+
+class Command(BaseCommand):
+    help = "Compare the vote counts in settings.TALLY_FILE with the Choice table and fix them."
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--check', action='store_true', default=False,
+                            help="Only verify the counts. Exits with an error if any of them are wrong.")
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        tally = get_tally()
+        if tally is None:
+            raise CommandError("TALLY_FILE is not set")
+        consistent = tally.verify()
+        mismatches = reconcile_tally(tally, fix=not options['check'])
+        if not consistent:
+            self.stdout.write("The counts don't add up to the total in the header")
+        for oid in sorted(mismatches):
+            tally_count, actual_count = mismatches[oid]
+            self.stdout.write("option {}: tally {}, actual {}".format(oid, tally_count, actual_count))
+        if options['check'] and (mismatches or not consistent):
+            raise CommandError("{} vote counts are wrong".format(len(mismatches)))
+        elif options['check']:
+            self.stdout.write("All vote counts are correct")
+        else:
+            self.stdout.write("Fixed {} vote counts".format(len(mismatches)))
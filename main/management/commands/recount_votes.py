@@ -0,0 +1,39 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import Change
+from lib.changes import record_changes
+from lib.models import get_vote_count_mismatches, rebuild_vote_counts
+from lib.tally import get_tally, reconcile_tally
+
+from argparse import ArgumentParser
+from typing import Any
+
+class Command(BaseCommand):
+    help = "Rebuild the stored vote count of every option from the Choice table."
+
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--check', action='store_true', default=False,
+                            help="Only verify the stored counts. Exits with an error if any of them are wrong.")
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        if options['check']:
+            mismatches = get_vote_count_mismatches()
+        else:
+            mismatches = rebuild_vote_counts()
+            record_changes(Change.OPTION, sorted(mismatches))
+            tally = get_tally()
+            if tally is not None:
+                reconcile_tally(tally)
+        for oid in sorted(mismatches):
+            stored_count, actual_count = mismatches[oid]
+            self.stdout.write("option {}: stored {}, actual {}".format(oid, stored_count, actual_count))
+        if options['check'] and mismatches:
+            raise CommandError("{} vote counts are wrong".format(len(mismatches)))
+        elif options['check']:
+            self.stdout.write("All vote counts are correct")
+        else:
+            self.stdout.write("Fixed {} vote counts".format(len(mismatches)))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Choice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Option',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Question',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(blank=True, max_length=30)),
+                ('text', models.TextField()),
+                ('multivote', models.BooleanField(default=False)),
+                ('locked', models.BooleanField(default=False)),
+                ('show_count', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='option',
+            name='question',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Question'),
+        ),
+        migrations.AddField(
+            model_name='choice',
+            name='option',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Option'),
+        ),
+        migrations.AddField(
+            model_name='choice',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='option',
+            unique_together=set([('text', 'question')]),
+        ),
+    ]
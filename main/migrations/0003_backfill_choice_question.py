@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction
+from django.db.models import Count, Max, Min
+
+# Number of Choice ids handled in each transaction
+CHUNK_SIZE = 5000
+
+def remove_duplicate_choices(apps, schema_editor):
+    # Choices made twice by get_or_create races have to be removed before (user, option) is made unique
+    Choice = apps.get_model('main', 'Choice')
+    db_alias = schema_editor.connection.alias
+    duplicates = (Choice.objects.using(db_alias).values('user_id', 'option_id')
+                  .annotate(num=Count('id'), first_id=Min('id')).filter(num__gt=1))
+    for row in list(duplicates):
+        with transaction.atomic(using=db_alias):
+            Choice.objects.using(db_alias).filter(user_id=row['user_id'], option_id=row['option_id']).exclude(id=row['first_id']).delete()
+
+def backfill_choice_question(apps, schema_editor):
+    Choice = apps.get_model('main', 'Choice')
+    db_alias = schema_editor.connection.alias
+    max_id = Choice.objects.using(db_alias).aggregate(Max('id'))['id__max'] or 0
+    for start in range(0, max_id + 1, CHUNK_SIZE):
+        with transaction.atomic(using=db_alias):
+            rows = (Choice.objects.using(db_alias).filter(id__gte=start, id__lt=start + CHUNK_SIZE, question__isnull=True)
+                    .values_list('id', 'option__question_id'))
+            ids_by_question = {}
+            for choice_id, question_id in rows:
+                ids_by_question.setdefault(question_id, []).append(choice_id)
+            for question_id, choice_ids in ids_by_question.items():
+                Choice.objects.using(db_alias).filter(id__in=choice_ids).update(question_id=question_id)
+
+
+class Migration(migrations.Migration):
+
+    # every chunk is committed separately, so that a large table is not locked for the whole migration
+    atomic = False
+
+    dependencies = [
+        ('main', '0002_choice_question'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_choices, migrations.RunPython.noop),
+        migrations.RunPython(backfill_choice_question, migrations.RunPython.noop),
+    ]
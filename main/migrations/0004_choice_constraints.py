@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+import django.db.models.deletion
+
+def finish_backfill(apps, schema_editor):
+    # Choices made by the old code while 0003 ran are handled here, after it has been stopped
+    Choice = apps.get_model('main', 'Choice')
+    Option = apps.get_model('main', 'Option')
+    db_alias = schema_editor.connection.alias
+    duplicates = (Choice.objects.using(db_alias).values('user_id', 'option_id')
+                  .annotate(num=Count('id'), first_id=Min('id')).filter(num__gt=1))
+    for row in list(duplicates):
+        Choice.objects.using(db_alias).filter(user_id=row['user_id'], option_id=row['option_id']).exclude(id=row['first_id']).delete()
+    qn = schema_editor.quote_name
+    schema_editor.execute("UPDATE {choice} SET {question_id} = (SELECT {option}.{question_id} FROM {option} "
+                          "WHERE {option}.{id} = {choice}.{option_id}) WHERE {question_id} IS NULL".format(
+                              choice=qn(Choice._meta.db_table), option=qn(Option._meta.db_table),
+                              question_id=qn('question_id'), option_id=qn('option_id'), id=qn('id')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0003_backfill_choice_question'),
+    ]
+
+    operations = [
+        migrations.RunPython(finish_backfill, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='choice',
+            name='question',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to='main.Question'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='choice',
+            unique_together=set([('user', 'option')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='choice',
+            index_together=set([('user', 'question')]),
+        ),
+    ]
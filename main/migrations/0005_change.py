@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+def record_existing_objects(apps, schema_editor):
+    # Log every existing question and option, so that changes since version 0 include all of them
+    Question = apps.get_model('main', 'Question')
+    Option = apps.get_model('main', 'Option')
+    Change = apps.get_model('main', 'Change')
+    db_alias = schema_editor.connection.alias
+    for model, kind in ((Question, 'question'), (Option, 'option')):
+        Change.objects.using(db_alias).bulk_create([Change(kind=kind, object_id=object_id)
+                                                    for object_id in model.objects.using(db_alias).order_by('id').values_list('id', flat=True).iterator()])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_choice_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('question', 'Question'), ('option', 'Option')], max_length=10)),
+                ('object_id', models.IntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.RunPython(record_existing_objects, migrations.RunPython.noop),
+    ]
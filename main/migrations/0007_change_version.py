@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+def set_versions(apps, schema_editor):
+    # Existing changes keep their ids as versions, and the counter continues from the last one
+    Change = apps.get_model('main', 'Change')
+    ChangeCounter = apps.get_model('main', 'ChangeCounter')
+    db_alias = schema_editor.connection.alias
+    Change.objects.using(db_alias).update(version=F('id'))
+    last_id = Change.objects.using(db_alias).aggregate(Max('id'))['id__max'] or 0
+    ChangeCounter.objects.using(db_alias).create(id=1, version=last_id)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_api_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='version',
+            field=models.BigIntegerField(db_index=True, default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_versions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+def count_votes(apps, schema_editor):
+    Option = apps.get_model('main', 'Option')
+    Choice = apps.get_model('main', 'Choice')
+    qn = schema_editor.quote_name
+    schema_editor.execute("UPDATE {option} SET {num_votes} = (SELECT COUNT(*) FROM {choice} "
+                          "WHERE {choice}.{option_id} = {option}.{id})".format(
+                              option=qn(Option._meta.db_table), choice=qn(Choice._meta.db_table),
+                              num_votes=qn('num_votes'), option_id=qn('option_id'), id=qn('id')))
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_change_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='option',
+            name='num_votes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_votes, migrations.RunPython.noop),
+    ]
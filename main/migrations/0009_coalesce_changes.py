@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Max
+import django.utils.timezone
+
+def coalesce_changes(apps, schema_editor):
+    # Versions become the ids of the changes, so clients which have synced before have to
+    # fetch all the data again. The last change is kept, since MySQL may reuse the ids of
+    # deleted rows at the end of a table.
+    Change = apps.get_model('main', 'Change')
+    PrunedVersion = apps.get_model('main', 'PrunedVersion')
+    db_alias = schema_editor.connection.alias
+    last_id = Change.objects.using(db_alias).aggregate(Max('id'))['id__max'] or 0
+    Change.objects.using(db_alias).filter(id__lt=last_id).delete()
+    PrunedVersion.objects.using(db_alias).create(id=1, version=last_id)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_option_num_votes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrunedVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(coalesce_changes, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='change',
+            name='version',
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='created',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AlterIndexTogether(
+            name='change',
+            index_together=set([('kind', 'object_id')]),
+        ),
+        migrations.RenameModel(
+            old_name='ChangeCounter',
+            new_name='TallyFence',
+        ),
+    ]
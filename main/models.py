@@ -2,9 +2,11 @@ from __future__ import unicode_literals
 
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
+from datetime import datetime
 from six import text_type, python_2_unicode_compatible
-from typing import Tuple
+from typing import Any, Optional, Tuple
 
 @python_2_unicode_compatible
 class Question(models.Model):
@@ -24,10 +26,20 @@ class Option(models.Model):
     serialize_order = ('text', 'question_id') # type: Tuple[text_type, ...]
     text = models.CharField(max_length=100) # type: text_type
     question = models.ForeignKey(Question) # type: Question
+    # denormalized count of Choice rows for this option, maintained by lib.actions
+    num_votes = models.IntegerField(default=0) # type: int
 
     class Meta(object):
         unique_together = ('text', 'question') # type: Tuple[text_type, ...]
 
+    def save(self, *args, **kwargs):
+        # type: (*Any, **Any) -> None
+        adding = self._state.adding
+        super(Option, self).save(*args, **kwargs)
+        if not adding:
+            # keep Choice.question in sync in case the option was moved to another question
+            Choice.objects.filter(option_id=self.id).exclude(question_id=self.question_id).update(question_id=self.question_id)
+
     def __str__(self):
         # type: () -> str
         return self.text # type: ignore
@@ -37,12 +49,77 @@ class Option(models.Model):
 class Choice(models.Model):
     user = models.ForeignKey(User) # type: User
     option = models.ForeignKey(Option) # type: Option
+    # denormalized option.question, so that a user's choices for a question can be found without a join
+    question = models.ForeignKey(Question, editable=False) # type: Question
+
+    class Meta(object):
+        unique_together = ('user', 'option') # type: Tuple[text_type, ...]
+        index_together = ('user', 'question') # type: Tuple[text_type, ...]
+
+    def save(self, *args, **kwargs):
+        # type: (*Any, **Any) -> None
+        self.question_id = self.option.question_id
+        super(Choice, self).save(*args, **kwargs)
 
     def get_question(self):
         # type: () -> Question
-        return self.option.question
+        return self.question
 
     def __str__(self):
         # type: () -> str
+        # ids are used so that listing many choices doesn't fetch their related objects
         format_str = "Choice(user={user}, option={option}, ques={ques})"
-        return format_str.format(user=self.user, option=self.option, ques=self.option.question) # type: ignore
+        return format_str.format(user=self.user_id, option=self.option_id, ques=self.question_id) # type: ignore
+
+@python_2_unicode_compatible
+class Change(models.Model):
+    """
+    The last change to a question or option (including its vote count), used by /api/changes/.
+    A new change replaces the previous one of the same object, and its id is the version
+    number of the data after the change (see lib.changes).
+    """
+    QUESTION = 'question'
+    OPTION = 'option'
+    KIND_CHOICES = ((QUESTION, 'Question'), (OPTION, 'Option'))
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES) # type: text_type
+    object_id = models.IntegerField() # type: int
+    deleted = models.BooleanField(default=False) # type: bool
+    created = models.DateTimeField(default=timezone.now, db_index=True) # type: datetime
+
+    class Meta:
+        index_together = [('kind', 'object_id')]
+
+    def __str__(self):
+        # type: () -> str
+        return "{}({}, {}{})".format(self.id, self.kind, self.object_id, ", deleted" if self.deleted else "") # type: ignore
+
+class PrunedVersion(models.Model):
+    """
+    A single row holding the highest version of the changes deleted by lib.changes.prune_changes.
+    """
+    version = models.BigIntegerField(default=0) # type: int
+
+class TallyFence(models.Model):
+    """
+    A single row holding the last fence given out by lib.tally.reserve_fence. Transactions
+    which add votes update it, which locks it until they end, so fences are in the order of commits.
+    """
+    version = models.BigIntegerField(default=0) # type: int
+
+@python_2_unicode_compatible
+class ApiToken(models.Model):
+    """
+    A token with which a user can authenticate to the API (see lib.tokens).
+    Only the SHA-256 digest of the token is stored.
+    """
+    user = models.ForeignKey(User) # type: User
+    digest = models.CharField(max_length=64, unique=True) # type: text_type
+    created = models.DateTimeField(auto_now_add=True) # type: datetime
+    # None means that the token never expires
+    expires = models.DateTimeField(null=True, blank=True) # type: Optional[datetime]
+    revoked = models.BooleanField(default=False) # type: bool
+
+    def __str__(self):
+        # type: () -> str
+        return "ApiToken(user={}, created={})".format(self.user, self.created) # type: ignore
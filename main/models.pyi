@@ -1,8 +1,9 @@
 from django.db import models
 from django.contrib.auth.models import User
 
+from datetime import datetime
 from six import text_type
-from typing import Any, Tuple
+from typing import Any, Optional, Tuple
 from lib.id_types import QuestionId, OptionId, ChoiceId, UserId
 
 class Question(models.Model):
@@ -28,6 +29,7 @@ class Option(models.Model):
     serialize_order = ... # type: Tuple[text_type, ...]
     text = ... # type: text_type
     question = ... # type: Question
+    num_votes = ... # type: int
 
     id = ... # type: OptionId
     question_id = ... # type: QuestionId
@@ -37,15 +39,21 @@ class Option(models.Model):
         # type: (**Any) -> None
         ...
 
+    def save(self, *args, **kwargs):
+        # type: (*Any, **Any) -> None
+        ...
+
     def __str__(self) -> str: ...
     def __unicode__(self) -> text_type: ...
 
 class Choice(models.Model):
     user = ... # type: User
     option = ... # type: Option
+    question = ... # type: Question
 
     user_id = ... # type: UserId
     option_id = ... # type: OptionId
+    question_id = ... # type: QuestionId
     user_set = ... # type: models.Manager[User]
     option_set = ... # type: models.Manager[Option]
     id = ... # type: ChoiceId
@@ -55,6 +63,45 @@ class Choice(models.Model):
         # type: (**Any) -> None
         ...
 
+    def save(self, *args, **kwargs):
+        # type: (*Any, **Any) -> None
+        ...
+
     def get_question(self) -> Question: ...
     def __str__(self) -> str: ...
     def __unicode__(self) -> text_type: ...
+
+class Change(models.Model):
+    QUESTION = ... # type: text_type
+    OPTION = ... # type: text_type
+    kind = ... # type: text_type
+    object_id = ... # type: int
+    deleted = ... # type: bool
+
+    id = ... # type: int
+    objects = ... # type: models.Manager[Change]
+
+    def __init__(self, **kwargs):
+        # type: (**Any) -> None
+        ...
+
+    def __str__(self) -> str: ...
+    def __unicode__(self) -> text_type: ...
+
+class ApiToken(models.Model):
+    user = ... # type: User
+    digest = ... # type: text_type
+    created = ... # type: datetime
+    expires = ... # type: Optional[datetime]
+    revoked = ... # type: bool
+
+    id = ... # type: int
+    user_id = ... # type: int
+    objects = ... # type: models.Manager[ApiToken]
+
+    def __init__(self, **kwargs):
+        # type: (**Any) -> None
+        ...
+
+    def __str__(self) -> str: ...
+    def __unicode__(self) -> text_type: ...
@@ -2,29 +2,57 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.db import connection, connections, transaction, IntegrityError, OperationalError
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import caches
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.utils.http import http_date
 
 import os
 import json
+import pstats
+from base64 import b64encode
+from datetime import timedelta
+import shutil
 import six
-
-from main.models import Question, Option, Choice
-from lib.actions import choose, unchoose
-from lib.models import vote_count, question_to_dict
-
-from lib import populate
+import tempfile
+import threading
+import time
+
+from main.models import Question, Option, Choice, Change, TallyFence, ApiToken
+from project_conf.settings import cached_auth
+from lib.actions import choose, unchoose, apply_ballot, update_questions
+from lib.models import vote_count, question_to_dict, get_vote_count_mismatches
+from lib import models as lib_models
+
+from lib import actions, codec, export, metrics, option_meta, pagination, populate, profiling, replicas, tally
+from lib.cache import get_payload_version, bump_data_versions, QUESTIONS
+from lib.changes import get_version_range, record_changes
+from lib.events import LocalBroker, EventStream, get_broker
 from lib.exceptions import BadDataError
-from lib.response import get_response_str
-from lib.testing import encode_data, do_test_login, do_test_basic_auth, do_logout, do_test_register, do_test_vote
+from lib.lru import LRUCache
+from lib.option_meta import get_options_meta, OptionMeta, OptionMetaCache
+from lib.sqlite import configure_connection, retry_on_locked
+from lib.request import get_auth_cache
+from lib.response import get_response_str, iter_json, JSONArray, JSONObject
+from lib.testing import send_request, encode_data, do_test_login, do_test_basic_auth, do_logout, do_test_register, do_test_vote
 from lib.textutil import force_text, force_str
+from lib.tokens import create_token, get_token_cache
+from lib.vote_queue import get_vote_queue, process_batch, VoteQueue
 
 from six import text_type
+from typing import Any, Dict, List, Optional, Set
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 TEST_DATA_FILE = os.path.join(BASE_DIR, "lib", "test_data.json")
 TEST_QLIST = json.load(open(TEST_DATA_FILE))
 FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+CACHED_AUTH_SETTINGS = {name: getattr(cached_auth, name) for name in dir(cached_auth) if name.isupper()}
 
 s_fav_fruit = "मनपसंद फल?"
 s_anaar = "अनार"
@@ -130,6 +158,30 @@ class TestTesting(TestCase):
         res3 = force_text(json.dumps(l3))
         self.assertEqual(encode_data(l3, "application/json"), res3)
 
+class TestLRUCache(TestCase):
+    def test_eviction(self):
+        # type: () -> None
+        cache = LRUCache(2, 10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        # type: () -> None
+        now = [100.0]
+        cache = LRUCache(2, 10, timer=lambda: now[0])
+        cache.set('a', 1)
+        now[0] += 9
+        self.assertEqual(cache.get('a'), 1)
+        now[0] += 1
+        self.assertEqual(cache.get('a', 0), 0)
+        self.assertEqual(len(cache), 0)
+
 class TestModels(TestCase):
     def test_question_str(self):
         # type: () -> None
@@ -167,6 +219,84 @@ class TestModels(TestCase):
 
         self.assertEqual(question_to_dict(q), qdict)
 
+    def test_iter_chunks(self):
+        # type: () -> None
+        populate.add_qlist(TEST_QLIST * 2)
+        expected = (lib_models.all_ques_data(), lib_models.questions_data(), lib_models.options_data())
+        old_chunk_size = lib_models.ITER_CHUNK_SIZE
+        try:
+            # two queries for each chunk of two questions, and one which finds no more questions
+            lib_models.ITER_CHUNK_SIZE = 2
+            with self.assertNumQueries(2 * len(TEST_QLIST) + 1):
+                self.assertEqual(lib_models.all_ques_data(), expected[0])
+            self.assertEqual(lib_models.questions_data(), expected[1])
+            self.assertEqual(lib_models.options_data(), expected[2])
+            qids = Question.objects.filter(title="Text Editor").values('id')
+            self.assertEqual(len(list(lib_models.iter_questions_data(qids))), 2)
+        finally:
+            lib_models.ITER_CHUNK_SIZE = old_chunk_size
+
+class TestPopulate(TestCase):
+    def test_iter_json_array(self):
+        # type: () -> None
+        text = json.dumps(TEST_QLIST, indent=2)
+        for chunk_size in (1, 7, 65536):
+            self.assertEqual(list(populate.iter_json_array(six.StringIO(text), chunk_size)), TEST_QLIST)
+        self.assertEqual(list(populate.iter_json_array(six.StringIO(" [ ] "))), [])
+        self.assertEqual(list(populate.iter_json_array(six.StringIO("[12, 345]"), 2)), [12, 345])
+        for text in ("", "{}", "[1, 2", "[1 2]", "[1,, 2]", '[{"a": 1}'):
+            with self.assertRaises(BadDataError):
+                list(populate.iter_json_array(six.StringIO(text), 3))
+
+    def test_import(self):
+        # type: () -> None
+        num_options = sum(len(qdict["options"]) for qdict in TEST_QLIST)
+        # three queries for each question (including replacing its change log entry), four for
+        # the options and their change log entries and two for the savepoint
+        with self.assertNumQueries(3 * len(TEST_QLIST) + 6):
+            self.assertEqual(populate.import_questions(TEST_QLIST), (len(TEST_QLIST), num_options))
+        self.assertEqual([question_to_dict(q) for q in Question.objects.order_by('id')], TEST_QLIST)
+        Question.objects.all().delete()
+        self.assertEqual(populate.import_questions(TEST_QLIST, batch_size=3), (len(TEST_QLIST), num_options))
+        self.assertEqual([question_to_dict(q) for q in Question.objects.order_by('id')], TEST_QLIST)
+        many_options = {"text": "Many options?", "options": [text_type(i) for i in range(2000)]}
+        self.assertEqual(populate.import_questions([many_options]), (1, 2000))
+
+    def test_invalid_import(self):
+        # type: () -> None
+        bad_qdicts = [
+            "question",
+            {"options": ["a"]},
+            {"text": "Q?", "options": "ab"},
+            {"text": "Q?", "options": ["a", "a"]},
+            {"text": "Q?", "options": ["a", 1]},
+            {"text": "Q?", "options": ["a"], "locked": "yes"},
+            {"text": "Q?", "options": ["a"], "title": "x" * 100},
+        ]
+        for qdict in bad_qdicts:
+            with self.assertRaises(BadDataError):
+                populate.import_questions(TEST_QLIST + [qdict])
+            self.assertEqual(Question.objects.count(), 0)
+            self.assertEqual(Option.objects.count(), 0)
+
+    def test_upsert(self):
+        # type: () -> None
+        populate.add_qlist(TEST_QLIST)
+        oids = set(Option.objects.values_list('id', flat=True))
+        qlist = [dict(qdict) for qdict in TEST_QLIST]
+        qlist[0]["locked"] = not qlist[0].get("locked", False)
+        qlist[0]["options"] = qlist[0]["options"] + ["New option"]
+        qlist.append({"title": "", "text": "New question?", "multivote": False, "locked": False,
+                      "show_count": True, "options": ["Yes", "No"]})
+        self.assertEqual(populate.import_questions(qlist, upsert=True), (1, 3))
+        self.assertEqual(Question.objects.count(), len(TEST_QLIST) + 1)
+        self.assertTrue(oids.issubset(Option.objects.values_list('id', flat=True)))
+        self.assertEqual([question_to_dict(q) for q in Question.objects.order_by('id')], qlist)
+        self.assertEqual(populate.import_questions(qlist, upsert=True), (0, 0))
+        # a question which is given twice gets every new option once
+        repeated = {"text": "Repeated?", "options": ["Yes", "No"]}
+        self.assertEqual(populate.import_questions([repeated, dict(repeated, options=["No", "Maybe"])], upsert=True), (1, 3))
+
 class TestChoosing(TestCase):
     def setUp(self):
         # type: () -> None
@@ -395,6 +525,197 @@ class TestChoosing(TestCase):
         self.assertEqual(vote_count(sublime), 0)
         self.assertEqual(vote_count(windows), 0)
 
+    def test_stored_counts(self):
+        # type: () -> None
+        u1 = User.objects.get(username='user1')
+        u2 = User.objects.get(username='user2')
+        qos = Question.objects.get(title="Operating System")
+        linux = Option.objects.get(question=qos, text="Linux")
+        windows = Option.objects.get(question=qos, text="Windows")
+        vim = Option.objects.get(text="Vim")
+
+        choose(u1, linux)
+        choose(u2, linux)
+        choose(u1, vim)
+        choose(u1, vim)
+        # switching a non-multivote question moves the vote
+        choose(u2, windows)
+        unchoose(u1, vim)
+        unchoose(u1, vim)
+
+        self.assertEqual(Option.objects.get(id=linux.id).num_votes, 1)
+        self.assertEqual(Option.objects.get(id=windows.id).num_votes, 1)
+        self.assertEqual(Option.objects.get(id=vim.id).num_votes, 0)
+        self.assertEqual(get_vote_count_mismatches(), {})
+
+    def test_cascade_deletes(self):
+        # type: () -> None
+        u1 = User.objects.get(username='user1')
+        u2 = User.objects.get(username='user2')
+        linux = Option.objects.get(text="Linux")
+        vim = Option.objects.get(text="Vim")
+        choose(u1, linux)
+        choose(u2, linux)
+        choose(u1, vim)
+        version = get_payload_version('options')
+        u1.delete()
+        self.assertEqual(Option.objects.get(id=linux.id).num_votes, 1)
+        self.assertEqual(Option.objects.get(id=vim.id).num_votes, 0)
+        self.assertNotEqual(get_payload_version('options'), version)
+        # deleting users in bulk (as the admin does) deletes them one by one
+        User.objects.filter(id=u2.id).delete()
+        self.assertEqual(Option.objects.get(id=linux.id).num_votes, 0)
+        self.assertEqual(get_vote_count_mismatches(), {})
+
+    def test_recount_votes_command(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        vim = Option.objects.get(text="Vim")
+        linux = Option.objects.get(text="Linux")
+        choose(user, vim)
+        choose(user, linux)
+        Option.objects.filter(id=vim.id).update(num_votes=5)
+        Option.objects.filter(id=linux.id).update(num_votes=0)
+        self.assertEqual(get_vote_count_mismatches(), {vim.id: (5, 1), linux.id: (0, 1)})
+
+        out = six.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('recount_votes', check=True, stdout=out)
+        call_command('recount_votes', stdout=out)
+        call_command('recount_votes', check=True, stdout=out)
+        self.assertEqual(get_vote_count_mismatches(), {})
+        self.assertEqual(Option.objects.get(id=vim.id).num_votes, 1)
+
+    def test_apply_ballot(self):
+        # type: () -> None
+        u1 = User.objects.get(username='user1')
+        u2 = User.objects.get(username='user2')
+        oids = {option.text: option.id for option in Option.objects.all()}
+        ballots = [
+            (["Vim", "Atom", "Windows"], []),
+            (["Linux", "Mac", "Sublime"], ["Atom"]),
+            (["Windows"], ["Vim", "Mac", "Other"]),
+            (["Vim", "Sublime", "Atom", "Linux"], ["Windows"]),
+        ]
+        for choose_strs, unchoose_strs in ballots:
+            choose_oids = [oids[text] for text in choose_strs]
+            unchoose_oids = [oids[text] for text in unchoose_strs]
+            options = get_options_meta(choose_oids + unchoose_oids)
+            apply_ballot(u1, options, choose_oids, unchoose_oids)
+            for oid in choose_oids:
+                choose(u2, Option.objects.get(id=oid))
+            for oid in unchoose_oids:
+                unchoose(u2, Option.objects.get(id=oid))
+            chosen1 = set(Choice.objects.filter(user=u1).values_list('option_id', flat=True))
+            chosen2 = set(Choice.objects.filter(user=u2).values_list('option_id', flat=True))
+            self.assertEqual(chosen1, chosen2)
+        self.assertEqual(get_vote_count_mismatches(), {})
+        for choice in Choice.objects.select_related('option'):
+            self.assertEqual(choice.question_id, choice.option.question_id)
+
+    def test_apply_ballot_conflict(self):
+        # type: () -> None
+        # an option chosen by another writer after the ballot read the user's choices is skipped
+        user = User.objects.get(username='user1')
+        vim = Option.objects.get(text="Vim")
+        atom = Option.objects.get(text="Atom")
+        get_ballot_result = actions.get_ballot_result
+
+        def get_ballot_result_with_conflict(*args):
+            # type: (*Any) -> Set[int]
+            Choice.objects.create(user=user, option=vim)
+            Option.objects.filter(id=vim.id).update(num_votes=F('num_votes') + 1)
+            return get_ballot_result(*args)
+
+        actions.get_ballot_result = get_ballot_result_with_conflict
+        try:
+            apply_ballot(user, get_options_meta([vim.id, atom.id]), [vim.id, atom.id], [])
+        finally:
+            actions.get_ballot_result = get_ballot_result
+        self.assertEqual(set(Choice.objects.filter(user=user).values_list('option_id', flat=True)), {vim.id, atom.id})
+        self.assertEqual(get_vote_count_mismatches(), {})
+
+    def test_choice_question(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        linux = Option.objects.get(text="Linux")
+        vim = Option.objects.get(text="Vim")
+        choose(user, linux)
+        choice = Choice.objects.get(user=user)
+        self.assertEqual(choice.question_id, linux.question_id)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Choice.objects.create(user=user, option=linux)
+        # choosing an already chosen option and the non-multivote cleanup need no joins
+        windows = Option.objects.get(text="Windows")
+        get_options_meta([windows.id])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(choose(user, linux))
+            self.assertTrue(choose(user, windows))
+        self.assertFalse([query for query in queries if 'JOIN' in query['sql']])
+        self.assertEqual(set(Choice.objects.filter(user=user).values_list('option__text', flat=True)), {"Windows"})
+        choose(user, linux)
+        linux.question = vim.question
+        linux.save()
+        self.assertEqual(Choice.objects.get(user=user, option=linux).question_id, vim.question_id)
+
+        # the question id in the cached metadata is not used, as the option may have been moved by another process
+        choose(user, windows)
+        mac = Option.objects.get(text="Mac")
+        get_options_meta([mac.id])
+        qnew = Question.objects.create(title="New", text="New?")
+        Option.objects.filter(id=mac.id).update(question=qnew)
+        self.assertTrue(choose(user, Option.objects.get(id=mac.id)))
+        self.assertEqual(Choice.objects.get(user=user, option=mac).question_id, qnew.id)
+        self.assertTrue(Choice.objects.filter(user=user, option=windows).exists())
+
+class TestOptionMeta(TestCase):
+    def setUp(self):
+        # type: () -> None
+        caches['default'].clear()
+        populate.add_qlist(TEST_QLIST)
+
+    def test_option_meta_cache(self):
+        # type: () -> None
+        now = [0.0]
+        meta_cache = OptionMetaCache(timer=lambda: now[0])
+        vim = Option.objects.get(text="Vim")
+        qed = vim.question
+        self.assertEqual(meta_cache.get_many([vim.id, 0]), {vim.id: OptionMeta(qed.id, False, True, False)})
+        with self.assertNumQueries(0):
+            self.assertFalse(meta_cache.get_many([vim.id])[vim.id].locked)
+
+        # a change made by another process is noticed when the shared version is checked
+        Question.objects.filter(id=qed.id).update(locked=True)
+        bump_data_versions(QUESTIONS)
+        now[0] = 0.5
+        self.assertFalse(meta_cache.get_many([vim.id])[vim.id].locked)
+        now[0] = 1.0
+        self.assertTrue(meta_cache.get_many([vim.id])[vim.id].locked)
+
+        # a change which doesn't bump the version is noticed when the cache expires
+        Question.objects.filter(id=qed.id).update(locked=False)
+        now[0] = 30.0
+        self.assertTrue(meta_cache.get_many([vim.id])[vim.id].locked)
+        now[0] = 31.0
+        self.assertFalse(meta_cache.get_many([vim.id])[vim.id].locked)
+
+        with self.settings(OPTION_META_MAX_AGE=0):
+            with self.assertNumQueries(1):
+                meta_cache.get_many([vim.id])
+
+    def test_local_changes(self):
+        # type: () -> None
+        user = User.objects.create_user('user1', password='pass1')
+        vim = Option.objects.get(text="Vim")
+        self.assertTrue(choose(user, vim))
+        qed = vim.question
+        qed.locked = True
+        qed.save()
+        self.assertIsNone(unchoose(user, vim))
+        update_questions([qed.id], locked=False)
+        self.assertTrue(unchoose(user, vim))
+
 class TestAuth(TestCase):
     def setUp(self):
         # type: () -> None
@@ -425,6 +746,95 @@ class TestAuth(TestCase):
         do_test_basic_auth(self, 'user1', 'pass1', 401, separator='**')
         do_test_basic_auth(self, s_anaar, 'pass1', 401, separator='**')
 
+    def test_basic_auth_cache(self):
+        # type: () -> None
+        get_auth_cache().clear()
+        do_test_basic_auth(self, 'user1', 'pass1', 200, "[]")
+        self.assertEqual(len(get_auth_cache()), 1)
+        do_test_basic_auth(self, 'user1', 'pass1', 200, "[]")
+        do_test_basic_auth(self, 'user1', 'pass2', 401, "wrong_login")
+        self.assertEqual(len(get_auth_cache()), 1)
+
+        user = User.objects.get(username='user1')
+        user.is_active = False
+        user.save()
+        do_test_basic_auth(self, 'user1', 'pass1', 403, "inactive")
+        user.is_active = True
+        user.set_password('pass3')
+        user.save()
+        do_test_basic_auth(self, 'user1', 'pass1', 401, "wrong_login")
+        do_test_basic_auth(self, 'user1', 'pass3', 200, "[]")
+
+        # entries are keyed by a digest of the header, not by the credentials
+        for key in get_auth_cache().data:
+            self.assertNotIn('pass3', key)
+
+    def test_api_tokens(self):
+        # type: () -> None
+        get_token_cache().clear()
+        self.assertEqual(self.client.post('/api/tokens/', {"username": "user1", "password": "pass2"}).status_code, 401)
+        self.assertEqual(get_response_str(self.client.post('/api/tokens/', {"username": "user2", "password": "pass2"})),
+                         "inactive")
+        response = self.client.post('/api/tokens/', {"username": "user1", "password": "pass1"})
+        self.assertEqual(response.status_code, 201)
+        token = json.loads(get_response_str(response))["token"]
+        self.assertIsNotNone(json.loads(get_response_str(response))["expires"])
+        self.assertFalse(ApiToken.objects.filter(digest=token).exists())
+
+        auth_header = "Bearer " + token
+        response = self.client.get('/api/my-choices/', HTTP_AUTHORIZATION=auth_header)
+        self.assertEqual(get_response_str(response), "[]")
+        # the token is looked up in the cache, so only the user is fetched
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/my-choices/', HTTP_AUTHORIZATION=auth_header)
+        for query in queries:
+            self.assertNotIn('main_apitoken', query['sql'])
+        response = self.client.get('/api/my-choices/', HTTP_AUTHORIZATION="Bearer x" + token)
+        self.assertEqual((response.status_code, get_response_str(response)), (401, "invalid_token"))
+
+        ApiToken.objects.update(expires=timezone.now() - timedelta(seconds=1))
+        get_token_cache().clear()
+        self.assertEqual(self.client.get('/api/my-choices/', HTTP_AUTHORIZATION=auth_header).status_code, 401)
+
+        token2 = json.loads(get_response_str(self.client.post('/api/tokens/', {"username": "user1", "password": "pass1"})))["token"]
+        token3 = json.loads(get_response_str(self.client.post('/api/tokens/', {"username": "user1", "password": "pass1"})))["token"]
+        for token in (token2, token3):
+            self.assertEqual(self.client.get('/api/my-choices/', HTTP_AUTHORIZATION="Bearer " + token).status_code, 200)
+        response = self.client.post('/api/tokens/revoke/', HTTP_AUTHORIZATION="Bearer " + token2)
+        self.assertEqual(get_response_str(response), "revoked")
+        self.assertEqual(self.client.get('/api/my-choices/', HTTP_AUTHORIZATION="Bearer " + token2).status_code, 401)
+        self.assertEqual(self.client.get('/api/my-choices/', HTTP_AUTHORIZATION="Bearer " + token3).status_code, 200)
+        self.client.post('/api/tokens/revoke/', HTTP_AUTHORIZATION="Basic " + b64encode(b"user1:pass1").decode('ascii'))
+        self.assertEqual(self.client.get('/api/my-choices/', HTTP_AUTHORIZATION="Bearer " + token3).status_code, 401)
+
+    def test_cached_session_auth(self):
+        # type: () -> None
+        caches['default'].clear()
+        with self.settings(**CACHED_AUTH_SETTINGS):
+            response = self.client.post('/api/login/', {"username": "user1", "password": "pass1"})
+            self.assertEqual(get_response_str(response), "success")
+            self.client.get('/api/my-choices/')
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/my-choices/')
+            self.assertEqual(response.status_code, 200)
+            for query in queries:
+                self.assertNotIn('auth_user', query['sql'])
+                self.assertNotIn('django_session', query['sql'])
+
+            user = User.objects.get(username='user1')
+            user.is_active = False
+            user.save()
+            self.assertEqual(get_response_str(self.client.get('/api/my-choices/')), "inactive")
+            user.is_active = True
+            user.set_password('pass3')
+            user.save()
+            # changing the password ends the user's sessions
+            self.assertEqual(self.client.get('/api/my-choices/').status_code, 401)
+
+            self.client.post('/api/login/', {"username": "user1", "password": "pass3"})
+            self.assertEqual(self.client.get('/api/my-choices/').status_code, 200)
+            do_logout(self)
+
     def test_login_success(self):
         # type: () -> None
         do_test_login(self, 'user1', 'pass1', 200, 200, FORM_CONTENT_TYPE, 'success')
@@ -547,6 +957,86 @@ class TestApiViews(TestCase):
         file_dict = json.load(open(TEST_DATA_FILE))
         self.assertEqual(response_dict, file_dict)
 
+    def test_changes(self):
+        # type: () -> None
+        with self.settings(CHANGE_LOG_COMMIT_MARGIN=0):
+            response = self.client.get('/api/changes/')
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(get_response_str(response))
+            self.assertEqual(len(data["questions"]), Question.objects.count())
+            self.assertEqual(len(data["options"]), Option.objects.count())
+            version = data["version"]
+
+            data = json.loads(get_response_str(self.client.get('/api/changes/?since={}'.format(version))))
+            self.assertEqual((data["version"], data["questions"], data["options"]), (version, {}, {}))
+
+            anaar = Option.objects.get(text=s_anaar)
+            choose(User.objects.get(username='user1'), anaar)
+            linux = Option.objects.get(text="Linux")
+            linux_id = linux.id
+            linux.delete()
+            qed = Question.objects.get(title="Text Editor")
+            qed.locked = True
+            qed.save()
+            data = json.loads(get_response_str(self.client.get('/api/changes/?since={}'.format(version))))
+            self.assertGreater(data["version"], version)
+            self.assertEqual(list(data["questions"]), [text_type(qed.id)])
+            self.assertTrue(data["questions"][text_type(qed.id)]["locked"])
+            changed_oids = list(qed.option_set.values_list('id', flat=True)) + [anaar.id]
+            self.assertEqual(set(data["options"]), set(text_type(oid) for oid in changed_oids))
+            self.assertEqual(data["options"][text_type(anaar.id)]["count"], 1)
+            self.assertEqual(data["deleted"], {"questions": [], "options": [linux_id]})
+
+    def test_changes_resync(self):
+        # type: () -> None
+        self.assertEqual(self.client.get('/api/changes/?since=abc').status_code, 400)
+        with self.settings(CHANGE_LOG_COMMIT_MARGIN=0):
+            old_version = json.loads(get_response_str(self.client.get('/api/changes/')))["version"]
+            response = self.client.get('/api/changes/?since={}'.format(old_version + 1))
+            self.assertEqual(response.status_code, 410)
+            linux = Option.objects.get(text="Linux")
+            linux_id = linux.id
+            linux.delete()
+            deleted_version = Change.objects.get(kind=Change.OPTION, object_id=linux_id).id
+            choose(User.objects.get(username='user1'), Option.objects.get(text="Vim"))
+            call_command('prune_changes', days=0, stdout=six.StringIO())
+            self.assertFalse(Change.objects.filter(kind=Change.OPTION, object_id=linux_id).exists())
+            pruned_version, version = get_version_range()
+            self.assertEqual(pruned_version, deleted_version)
+            for since in (0, old_version):
+                response = self.client.get('/api/changes/?since={}'.format(since))
+                self.assertEqual(response.status_code, 410)
+                self.assertEqual(json.loads(get_response_str(response)), {"error": "resync_required", "version": version})
+            self.assertEqual(self.client.get('/api/changes/?since={}'.format(version)).status_code, 200)
+
+            # the entries of deleted objects are also removed when something else is deleted
+            Option.objects.get(text="Vim").delete()
+            anaar = Option.objects.get(text=s_anaar)
+            anaar_id = anaar.id
+            with self.settings(CHANGE_LOG_RETENTION_DAYS=0):
+                anaar.delete()
+            self.assertEqual(list(Change.objects.filter(deleted=True).values_list('object_id', flat=True)), [anaar_id])
+
+    def test_changes_commit_margin(self):
+        # type: () -> None
+        with self.settings(CHANGE_LOG_COMMIT_MARGIN=0):
+            version = json.loads(get_response_str(self.client.get('/api/changes/')))["version"]
+        anaar = Option.objects.get(text=s_anaar)
+        choose(User.objects.get(username='user1'), anaar)
+        # a recent change is sent again, since one made before it may not have been committed yet
+        for i in range(2):
+            data = json.loads(get_response_str(self.client.get('/api/changes/?since={}'.format(version))))
+            self.assertEqual(data["version"], version)
+            self.assertEqual(list(data["options"]), [text_type(anaar.id)])
+
+    def test_change_coalescing(self):
+        # type: () -> None
+        record_changes(Change.OPTION, [1, 2, 3])
+        record_changes(Change.OPTION, [2, 2])
+        changes = Change.objects.filter(kind=Change.OPTION, object_id__in=[1, 2, 3]).order_by('id')
+        self.assertEqual(list(changes.values_list('object_id', flat=True)), [1, 3, 2])
+        self.assertEqual(changes.last().id, Change.objects.latest('id').id)
+
     def test_my_choices_unauthed(self):
         # type: () -> None
         response = self.client.get('/api/my-choices/')
@@ -613,6 +1103,69 @@ class TestApiViews(TestCase):
             else:
                 self.assertIsNone(odict["count"])
 
+    def test_question_results(self):
+        # type: () -> None
+        u1 = User.objects.get(username='user1')
+        u2 = User.objects.get(username='user2')
+        for user, texts in ((u1, ["Linux", s_anaar, s_lichi, "Vim"]), (u2, ["Linux", s_anaar])):
+            for text in texts:
+                choose(user, Option.objects.get(text=text))
+        qos = Question.objects.get(title="Operating System")
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/questions/{}/results/'.format(qos.id))
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(get_response_str(response))
+        self.assertEqual(results["question"], qos.id)
+        self.assertEqual(results["total"], 2)
+        self.assertEqual(results["voters"], 2)
+        self.assertEqual([odict["text"] for odict in results["options"]],
+                         list(qos.option_set.order_by('id').values_list('text', flat=True)))
+        for odict in results["options"]:
+            self.assertEqual(odict["count"], 2 if odict["text"] == "Linux" else 0)
+            self.assertEqual(odict["percentage"], 100.0 if odict["text"] == "Linux" else 0.0)
+
+        fruits = Option.objects.get(text=s_anaar).question
+        results = json.loads(get_response_str(self.client.get('/api/questions/{}/results/'.format(fruits.id))))
+        self.assertEqual((results["total"], results["voters"]), (3, 2))
+        percentages = {odict["text"]: odict["percentage"] for odict in results["options"]}
+        self.assertEqual(percentages[s_anaar], 66.67)
+        self.assertEqual(percentages[s_lichi], 33.33)
+
+        qed = Question.objects.get(title="Text Editor")
+        results = json.loads(get_response_str(self.client.get('/api/questions/{}/results/'.format(qed.id))))
+        self.assertIsNone(results["total"])
+        self.assertIsNone(results["voters"])
+        self.assertTrue(all(odict["count"] is None and odict["percentage"] is None for odict in results["options"]))
+
+        self.assertEqual(self.client.get('/api/questions/1000/results/').status_code, 404)
+
+    def test_read_query_counts(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        choose(user, Option.objects.get(text="Linux"))
+        for qlist in (TEST_QLIST, TEST_QLIST * 5):
+            populate.add_qlist(qlist)
+            with self.assertNumQueries(2):
+                self.client.get('/api/')
+            with self.assertNumQueries(1):
+                self.client.get('/api/questions/')
+            with self.assertNumQueries(1):
+                self.client.get('/api/options/')
+
+    def test_vote_query_count(self):
+        # type: () -> None
+        self.client.force_login(User.objects.get(username='user1'))
+        self.client.get('/api/my-choices/')
+        oids1 = list(Option.objects.filter(text__in=["Vim", "Linux"]).values_list('id', flat=True))
+        oids2 = list(Option.objects.filter(question__multivote=True).values_list('id', flat=True))
+        oids3 = list(Option.objects.filter(question__multivote=True).exclude(text="Vim").values_list('id', flat=True))
+        for oids in (oids1, oids2):
+            with self.assertNumQueries(13):
+                send_request(self.client.post, '/api/vote/', {"choose": oids}, "application/json")
+        # the questions of oids3 are cached by lib.option_meta
+        with self.assertNumQueries(10):
+            send_request(self.client.post, '/api/vote/', {"unchoose": oids3}, "application/json")
+
     def test_vote_form_empty(self):
         # type: () -> None
         do_test_vote(self, "user1", None, None, None, 200, [])
@@ -673,3 +1226,1088 @@ class TestApiViews(TestCase):
         # type: () -> None
         do_test_vote(self, "user3", ["Vim", "Sublime", "Windows"], ["Atom", "Linux"], ["Sublime"],
                      200, ["Vim", "Sublime", "Linux"], FORM_CONTENT_TYPE, locked_titles=["Text Editor"])
+
+class TestStreamingJSON(TestCase):
+    def test_iter_json(self):
+        # type: () -> None
+        with self.settings(JSON_CODEC='lib.codec.StdlibCodec'):
+            self.check_iter_json()
+
+    def check_iter_json(self):
+        # type: () -> None
+        values = [[], {}, [1], {"a": [1, {"b": None}]}, TEST_QLIST, s_fav_fruit]
+        for indent in (None, 0, 2, 4):
+            for value in values:
+                expected = json.dumps(value, indent=indent)
+                self.assertEqual("".join(iter_json(value, indent)), expected)
+                if isinstance(value, list):
+                    self.assertEqual("".join(iter_json(JSONArray(iter(value)), indent)), expected)
+                elif isinstance(value, dict):
+                    self.assertEqual("".join(iter_json(JSONObject(value.items()), indent)), expected)
+            pairs = [(1, {"x": [1, 2]}), (2, "y")]
+            self.assertEqual("".join(iter_json(JSONObject(pairs), indent)), json.dumps(dict(pairs), indent=indent, sort_keys=True))
+
+    def test_streamed_responses(self):
+        # type: () -> None
+        populate.add_qlist(TEST_QLIST * 3)
+        choose(User.objects.create_user('user1'), Option.objects.filter(text="Linux").first())
+        for indent in (None, 2):
+            for url in ('/api/', '/api/questions/', '/api/options/'):
+                with self.settings(JSON_INDENT=indent, STREAM_JSON_RESPONSES=False, API_CACHE=None):
+                    buffered = self.client.get(url)
+                with self.settings(JSON_INDENT=indent, STREAM_JSON_RESPONSES=True):
+                    streamed = self.client.get(url)
+                self.assertFalse(buffered.streaming)
+                self.assertTrue(streamed.streaming)
+                self.assertEqual(b"".join(streamed.streaming_content), buffered.content)
+
+class CompactCodec(codec.StdlibCodec):
+    # Codec which formats JSON differently from json.dumps, like OrjsonCodec
+    def dumps(self, obj, indent=None):
+        # type: (Any, Optional[int]) -> bytes
+        return self.make_encoder(indent).encode(obj).encode('utf-8')
+
+    def make_encoder(self, indent=None):
+        # type: (Optional[int]) -> codec.JSONEncoder
+        return codec.JSONEncoder(indent=indent, separators=(',', ':'), ensure_ascii=False)
+
+class TestCodec(TestCase):
+    def get_codecs(self):
+        # type: () -> List[Any]
+        codecs = [codec.StdlibCodec()]
+        if codec.orjson is not None:
+            codecs.append(codec.OrjsonCodec())
+        return codecs
+
+    def test_loads(self):
+        # type: () -> None
+        for json_codec in self.get_codecs():
+            self.assertEqual(json_codec.loads('{"a": [1, 2.5, null, "अनार"]}'.encode('utf-8')),
+                             {"a": [1, 2.5, None, s_anaar]})
+            self.assertEqual(json_codec.loads(b'[NaN, 123456789012345678901234567890]')[1], 123456789012345678901234567890)
+            for data in (b"", b"{", b"[1,]", b"{'a': 1}"):
+                with six.assertRaisesRegex(self, BadDataError, "Invalid JSON"):
+                    json_codec.loads(data)
+            with six.assertRaisesRegex(self, BadDataError, "Could not decode data to text"):
+                json_codec.loads(b'["\xff"]')
+
+    def test_dumps(self):
+        # type: () -> None
+        data = JSONObject([(1, JSONArray(["x", s_lichi])), (2, {"b": [None, True, 1.5]})])
+        expected = {"1": ["x", s_lichi], "2": {"b": [None, True, 1.5]}}
+        for json_codec in self.get_codecs():
+            for indent in (None, 2, 4):
+                self.assertEqual(json.loads(json_codec.dumps(data, indent).decode('utf-8')), expected)
+            self.assertEqual(json_codec.dumps([1], 2), json.dumps([1], indent=2).encode('utf-8'))
+            with self.assertRaises(TypeError):
+                json_codec.dumps(object())
+
+    def test_setting(self):
+        # type: () -> None
+        with self.settings(JSON_CODEC='lib.codec.StdlibCodec'):
+            self.assertIsInstance(codec.get_codec(), codec.StdlibCodec)
+            response = self.client.post('/api/login/', b'{"username": ', content_type="application/json")
+            self.assertEqual(get_response_str(response), "Invalid JSON")
+            self.assertEqual(response.status_code, 400)
+        # orjson is only used if it is configured, even if it is installed
+        with self.settings(JSON_CODEC=None):
+            self.assertIsInstance(codec.get_codec(), codec.StdlibCodec)
+
+    def test_iter_json(self):
+        # type: () -> None
+        # streamed JSON is formatted by the configured codec
+        paths = ['lib.codec.StdlibCodec', 'main.tests.CompactCodec']
+        if codec.orjson is not None:
+            paths.append('lib.codec.OrjsonCodec')
+        values = [[], {"a": [1, {"b": None}]}, TEST_QLIST, s_fav_fruit]
+        for path in paths:
+            with self.settings(JSON_CODEC=path):
+                for indent in (None, 2, 4):
+                    for value in values:
+                        expected = codec.get_codec().dumps(value, indent).decode('utf-8')
+                        self.assertEqual("".join(iter_json(value, indent)), expected)
+                        if isinstance(value, list):
+                            self.assertEqual("".join(iter_json(JSONArray(iter(value)), indent)), expected)
+
+class TestVoteQueue(TestCase):
+    def setUp(self):
+        # type: () -> None
+        populate.add_qlist(TEST_QLIST)
+        User.objects.create_user('user1')
+        User.objects.create_user('user2')
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings_override = self.settings(VOTE_QUEUE=os.path.join(self.tmpdir, 'queue.sqlite3'))
+        self.settings_override.enable()
+
+    def tearDown(self):
+        # type: () -> None
+        self.settings_override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def test_queued_votes(self):
+        # type: () -> None
+        u1 = User.objects.get(username='user1')
+        u2 = User.objects.get(username='user2')
+        choose(u1, Option.objects.get(text="Windows"))
+        choose(u2, Option.objects.get(text="Windows"))
+        oids = {option.text: option.id for option in Option.objects.all()}
+        ballots = [
+            (["Vim", "Atom", "Linux"], []),
+            (["Mac", "Sublime"], ["Atom"]),
+            (["Windows"], ["Vim", "Other"]),
+        ]
+        self.client.force_login(u1)
+        for choose_strs, unchoose_strs in ballots:
+            data = {"choose": [oids[text] for text in choose_strs], "unchoose": [oids[text] for text in unchoose_strs]}
+            response = send_request(self.client.post, '/api/vote/', data, "application/json")
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(get_response_str(response), "queued")
+            options = get_options_meta(data["choose"] + data["unchoose"])
+            apply_ballot(u2, options, data["choose"], data["unchoose"])
+
+        expected = sorted(Choice.objects.filter(user=u2).values_list('option_id', flat=True))
+        self.assertEqual(list(Choice.objects.filter(user=u1).values_list('option_id', flat=True)), [oids["Windows"]])
+        self.assertEqual(json.loads(get_response_str(self.client.get('/api/my-choices/'))), expected)
+
+        call_command('process_vote_queue', once=True, batch_size=2, stdout=six.StringIO())
+        self.assertEqual(sorted(Choice.objects.filter(user=u1).values_list('option_id', flat=True)), expected)
+        self.assertEqual(json.loads(get_response_str(self.client.get('/api/my-choices/'))), expected)
+        self.assertEqual(len(get_vote_queue()), 0)
+        self.assertEqual(get_vote_count_mismatches(), {})
+
+    def test_replayed_batch(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        queue = get_vote_queue()
+        vim = Option.objects.get(text="Vim")
+        linux = Option.objects.get(text="Linux")
+        mac = Option.objects.get(text="Mac")
+        queue.put(user.id, [vim.id, linux.id], [])
+        queue.put(user.id, [mac.id], [vim.id])
+        # a batch which was applied but not removed from the queue is applied again
+        with transaction.atomic():
+            batch = queue.get_batch(10)
+            process_batch(queue, 10)
+            queue.put(batch[0][1], batch[0][2], batch[0][3])
+            queue.put(batch[1][1], batch[1][2], batch[1][3])
+        process_batch(queue, 10)
+        self.assertEqual(set(Choice.objects.filter(user=user).values_list('option_id', flat=True)), {mac.id})
+        self.assertEqual(get_vote_count_mismatches(), {})
+
+    def test_locked_before_applied(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        vim = Option.objects.get(text="Vim")
+        linux = Option.objects.get(text="Linux")
+        self.client.force_login(user)
+        send_request(self.client.post, '/api/vote/', {"choose": [vim.id, linux.id]}, "application/json")
+        etag = self.client.get('/api/my-choices/')['ETag']
+        # locked by another process, so the cached metadata of this process is stale
+        get_options_meta([vim.id])
+        Question.objects.filter(id=vim.question_id).update(locked=True)
+        bump_data_versions(QUESTIONS)
+        response = self.client.get('/api/my-choices/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(get_response_str(response)), [linux.id])
+        call_command('process_vote_queue', once=True, stdout=six.StringIO())
+        self.assertEqual(list(Choice.objects.filter(user=user).values_list('option_id', flat=True)), [linux.id])
+
+    def test_my_choices_etag(self):
+        # type: () -> None
+        self.client.force_login(User.objects.get(username='user1'))
+        etag = self.client.get('/api/my-choices/')['ETag']
+        vim = Option.objects.get(text="Vim")
+        send_request(self.client.post, '/api/vote/', {"choose": [vim.id]}, "application/json")
+        response = self.client.get('/api/my-choices/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(get_response_str(response)), [vim.id])
+
+class TestCache(TestCase):
+    def setUp(self):
+        # type: () -> None
+        caches['default'].clear()
+        User.objects.create_user('user1', password='pass1')
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass1')
+        populate.add_qlist(TEST_QLIST)
+
+    def test_cached_responses(self):
+        # type: () -> None
+        for url in ('/api/', '/api/questions/', '/api/options/'):
+            response1 = self.client.get(url)
+            with self.assertNumQueries(0):
+                response2 = self.client.get(url)
+            self.assertEqual(response1.content, response2.content)
+            self.assertEqual(response2['Content-Type'], 'application/json')
+
+    def test_local_versions_expire(self):
+        # type: () -> None
+        # a local-memory cache isn't shared, so its versions are renewed to notice changes made by other processes
+        with self.settings(API_LOCAL_VERSION_TIMEOUT=1):
+            caches['default'].clear()
+            etag = self.client.get('/api/questions/')['ETag']
+            self.assertEqual(self.client.get('/api/questions/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            time.sleep(1.1)
+            self.assertEqual(self.client.get('/api/questions/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_vote_invalidates_options(self):
+        # type: () -> None
+        for url in ('/api/', '/api/questions/', '/api/options/'):
+            self.client.get(url)
+        versions = {name: get_payload_version(name) for name in ('index', 'questions', 'options')}
+        linux = Option.objects.get(text="Linux")
+        choose(User.objects.get(username='user1'), linux)
+        self.assertEqual(get_payload_version('index'), versions['index'])
+        self.assertEqual(get_payload_version('questions'), versions['questions'])
+        self.assertNotEqual(get_payload_version('options'), versions['options'])
+
+        with self.assertNumQueries(0):
+            self.client.get('/api/')
+            self.client.get('/api/questions/')
+        data = json.loads(get_response_str(self.client.get('/api/options/')))
+        self.assertEqual(data[text_type(linux.id)]["count"], 1)
+
+    def test_question_save_invalidates(self):
+        # type: () -> None
+        self.client.get('/api/')
+        self.client.get('/api/questions/')
+        qos = Question.objects.get(title="Operating System")
+        qos.title = "OS"
+        qos.save()
+        for url in ('/api/', '/api/questions/'):
+            self.assertIn('"OS"', get_response_str(self.client.get(url)))
+
+    def test_admin_delete_choices(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        linux = Option.objects.get(text="Linux")
+        choose(user, linux)
+        self.client.get('/api/options/')
+        self.client.force_login(User.objects.get(username='admin'))
+        choice_ids = list(Choice.objects.values_list('id', flat=True))
+        response = self.client.post('/admin/main/choice/', {'action': 'delete_selected_choices',
+                                    '_selected_action': choice_ids, 'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Choice.objects.count(), 0)
+        self.assertEqual(get_vote_count_mismatches(), {})
+        data = json.loads(get_response_str(self.client.get('/api/options/')))
+        self.assertEqual(data[text_type(linux.id)]["count"], 0)
+
+class TestAdmin(TestCase):
+    def setUp(self):
+        # type: () -> None
+        caches['default'].clear()
+        populate.add_qlist(TEST_QLIST)
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass1')
+        self.client.force_login(User.objects.get(username='admin'))
+
+    def add_choices(self, num_users):
+        # type: (int) -> None
+        for i in range(num_users):
+            user = User.objects.create_user('voter{}'.format(User.objects.count()), password='pass')
+            for text in ("Vim", "Linux", s_anaar):
+                choose(user, Option.objects.get(text=text))
+
+    def test_changelist_queries(self):
+        # type: () -> None
+        # the number of queries doesn't depend on the number of rows shown
+        num_queries = {} # type: Dict[text_type, int]
+        for num_users in (1, 5):
+            self.add_choices(num_users)
+            for url in ('/admin/main/choice/', '/admin/main/option/', '/admin/main/question/'):
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(self.client.get(url).status_code, 200)
+                self.assertEqual(len(queries), num_queries.setdefault(url, len(queries)))
+        user = User.objects.get(username='voter1')
+        response = self.client.get('/admin/main/choice/?user={}'.format(user.id))
+        self.assertEqual(len(response.context['cl'].result_list), 3)
+        qed = Question.objects.get(title="Text Editor")
+        response = self.client.get('/admin/main/question/')
+        totals = {question.id: question.vote_total for question in response.context['cl'].result_list}
+        self.assertEqual(totals[qed.id], 6)
+
+    def test_question_actions(self):
+        # type: () -> None
+        versions = [get_payload_version('questions')]
+        qids = list(Question.objects.order_by('id').values_list('id', flat=True)[:2])
+        last_change = Change.objects.latest('id').id
+        response = self.client.post('/admin/main/question/', {'action': 'set_locked_true', '_selected_action': qids})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(Question.objects.filter(locked=True).order_by('id').values_list('id', flat=True)), qids)
+        versions.append(get_payload_version('questions'))
+        self.assertNotEqual(versions[0], versions[1])
+        self.assertEqual(sorted(Change.objects.filter(id__gt=last_change).values_list('kind', 'object_id')),
+                         [(Change.QUESTION, qid) for qid in qids])
+
+        last_change = Change.objects.latest('id').id
+        qids = list(Question.objects.filter(show_count=True).values_list('id', flat=True))
+        self.client.post('/admin/main/question/', {'action': 'set_show_count_false', '_selected_action': qids})
+        self.assertFalse(Question.objects.filter(id__in=qids, show_count=True).exists())
+        changed_oids = set(Change.objects.filter(id__gt=last_change, kind=Change.OPTION).values_list('object_id', flat=True))
+        self.assertEqual(changed_oids, set(Option.objects.filter(question_id__in=qids).values_list('id', flat=True)))
+        data = json.loads(get_response_str(self.client.get('/api/options/')))
+        for oid in changed_oids:
+            self.assertIsNone(data[text_type(oid)]["count"])
+
+    def test_estimated_count_paginator(self):
+        # type: () -> None
+        self.add_choices(3)
+        Choice.objects.filter(id=Choice.objects.order_by('id')[1].id).delete()
+        old_threshold = pagination.ESTIMATE_THRESHOLD
+        pagination.ESTIMATE_THRESHOLD = 0
+        try:
+            paginator = pagination.EstimatedCountPaginator(Choice.objects.order_by('id'), 2)
+            self.assertEqual(paginator.count, Choice.objects.count() + 1)
+            paginator = pagination.EstimatedCountPaginator(Choice.objects.filter(user__username='voter2'), 2)
+            self.assertEqual(paginator.count, 3)
+        finally:
+            pagination.ESTIMATE_THRESHOLD = old_threshold
+        paginator = pagination.EstimatedCountPaginator(Choice.objects.order_by('id'), 2)
+        self.assertEqual(paginator.count, Choice.objects.count())
+
+class TestConditionalGet(TestCase):
+    def setUp(self):
+        # type: () -> None
+        caches['default'].clear()
+        User.objects.create_user('user1', password='pass1')
+        User.objects.create_user('user2', password='pass2')
+        populate.add_qlist(TEST_QLIST)
+
+    def test_not_modified(self):
+        # type: () -> None
+        for url in ('/api/', '/api/questions/', '/api/options/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+            response = self.client.get(url, HTTP_IF_NONE_MATCH='"stale"')
+            self.assertEqual(response.status_code, 200)
+
+    def test_etag_changes_on_vote(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        etag = self.client.get('/api/options/')['ETag']
+        questions_etag = self.client.get('/api/questions/')['ETag']
+        choose(user, Option.objects.get(text="Linux"))
+        response = self.client.get('/api/options/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.get('/api/questions/', HTTP_IF_NONE_MATCH=questions_etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_if_modified_since(self):
+        # type: () -> None
+        # a change in the same second as the last request must not be hidden by If-Modified-Since
+        response = self.client.get('/api/options/')
+        self.assertNotIn('Last-Modified', response)
+        choose(User.objects.get(username='user1'), Option.objects.get(text="Linux"))
+        response = self.client.get('/api/options/', HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(response.status_code, 200)
+
+    def test_my_choices(self):
+        # type: () -> None
+        u1 = User.objects.get(username='user1')
+        u2 = User.objects.get(username='user2')
+        self.client.force_login(u1)
+        etag = self.client.get('/api/my-choices/')['ETag']
+        self.assertEqual(self.client.get('/api/my-choices/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # votes of other users don't change the ETag
+        choose(u2, Option.objects.get(text="Vim"))
+        self.assertEqual(self.client.get('/api/my-choices/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        choose(u1, Option.objects.get(text="Vim"))
+        response = self.client.get('/api/my-choices/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(get_response_str(response)), [Option.objects.get(text="Vim").id])
+
+        # the ETag is not shared between users
+        self.client.force_login(u2)
+        self.assertEqual(self.client.get('/api/my-choices/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_my_choices_unauthed(self):
+        # type: () -> None
+        response = self.client.get('/api/my-choices/', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 401)
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        # type: () -> None
+        populate.add_qlist(TEST_QLIST)
+        User.objects.create_user('user1', password='pass1')
+        User.objects.create_user('admin', password='pass2', is_staff=True)
+        metrics.registry.reset()
+
+    def test_metrics(self):
+        # type: () -> None
+        self.client.force_login(User.objects.get(username='user1'))
+        for i in range(3):
+            self.client.get('/api/options/')
+        oids = list(Option.objects.filter(text="Vim").values_list('id', flat=True))
+        send_request(self.client.post, '/api/vote/', {"choose": oids}, "application/json")
+        self.client.get('/admin/')
+        stats = metrics.registry.to_dict()
+        self.assertEqual(list(stats), ['options', 'vote'])
+        self.assertEqual(stats['options']['requests'], 3)
+        self.assertEqual(stats['options']['latency_seconds']['buckets']['+Inf'], 3)
+        self.assertEqual(stats['vote']['requests'], 1)
+        self.assertEqual(stats['vote']['errors'], 0)
+        self.assertGreater(stats['vote']['sql_queries'], 0)
+        self.assertGreater(stats['vote']['sql_seconds'], 0)
+
+    def test_metrics_view(self):
+        # type: () -> None
+        self.client.get('/api/questions/')
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 401)
+        self.client.force_login(User.objects.get(username='user1'))
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        self.client.force_login(User.objects.get(username='admin'))
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(get_response_str(response))['questions']['requests'], 1)
+        response = self.client.get('/api/metrics/', {'format': 'prometheus'})
+        self.assertEqual(response.status_code, 200)
+        lines = get_response_str(response).split('\n')
+        self.assertIn('poller_requests_total{view="questions"} 1', lines)
+        self.assertIn('poller_request_duration_seconds_bucket{view="questions",le="+Inf"} 1', lines)
+        self.assertIn('poller_request_duration_seconds_count{view="metrics"} 3', lines)
+
+class TestExport(TestCase):
+    def setUp(self):
+        # type: () -> None
+        populate.add_qlist(TEST_QLIST)
+        u1 = User.objects.create_user('user1', password='pass1')
+        u2 = User.objects.create_user('admin', password='pass2', is_staff=True)
+        for user, texts in ((u1, ["Vim", "Linux", s_anaar]), (u2, ["Atom", s_lichi])):
+            for text in texts:
+                choose(user, Option.objects.get(text=text))
+
+    def get_rows(self, question_ids=None):
+        # type: (Any) -> List[List[int]]
+        choices = Choice.objects.order_by('id')
+        if question_ids is not None:
+            choices = choices.filter(question_id__in=question_ids)
+        return [list(row) for row in choices.values_list('id', 'user_id', 'option_id', 'question_id')]
+
+    def test_iter_export(self):
+        # type: () -> None
+        rows = self.get_rows()
+        for chunk_size in (1, 2, 5, 100):
+            lines = list(export.iter_export('csv', chunk_size=chunk_size))
+            self.assertEqual(lines[0], "id,user_id,option_id,question_id\n")
+            self.assertEqual([[int(x) for x in line.split(",")] for line in lines[1:]], rows)
+            lines = list(export.iter_export('ndjson', chunk_size=chunk_size))
+            self.assertEqual([list(json.loads(line).values()) for line in lines], rows)
+            self.assertEqual(list(json.loads(lines[0])), ["id", "user_id", "option_id", "question_id"])
+        qid = Option.objects.get(text="Vim").question_id
+        lines = list(export.iter_export('ndjson', [qid], chunk_size=1))
+        self.assertEqual([list(json.loads(line).values()) for line in lines], self.get_rows([qid]))
+
+    def test_export_view(self):
+        # type: () -> None
+        self.assertEqual(self.client.get('/api/export/votes/').status_code, 401)
+        self.client.force_login(User.objects.get(username='user1'))
+        self.assertEqual(self.client.get('/api/export/votes/').status_code, 403)
+        self.client.force_login(User.objects.get(username='admin'))
+        response = self.client.get('/api/export/votes/')
+        self.assertEqual(response['Content-Type'], "text/csv")
+        lines = b"".join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), Choice.objects.count() + 1)
+
+        qids = list(Question.objects.filter(multivote=True).values_list('id', flat=True))
+        url = '/api/export/votes/?format=ndjson&' + '&'.join('question={}'.format(qid) for qid in qids)
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([list(json.loads(line).values()) for line in lines], self.get_rows(qids))
+        for url in ('/api/export/votes/?format=xml', '/api/export/votes/?question=x'):
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_export_command(self):
+        # type: () -> None
+        out = six.StringIO()
+        call_command('export_votes', format='ndjson', stdout=out)
+        self.assertEqual([list(json.loads(line).values()) for line in out.getvalue().splitlines()], self.get_rows())
+
+class TestEventStream(TransactionTestCase):
+    def setUp(self):
+        # type: () -> None
+        User.objects.create_user('user1', password='pass1')
+        populate.add_qlist(TEST_QLIST)
+
+    def read_events(self, stream, count):
+        # type: (Any, int) -> List[text_type]
+        events = []
+        while len(events) < count:
+            chunk = force_text(next(stream))
+            if not chunk.startswith(':'):
+                events.append(chunk)
+        return events
+
+    def test_broker(self):
+        # type: () -> None
+        broker = LocalBroker(buffer_size=2)
+        self.assertEqual(broker.wait(0, 0), (0, []))
+        broker.publish("a", 1)
+        self.assertEqual(broker.wait(0, 0), (1, [(1, "a", 1)]))
+        broker.publish("b", 2)
+        broker.publish("c", 3)
+        self.assertEqual(broker.wait(0, 0), (3, [(2, "b", 2), (3, "c", 3)]))
+        self.assertEqual(broker.wait(2, 0), (3, [(3, "c", 3)]))
+        broker.skip()
+        self.assertEqual(broker.wait(3, 0), (4, []))
+
+    def test_stream_from_unknown_id(self):
+        # type: () -> None
+        broker = get_broker()
+        last_id = broker.last_event_id()
+        # like after a restart of the server or a reconnection to another process
+        stream = EventStream(last_id + 5, heartbeat_interval=0.01)
+        event = self.read_events(stream, 1)[0]
+        self.assertIn("id: {}\n".format(last_id), event)
+        self.assertIn("event: resync", event)
+        broker.publish("count", {"option": 1})
+        self.assertIn("id: {}\n".format(last_id + 1), self.read_events(stream, 1)[0])
+        stream.close()
+
+    def test_stream(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        linux = Option.objects.get(text="Linux")
+        windows = Option.objects.get(text="Windows")
+        qos = linux.question
+        with self.settings(SSE_HEARTBEAT_INTERVAL=0.01):
+            response = self.client.get('/api/stream/')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            stream = iter(response.streaming_content)
+
+            # votes for questions which hide counts are not published
+            choose(user, Option.objects.get(text="Vim"))
+            choose(user, windows)
+            choose(user, linux)
+            qos.locked = True
+            qos.save()
+
+            events = self.read_events(stream, 4)
+            response.close()
+        data = [json.loads(event.split("data: ")[1]) for event in events]
+        self.assertIn("event: count", events[0])
+        self.assertEqual(data[0], {"option": windows.id, "question": qos.id, "delta": 1})
+        self.assertEqual(sorted(data[1:3], key=lambda d: d["delta"]), [
+            {"option": windows.id, "question": qos.id, "delta": -1},
+            {"option": linux.id, "question": qos.id, "delta": 1},
+        ])
+        self.assertIn("event: locked", events[3])
+        self.assertEqual(data[3], {"question": qos.id, "locked": True})
+
+    def test_locked_without_query(self):
+        # type: () -> None
+        qos = Question.objects.get(title="Operating System")
+        with self.settings(SSE_HEARTBEAT_INTERVAL=0.01):
+            response = self.client.get('/api/stream/')
+            stream = iter(response.streaming_content)
+            # the old value of locked is remembered when the question is loaded, not read again when it is saved
+            with CaptureQueriesContext(connection) as queries:
+                qos.locked = True
+                qos.save()
+            self.assertFalse([query for query in queries if query['sql'].startswith('SELECT "main_question"')])
+            qos.save()
+            qos.locked = False
+            qos.save()
+            events = self.read_events(stream, 2)
+            response.close()
+        data = [json.loads(event.split("data: ")[1]) for event in events]
+        self.assertEqual(data, [{"question": qos.id, "locked": True}, {"question": qos.id, "locked": False}])
+
+    def test_last_event_id(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        linux = Option.objects.get(text="Linux")
+        with self.settings(SSE_HEARTBEAT_INTERVAL=0.01):
+            response = self.client.get('/api/stream/')
+            stream = iter(response.streaming_content)
+            start = get_broker().last_event_id()
+            choose(user, linux)
+            unchoose(user, linux)
+            self.read_events(stream, 2)
+            response.close()
+
+            # events are replayed to clients which reconnect
+            response = self.client.get('/api/stream/', HTTP_LAST_EVENT_ID=str(start))
+            events = self.read_events(iter(response.streaming_content), 2)
+            response.close()
+            self.assertTrue(events[0].startswith("id: {}\n".format(start + 1)))
+            self.assertIn('"delta": 1', events[0])
+            self.assertTrue(events[1].startswith("id: {}\n".format(start + 2)))
+            self.assertIn('"delta": -1', events[1])
+
+            # events which were not published while nobody was subscribed cause a resync
+            choose(user, linux)
+            response = self.client.get('/api/stream/', HTTP_LAST_EVENT_ID=str(start + 2))
+            events = self.read_events(iter(response.streaming_content), 1)
+            response.close()
+            self.assertIn("event: resync", events[0])
+
+class TestTally(TransactionTestCase):
+    def setUp(self):
+        # type: () -> None
+        User.objects.create_user('user1')
+        populate.add_qlist(TEST_QLIST)
+        caches['default'].clear()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'tally')
+
+    def tearDown(self):
+        # type: () -> None
+        if self.path in tally._tallies:
+            tally._tallies.pop(self.path).close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_tally_file(self):
+        # type: () -> None
+        t1 = tally.Tally(self.path)
+        self.assertTrue(t1.is_new)
+        t1.add({3: 2, 5: 1})
+        t1.add({3: -1})
+        t2 = tally.Tally(self.path)
+        self.assertFalse(t2.is_new)
+        self.assertEqual((t2.get(3), t2.get(5), t2.get(4)), (1, 1, 0))
+        self.assertEqual(t2.get(100000), 0)
+
+        # the file is grown by one process and the other one remaps it
+        t2.add({100000: 4})
+        self.assertEqual(t1.get(100000), 4)
+        self.assertEqual(t1.counts(), {3: 1, 5: 1, 100000: 4})
+        self.assertTrue(t1.verify())
+        t1.reset({7: 2})
+        self.assertEqual(t2.counts(), {7: 2})
+        self.assertTrue(t2.verify())
+
+        # votes fenced at or below the version of the last rebuild are already in its counts
+        t1.reset({7: 2}, fence=10)
+        t2.add({7: 1}, fence=10)
+        self.assertEqual(t1.get(7), 2)
+        t2.add({7: 1}, fence=11)
+        t2.add({8: 1})
+        self.assertEqual(t1.counts(), {7: 3, 8: 1})
+        t2.clear([7, 9, 200000])
+        self.assertEqual(t1.counts(), {8: 1})
+        self.assertTrue(t1.verify())
+        self.assertEqual(t1.get_fence(), 10)
+
+        # a count changed without updating the total is detected
+        tally.COUNT.pack_into(t1.mm, tally.HEADER.size + 8 * tally.COUNT.size, 3)
+        self.assertFalse(t2.verify())
+        t1.close()
+        t2.close()
+
+    def test_tally_votes(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        linux = Option.objects.get(text="Linux")
+        windows = Option.objects.get(text="Windows")
+        choose(user, linux)
+        with self.settings(TALLY_FILE=self.path):
+            # a new tally is filled from the Choice table
+            t = tally.get_tally()
+            self.assertEqual(t.counts(), {linux.id: 1})
+            choose(user, windows)
+            unchoose(user, linux)
+            self.assertEqual(t.counts(), {windows.id: 1})
+            with transaction.atomic():
+                choose(user, linux)
+                # counts are only changed on commit
+                self.assertEqual(t.get(linux.id), 0)
+            self.assertEqual(t.counts(), {linux.id: 1})
+
+            expected = json.loads(get_response_str(self.client.get('/api/options/')))
+            self.assertEqual(expected[str(linux.id)]['count'], 1)
+            self.assertIsNone(expected[str(Option.objects.get(text="Vim").id)]['count'])
+            unchoose(user, linux)
+            # after a vote, counts are read from the tally and the rest from the cache
+            with self.assertNumQueries(0):
+                response = self.client.get('/api/options/')
+            expected[str(linux.id)]['count'] = 0
+            self.assertEqual(json.loads(get_response_str(response)), expected)
+
+            t.add({linux.id: 5})
+            with self.assertRaises(CommandError):
+                call_command('reconcile_tally', check=True, stdout=six.StringIO())
+            out = six.StringIO()
+            call_command('reconcile_tally', stdout=out)
+            self.assertIn("option {}: tally 5, actual 0".format(linux.id), out.getvalue())
+            self.assertEqual(t.counts(), {})
+            call_command('reconcile_tally', check=True, stdout=six.StringIO())
+
+            # a vote committed before a rebuild, but added after it, isn't counted twice
+            with transaction.atomic():
+                choose(user, linux)
+                fence = TallyFence.objects.get().version
+            tally.reconcile_tally(t)
+            self.assertEqual(t.get_fence(), TallyFence.objects.get().version)
+            self.assertGreater(t.get_fence(), fence)
+            t.add({linux.id: 1}, fence)
+            self.assertEqual(t.counts(), {linux.id: 1})
+
+            # the count of a deleted option is cleared, including when its question is deleted
+            linux.delete()
+            self.assertEqual(t.counts(), {})
+            choose(user, windows)
+            windows.question.delete()
+            self.assertEqual(t.counts(), {})
+            self.assertTrue(t.verify())
+
+class TestSqlite(TransactionTestCase):
+    def setUp(self):
+        # type: () -> None
+        populate.add_qlist(TEST_QLIST)
+
+    def test_pragmas(self):
+        # type: () -> None
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA busy_timeout')
+        old_timeout = cursor.fetchone()[0]
+        with self.settings(SQLITE_PRAGMAS={'busy_timeout': 1234}):
+            configure_connection(sender=None, connection=connection)
+        cursor.execute('PRAGMA busy_timeout')
+        self.assertEqual(cursor.fetchone()[0], 1234)
+        cursor.execute('PRAGMA busy_timeout = {}'.format(old_timeout))
+
+    def test_retry_on_locked(self):
+        # type: () -> None
+        calls = []
+        @retry_on_locked
+        def write(error, failures):
+            # type: (text_type, int) -> int
+            calls.append(1)
+            if len(calls) <= failures:
+                raise OperationalError(error)
+            return len(calls)
+
+        with self.settings(SQLITE_LOCKED_RETRIES=2, SQLITE_LOCKED_RETRY_DELAY=0):
+            self.assertEqual(write("database is locked", 2), 3)
+            del calls[:]
+            with self.assertRaises(OperationalError):
+                write("database is locked", 3)
+            self.assertEqual(len(calls), 3)
+            del calls[:]
+            with self.assertRaises(OperationalError):
+                write("no such table: main_option", 1)
+            self.assertEqual(len(calls), 1)
+            # an outer transaction can't be retried
+            del calls[:]
+            with self.assertRaises(OperationalError):
+                with transaction.atomic():
+                    write("database table is locked", 1)
+            self.assertEqual(len(calls), 1)
+
+    def test_concurrent_votes(self):
+        # type: () -> None
+        num_writers = 8
+        users = [User.objects.create_user('user{}'.format(i)) for i in range(num_writers)]
+        editors = list(Option.objects.filter(question__multivote=True, question__text__startswith="Which text"))
+        oses = list(Option.objects.filter(question__multivote=False))
+        errors = [] # type: List[Exception]
+
+        def vote(user):
+            # type: (User) -> None
+            try:
+                for i in range(5):
+                    for option in editors:
+                        choose(user, option)
+                    for option in oses:
+                        choose(user, option)
+                    unchoose(user, editors[i % len(editors)])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=vote, args=(user,)) for user in users]
+        with self.settings(SQLITE_LOCKED_RETRIES=20, SQLITE_LOCKED_RETRY_DELAY=0.005):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        expected = set(option.id for option in editors)
+        expected.discard(editors[4 % len(editors)].id)
+        expected.add(oses[-1].id)
+        for user in users:
+            self.assertEqual(set(Choice.objects.filter(user=user).values_list('option_id', flat=True)), expected)
+        self.assertEqual(get_vote_count_mismatches(), {})
+
+    def test_concurrent_ballots(self):
+        # type: () -> None
+        # ballots of the same user at once neither fail nor leave two choices in a single-vote question
+        user = User.objects.create_user('user1')
+        editors = list(Option.objects.filter(question__multivote=True, question__text__startswith="Which text"))
+        oses = list(Option.objects.filter(question__multivote=False))
+        options = get_options_meta([option.id for option in editors + oses])
+        errors = [] # type: List[Exception]
+
+        def vote(i):
+            # type: (int) -> None
+            try:
+                for j in range(5):
+                    apply_ballot(user, options, [editors[j].id, oses[(i + j) % len(oses)].id], [editors[(i + j) % len(editors)].id])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=vote, args=(i,)) for i in range(6)]
+        with self.settings(SQLITE_LOCKED_RETRIES=20, SQLITE_LOCKED_RETRY_DELAY=0.005):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Choice.objects.filter(user=user, option__in=oses).count(), 1)
+        self.assertEqual(get_vote_count_mismatches(), {})
+
+    def test_concurrent_queue(self):
+        # type: () -> None
+        # the vote queue worker writes while other votes are applied directly
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        users = [User.objects.create_user('user{}'.format(i)) for i in range(8)]
+        queued_users, direct_users = users[:4], users[4:]
+        editors = list(Option.objects.filter(question__multivote=True, question__text__startswith="Which text"))
+        oses = list(Option.objects.filter(question__multivote=False))
+        errors = [] # type: List[Exception]
+
+        def work(queue):
+            # type: (VoteQueue) -> None
+            try:
+                while process_batch(queue, 2):
+                    pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        def vote(user):
+            # type: (User) -> None
+            try:
+                for i in range(5):
+                    for option in editors:
+                        choose(user, option)
+                    unchoose(user, editors[i])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        with self.settings(VOTE_QUEUE=os.path.join(tmpdir, 'queue.sqlite3'),
+                           SQLITE_LOCKED_RETRIES=20, SQLITE_LOCKED_RETRY_DELAY=0.005):
+            queue = get_vote_queue()
+            for i in range(5):
+                for user in queued_users:
+                    queue.put(user.id, [option.id for option in editors] + [oses[i].id], [editors[i].id])
+            threads = [threading.Thread(target=work, args=(queue,))]
+            threads.extend(threading.Thread(target=vote, args=(user,)) for user in direct_users)
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(queue), 0)
+        self.assertEqual(errors, [])
+        expected = set(option.id for option in editors[:4])
+        for user in direct_users:
+            self.assertEqual(set(Choice.objects.filter(user=user).values_list('option_id', flat=True)), expected)
+        for user in queued_users:
+            self.assertEqual(set(Choice.objects.filter(user=user).values_list('option_id', flat=True)), expected | {oses[4].id})
+        self.assertEqual(get_vote_count_mismatches(), {})
+
+class TestReplicas(TestCase):
+    # 'default' is the primary and a separate SQLite file stands in for a replica
+    def setUp(self):
+        # type: () -> None
+        populate.add_qlist(TEST_QLIST)
+        User.objects.create_user('user1')
+        self.tmpdir = tempfile.mkdtemp()
+        connections.databases['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(self.tmpdir, 'replica.sqlite3'),
+        }
+        call_command('migrate', database='replica', verbosity=0, interactive=False)
+        self.settings_override = self.settings(DATABASE_REPLICAS=['replica'], API_CACHE=None)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        # type: () -> None
+        self.settings_override.disable()
+        replicas._replica_sets.clear()
+        connections['replica'].close()
+        del connections.databases['replica']
+        delattr(connections._connections, 'replica')
+        shutil.rmtree(self.tmpdir)
+
+    def test_router(self):
+        # type: () -> None
+        self.assertEqual(json.loads(get_response_str(self.client.get('/api/questions/'))), {})
+        Question.objects.using('replica').bulk_create([Question(text="Only on the replica")])
+        response_data = json.loads(get_response_str(self.client.get('/api/questions/')))
+        self.assertEqual([qdict['text'] for qdict in response_data.values()], ["Only on the replica"])
+        with self.settings(DATABASE_REPLICAS=[]):
+            response_data = json.loads(get_response_str(self.client.get('/api/questions/')))
+        self.assertEqual(len(response_data), len(TEST_QLIST))
+        self.assertTrue(replicas.check_alias('replica'))
+
+    def test_cached_data(self):
+        # type: () -> None
+        # data which is cached under the current versions is read from the primary, as the replica is behind
+        caches['default'].clear()
+        with self.settings(API_CACHE='default'):
+            response_data = json.loads(get_response_str(self.client.get('/api/questions/')))
+            self.assertEqual(len(response_data), len(TEST_QLIST))
+            vim = Option.objects.get(text="Vim")
+            replicas.set_read_db('replica')
+            try:
+                option_meta.option_meta_cache.clear()
+                self.assertEqual(list(get_options_meta([vim.id])), [vim.id])
+                self.assertEqual(len(tally.get_option_skeleton()), Option.objects.using('default').count())
+            finally:
+                replicas.set_read_db(None)
+
+    def test_pinning(self):
+        # type: () -> None
+        user = User.objects.get(username='user1')
+        vim = Option.objects.get(text="Vim")
+        self.client.force_login(user)
+        response = send_request(self.client.post, '/api/vote/', {"choose": [vim.id]}, "application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(replicas.PIN_COOKIE, response.cookies)
+        response = self.client.get('/api/my-choices/')
+        self.assertEqual(json.loads(get_response_str(response)), [vim.id])
+        # the session is only on the primary
+        self.client.cookies[replicas.PIN_COOKIE] = '0'
+        self.assertEqual(self.client.get('/api/my-choices/').status_code, 401)
+
+    def test_pinning_without_cookies(self):
+        # type: () -> None
+        # a client which authenticates with a token is pinned by its user, even if it doesn't keep cookies
+        caches['default'].clear()
+        get_token_cache().clear()
+        user = User.objects.get(username='user1')
+        vim = Option.objects.get(text="Vim")
+        auth_header = "Bearer " + create_token(user)[0]
+        with self.settings(API_CACHE='default'):
+            response = self.client.post('/api/vote/', json.dumps({"choose": [vim.id]}), content_type="application/json",
+                                        HTTP_AUTHORIZATION=auth_header)
+            self.assertEqual(response.status_code, 200)
+            self.client.cookies.clear()
+            response = self.client.get('/api/my-choices/', HTTP_AUTHORIZATION=auth_header)
+            self.assertEqual(json.loads(get_response_str(response)), [vim.id])
+            # once the pin has expired, choices are read from the replica, which hasn't got them yet
+            caches['default'].delete(replicas.PIN_KEY.format(user.id))
+            response = self.client.get('/api/my-choices/', HTTP_AUTHORIZATION=auth_header)
+            self.assertEqual(json.loads(get_response_str(response)), [])
+
+    def test_replica_set(self):
+        # type: () -> None
+        now = [0.0]
+        up = {'r1', 'r2', 'r3'}
+        latencies = {'r1': 0.03, 'r2': 0.01, 'r3': 0.02}
+
+        def check(alias):
+            # type: (text_type) -> bool
+            now[0] += latencies[alias]
+            return alias in up
+
+        replica_set = replicas.ReplicaSet(['r1', 'r2', 'r3'], check=check, timer=lambda: now[0])
+        with self.settings(REPLICA_CHECK_INTERVAL=5):
+            self.assertEqual([replica_set.choose() for i in range(4)], ['r1', 'r2', 'r3', 'r1'])
+            # health is only checked again after REPLICA_CHECK_INTERVAL seconds
+            up.discard('r2')
+            self.assertEqual(replica_set.choose(), 'r2')
+            now[0] += 5
+            self.assertEqual(set(replica_set.choose() for i in range(4)), {'r1', 'r3'})
+            with self.settings(REPLICA_SELECTION='health'):
+                self.assertEqual(replica_set.choose(), 'r3')
+            up.clear()
+            now[0] += 5
+            self.assertEqual(replica_set.choose(), 'default')
+
+    def test_replica_check_outside_lock(self):
+        # type: () -> None
+        checking = threading.Event()
+        release = threading.Event()
+
+        def check(alias):
+            # type: (text_type) -> bool
+            checking.set()
+            release.wait(5)
+            return True
+
+        replica_set = replicas.ReplicaSet(['r1'], check=check)
+        with self.settings(REPLICA_CHECK_INTERVAL=60):
+            thread = threading.Thread(target=replica_set.choose)
+            thread.start()
+            self.assertTrue(checking.wait(5))
+            # other requests don't wait for a running check, and skip a replica until its first check has passed
+            self.assertEqual(replica_set.choose(), 'default')
+            release.set()
+            thread.join()
+            self.assertEqual(replica_set.choose(), 'r1')
+
+class TestProfiling(TestCase):
+    def setUp(self):
+        # type: () -> None
+        populate.add_qlist(TEST_QLIST)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # type: () -> None
+        shutil.rmtree(self.tmpdir)
+
+    def get_dumps(self):
+        # type: () -> List[text_type]
+        return sorted(name for name in os.listdir(self.tmpdir) if name.endswith('.prof'))
+
+    def test_profiling(self):
+        # type: () -> None
+        with self.settings(PROFILE_DIR=self.tmpdir, PROFILE_URL_NAMES=['api:options']):
+            self.client.get('/api/questions/')
+            self.assertEqual(self.get_dumps(), [])
+            self.client.get('/api/options/')
+            dumps = self.get_dumps()
+            self.assertEqual(len(dumps), 1)
+            with open(os.path.join(self.tmpdir, dumps[0][:-len('.prof')] + '.json')) as fobj:
+                metadata = json.load(fobj)
+            self.assertEqual((metadata['view_name'], metadata['path'], metadata['status']), ('api:options', '/api/options/', 200))
+            stats = pstats.Stats(os.path.join(self.tmpdir, dumps[0]))
+            self.assertIn('options', [func_name for filename, line, func_name in stats.stats])
+
+            with self.settings(PROFILE_SAMPLE_RATE=1.0, PROFILE_MAX_FILES=2):
+                self.client.get('/api/questions/')
+                self.client.get('/api/')
+            dumps = self.get_dumps()
+            self.assertEqual(len(dumps), 2)
+            self.assertEqual(len(os.listdir(self.tmpdir)), 4)
+            self.assertIn('api.index', dumps[1])
+
+            with self.settings(PROFILE_MAX_BYTES=0):
+                self.client.get('/api/options/')
+            self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_rotation_interval(self):
+        # type: () -> None
+        old_rotate_every = profiling.ROTATE_EVERY
+        profiling.ROTATE_EVERY = 2
+        try:
+            with self.settings(PROFILE_DIR=self.tmpdir, PROFILE_SAMPLE_RATE=1.0, PROFILE_MAX_FILES=3):
+                self.client.get('/api/')
+                # dumps written by other processes are only noticed when the directory is listed again
+                for i in range(3):
+                    open(os.path.join(self.tmpdir, '0-{}.prof'.format(i)), 'w').close()
+                self.client.get('/api/')
+                self.assertEqual(len(self.get_dumps()), 5)
+                self.client.get('/api/')
+                self.assertEqual(len(self.get_dumps()), 3)
+                self.assertFalse([name for name in self.get_dumps() if name.startswith('0-')])
+        finally:
+            profiling.ROTATE_EVERY = old_rotate_every
@@ -26,6 +26,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'lib.metrics.MetricsMiddleware',
+    'lib.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -34,8 +36,13 @@ MIDDLEWARE_CLASSES = [
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'lib.profiling.ProfilingMiddleware',
 ]
 
+# ReplicaRouter sends reads to a replica only while ReplicaMiddleware handles a safe request
+# and DATABASE_REPLICAS is not empty (see lib/replicas.py)
+DATABASE_ROUTERS = ['lib.replicas.ReplicaRouter']
+
 ROOT_URLCONF = CONF_DIR_NAME + '.urls'
 
 TEMPLATES = [
@@ -85,6 +92,109 @@ admin.site.site_title = PROJECT_TITLE + " admin"
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# Caching
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Alias of the cache (in CACHES) used to cache API responses. Set to None to disable caching.
+API_CACHE = 'default'
+# Number of seconds for which a cached API response is kept. None means forever.
+API_CACHE_TIMEOUT = 600
+# API_CACHE has to be shared by all processes (for example memcached) for changes made in one
+# process to invalidate the responses cached by the others. In a local-memory cache, the versions
+# of the data are renewed every API_LOCAL_VERSION_TIMEOUT seconds instead, so other processes
+# may serve stale responses for that long.
+API_LOCAL_VERSION_TIMEOUT = 5
+# Stream the JSON of the read-only API endpoints while it is being encoded instead of building
+# it in memory first. This keeps memory use flat for large polls, but disables API_CACHE.
+STREAM_JSON_RESPONSES = False
+
+# Verified HTTP Basic auth credentials are cached in each process
+# so that the password hash is not computed on every request.
+# AUTH_CACHE_SIZE is the maximum number of cached credentials (0 disables the cache)
+# and AUTH_CACHE_TTL is the number of seconds for which they are cached.
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL = 300
+
+# Number of seconds for which tokens issued by /api/tokens/ are valid. None means forever.
+API_TOKEN_TTL = 30 * 24 * 3600
+
+# Alias of the cache (in CACHES) used by lib.auth_backends.CachedModelBackend to cache users
+# authenticated by sessions (see cached_auth.py). None disables the cache.
+USER_CACHE = None
+# Number of seconds for which a cached user is kept
+USER_CACHE_TIMEOUT = 300
+
+# Each process caches whether questions are locked or allow multiple votes (see lib/option_meta.py).
+# Changes made in other processes are noticed within OPTION_META_CHECK_INTERVAL seconds if API_CACHE
+# is shared by all processes, and within OPTION_META_MAX_AGE seconds otherwise.
+# Set OPTION_META_MAX_AGE to 0 to disable the cache.
+OPTION_META_CHECK_INTERVAL = 1
+OPTION_META_MAX_AGE = 30
+
+# Aliases in DATABASES of read-only replicas of the 'default' database, to which the reads
+# of GET requests are sent (see lib/replicas.py). They are picked 'round_robin' or by 'health'
+# (the latency of their last health check), and checked every REPLICA_CHECK_INTERVAL seconds.
+# Clients which make a POST request read from 'default' for the next REPLICA_PIN_SECONDS seconds,
+# which should be longer than the replication lag.
+DATABASE_REPLICAS = []
+REPLICA_SELECTION = 'round_robin'
+REPLICA_CHECK_INTERVAL = 5
+REPLICA_PIN_SECONDS = 10
+
+# PRAGMA statements run on every new SQLite connection, as a dict mapping names to values
+# (see lib/sqlite.py). sqlite.py sets them up for concurrent writers.
+SQLITE_PRAGMAS = {}
+# Writes which fail because an SQLite database is locked are retried this many times
+# after waiting for about SQLITE_LOCKED_RETRY_DELAY seconds, which is doubled for each retry.
+SQLITE_LOCKED_RETRIES = 3
+SQLITE_LOCKED_RETRY_DELAY = 0.05
+
+# Path of a file in which vote counts are shared by all processes on a host (see lib/tally.py).
+# /api/options/ then reads counts from this file instead of from the database. Requires fcntl (Unix).
+# None means that counts are only kept in the database.
+TALLY_FILE = None
+
+# Path of an SQLite file in which /api/vote/ queues ballots instead of applying them.
+# Queued ballots are applied by 'manage.py process_vote_queue', which must be kept running.
+# None means that ballots are applied immediately.
+VOTE_QUEUE = None
+# Maximum number of queued ballots applied in a transaction
+VOTE_QUEUE_BATCH_SIZE = 500
+
+# Number of days for which /api/changes/ reports deleted questions and options. Older entries are
+# removed whenever something is deleted, and clients which last synced before them have to fetch all the data again.
+CHANGE_LOG_RETENTION_DAYS = 30
+# Number of seconds within which a transaction which logs a change is expected to commit.
+# /api/changes/ sends the changes made in this time again, in case earlier ones weren't committed yet.
+CHANGE_LOG_COMMIT_MARGIN = 10
+
+# Live events (/api/stream/)
+
+# Class used to fan out events to subscribers. LocalBroker only works within a single process.
+EVENT_BROKER = 'lib.events.LocalBroker'
+# A comment is sent to idle subscribers after this many seconds
+SSE_HEARTBEAT_INTERVAL = 15
+# Streams are closed after this many seconds (None means never), after which clients reconnect
+SSE_MAX_DURATION = 600
+
+# Profiling (see lib/profiling.py)
+
+# Directory in which the cProfile stats of profiled requests are written. None disables profiling.
+PROFILE_DIR = None
+# Fraction of requests which are profiled
+PROFILE_SAMPLE_RATE = 0.0
+# Names of views (like 'api:vote') whose requests are all profiled
+PROFILE_URL_NAMES = []
+# The oldest dumps are removed when there are more than PROFILE_MAX_FILES of them
+# or they take more than PROFILE_MAX_BYTES bytes (which is only checked from time to time)
+PROFILE_MAX_FILES = 1000
+PROFILE_MAX_BYTES = 100 * 1024 * 1024
+
 # Misc
 
 ALLOW_REG = True
@@ -94,6 +204,10 @@ if DEBUG:
 else:
     JSON_INDENT = None
 
+# Dotted path of the class used to parse and encode JSON (see lib.codec).
+# 'lib.codec.OrjsonCodec' is faster, but needs orjson and formats responses differently.
+JSON_CODEC = 'lib.codec.StdlibCodec'
+
 # Import local settings
 
 try:
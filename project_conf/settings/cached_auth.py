@@ -0,0 +1,16 @@
+# Settings which keep sessions and authenticated users in the cache,
+# so that requests authenticated by a session don't query the database before the view runs.
+# To use them, add 'from .cached_auth import *' to local.py.
+# Sessions are still written to the database, so they survive a cache flush.
+# The cache has to be shared by all server processes (like memcached),
+# otherwise a user who has logged out in one process stays logged in in the others.
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'default'
+
+# ModelBackend is kept so that sessions created before switching to these settings remain valid
+AUTHENTICATION_BACKENDS = [
+    'lib.auth_backends.CachedModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+USER_CACHE = 'default'
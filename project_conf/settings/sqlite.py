@@ -0,0 +1,15 @@
+# Settings for serving concurrent writers from an SQLite database.
+# To use them, add 'from .sqlite import *' to local.py.
+# WAL journaling lets reads proceed while a vote is being written. It keeps the database in
+# two extra files (-wal and -shm) next to it, so the database must be on a local filesystem.
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    # with WAL, NORMAL is safe against corruption; a power failure may lose the last transactions
+    'synchronous': 'NORMAL',
+    # milliseconds for which a writer waits for the lock before failing with 'database is locked'
+    'busy_timeout': 5000,
+    # read the database through a memory mapping of up to this many bytes
+    'mmap_size': 256 * 1024 * 1024,
+}
+SQLITE_LOCKED_RETRIES = 5
@@ -1,5 +1,5 @@
 from six import text_type
-from typing import AnyStr, Optional, Union
+from typing import Any, AnyStr, Dict, List, Optional, Union
 
 PROJECT_NAME = ... # type: Union[str, text_type]
 PROJECT_TITLE = ... # type: text_type
@@ -8,3 +8,37 @@ SECRET_KEY = ... # type: str
 DEBUG = ... # type: bool
 ALLOW_REG = ... # type: bool
 JSON_INDENT = ... # type: Optional[int]
+JSON_CODEC = ... # type: Optional[str]
+
+CACHES = ... # type: Dict[str, Dict[str, Any]]
+API_CACHE = ... # type: Optional[str]
+API_CACHE_TIMEOUT = ... # type: Optional[int]
+API_LOCAL_VERSION_TIMEOUT = ... # type: int
+STREAM_JSON_RESPONSES = ... # type: bool
+AUTH_CACHE_SIZE = ... # type: int
+AUTH_CACHE_TTL = ... # type: float
+API_TOKEN_TTL = ... # type: Optional[float]
+USER_CACHE = ... # type: Optional[str]
+USER_CACHE_TIMEOUT = ... # type: Optional[float]
+OPTION_META_CHECK_INTERVAL = ... # type: float
+OPTION_META_MAX_AGE = ... # type: float
+DATABASE_REPLICAS = ... # type: List[str]
+REPLICA_SELECTION = ... # type: str
+REPLICA_CHECK_INTERVAL = ... # type: float
+REPLICA_PIN_SECONDS = ... # type: float
+PROFILE_DIR = ... # type: Optional[text_type]
+PROFILE_SAMPLE_RATE = ... # type: float
+PROFILE_URL_NAMES = ... # type: List[str]
+PROFILE_MAX_FILES = ... # type: int
+PROFILE_MAX_BYTES = ... # type: int
+SQLITE_PRAGMAS = ... # type: Dict[str, Any]
+SQLITE_LOCKED_RETRIES = ... # type: int
+SQLITE_LOCKED_RETRY_DELAY = ... # type: float
+TALLY_FILE = ... # type: Optional[text_type]
+VOTE_QUEUE = ... # type: Optional[text_type]
+VOTE_QUEUE_BATCH_SIZE = ... # type: int
+CHANGE_LOG_RETENTION_DAYS = ... # type: float
+CHANGE_LOG_COMMIT_MARGIN = ... # type: float
+EVENT_BROKER = ... # type: str
+SSE_HEARTBEAT_INTERVAL = ... # type: float
+SSE_MAX_DURATION = ... # type: Optional[float]
@@ -1,5 +1,5 @@
 from six import text_type
-from typing import overload, Any, Generator, Generic, Iterable, Mapping, Optional, Sequence, Sized, Tuple, TypeVar
+from typing import overload, Any, Dict, Generator, Generic, Iterable, Mapping, Optional, Sequence, Sized, Tuple, TypeVar
 
 class Model(object):
     def save(self, update_fields=[]):
@@ -12,6 +12,9 @@ def BooleanField(name=None, default=None, blank=False, null=False, *args, **kwar
 def CharField(name=None, default=None, max_length=None, blank=False, null=False, *args, **kwargs):
     # type: (Optional[text_type], Optional[bool], Optional[int], bool, bool, *Any, **Any) -> text_type
     ...
+def IntegerField(name=None, default=None, blank=False, null=False, *args, **kwargs):
+    # type: (Optional[text_type], Optional[int], bool, bool, *Any, **Any) -> int
+    ...
 def TextField(name=None, default=None, blank=False, null=False, *args, **kwargs):
     # type: (Optional[text_type], Optional[bool], bool, bool, *Any, **Any) -> text_type
     ...
@@ -19,6 +22,27 @@ def ForeignKey(field, blank=False, null=False, *args, **kwargs):
     # type: (Any, bool, bool, *Any, **Any) -> Any
     ...
 
+class F(object):
+    def __init__(self, name):
+        # type: (text_type) -> None
+        ...
+    def __add__(self, other):
+        # type: (Any) -> F
+        ...
+    def __sub__(self, other):
+        # type: (Any) -> F
+        ...
+
+class Count(object):
+    def __init__(self, expression, distinct=False, **extra):
+        # type: (Any, bool, **Any) -> None
+        ...
+
+class Sum(object):
+    def __init__(self, expression, **extra):
+        # type: (Any, **Any) -> None
+        ...
+
 ModelT = TypeVar('ModelT', bound=Model)
 
 class ModelIterable(Generic[ModelT], Iterable):
@@ -56,7 +80,7 @@ class QuerySet(Generic[ModelT], Sequence):
     def first(self) -> ModelT: ...
     def count(self) -> int: ... # type: ignore
     def exists(self) -> bool: ...
-    def delete(self) -> None: ...
+    def delete(self) -> Tuple[int, Dict[text_type, int]]: ...
     def select_related(self) -> QuerySet[ModelT]: ...
     def values(self, *args):
         # type: (*text_type) -> ValuesIterable[ModelT]
@@ -73,7 +97,10 @@ class QuerySet(Generic[ModelT], Sequence):
 
     def __len__(self) -> int: ...
     def update(self, **kwargs):
-        # type: (**Any) -> None
+        # type: (**Any) -> int
+        ...
+    def annotate(self, *args, **kwargs):
+        # type: (*Any, **Any) -> QuerySet[ModelT]
         ...
 
 class Manager(Generic[ModelT], QuerySet):
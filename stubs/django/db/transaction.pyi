@@ -0,0 +1,8 @@
+from typing import Any, Callable, Optional
+
+def atomic(using=None, savepoint=True):
+    # type: (Optional[str], bool) -> Any
+    ...
+def on_commit(func, using=None):
+    # type: (Callable[[], None], Optional[str]) -> None
+    ...
@@ -1,4 +1,4 @@
 from django.http.request import HttpRequest, QueryDict
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, StreamingHttpResponse
 
-__all__ = ['HttpRequest', 'QueryDict', 'HttpResponse']
+__all__ = ['HttpRequest', 'QueryDict', 'HttpResponse', 'StreamingHttpResponse']
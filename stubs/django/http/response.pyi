@@ -19,3 +19,10 @@ class HttpResponse(MutableMapping[text_type, text_type]):
     def __delitem__(self, header: text_type) -> None: ...
     def __iter__(self) -> Iterator[text_type]: ...
     def __len__(self) -> int: ...
+
+class StreamingHttpResponse(HttpResponse):
+    streaming_content = ... # type: Iterator[binary_type]
+
+    def __init__(self, streaming_content=(), content_type=None, status=200, reason=None, charset=None):
+        # type: (Any, Optional[text_type], int, Optional[str], Optional[text_type]) -> None
+        ...
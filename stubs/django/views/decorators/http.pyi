@@ -1,5 +1,5 @@
 from django.http import HttpResponse
-from typing import Callable
+from typing import Any, Callable, Optional
 
 def require_safe(view):
     # type: (Callable[..., HttpResponse]) -> Callable[..., HttpResponse]
@@ -7,3 +7,6 @@ def require_safe(view):
 def require_POST(view):
     # type: (Callable[..., HttpResponse]) -> Callable[..., HttpResponse]
     ...
+def condition(etag_func=None, last_modified_func=None):
+    # type: (Optional[Callable[..., Any]], Optional[Callable[..., Any]]) -> Callable[[Callable[..., HttpResponse]], Callable[..., HttpResponse]]
+    ...